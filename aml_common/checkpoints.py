@@ -0,0 +1,81 @@
+import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import torch
+
+def copy_to_cpu(obj):
+    # Copy tensors to the CPU, so a checkpoint can be written while training keeps updating the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(item) for item in obj)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    return copy.deepcopy(obj)
+
+def capture_rng_states():
+    rng_states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        rng_states['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_states
+
+def restore_rng_states(rng_states):
+    torch.set_rng_state(rng_states['torch'])
+    np.random.set_state(rng_states['numpy'])
+    if 'cuda' in rng_states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states['cuda'])
+
+class CheckpointManager:
+    # Saves the training state every N epochs (or minutes) and restores the last saved state. The state is copied to
+    # the CPU and written by a background thread to a temporary file which is then renamed, so a crash while writing
+    # never corrupts the last checkpoint
+    def __init__(self, checkpoint_path, every_n_epochs=1, every_n_minutes=None):
+        self.checkpoint_path = checkpoint_path
+        self.every_n_epochs = every_n_epochs
+        self.every_n_minutes = every_n_minutes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_write = None
+        self.last_save_time = perf_counter()
+
+    def load(self):
+        # Return the last saved state, or None when there is no checkpoint
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        return torch.load(self.checkpoint_path, map_location='cpu', weights_only=False)
+
+    def write(self, state):
+        temporary_path = self.checkpoint_path + '.tmp'
+        torch.save(state, temporary_path)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def wait(self):
+        # Wait for the write in progress and raise if it failed
+        if self.pending_write is not None:
+            self.pending_write.result()
+            self.pending_write = None
+
+    def maybe_save(self, epoch, num_epochs, get_state):
+        # Save after every N epochs, after every N minutes if given, and after the last epoch
+        if self.every_n_minutes is not None:
+            should_save = perf_counter() - self.last_save_time >= 60 * self.every_n_minutes
+        else:
+            should_save = (epoch + 1) % self.every_n_epochs == 0
+        if not should_save and epoch != num_epochs - 1:
+            return
+
+        # Only the CPU copy is made synchronously, at most one write is in flight at a time
+        state = copy_to_cpu(get_state())
+        state['epoch'] = epoch
+        state['rng_states'] = capture_rng_states()
+        self.wait()
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        self.pending_write = self.executor.submit(self.write, state)
+        self.last_save_time = perf_counter()
+
+    def close(self):
+        # Wait for the last write and stop the writer thread, call this once training is done
+        self.wait()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,90 @@
+import os
+import atexit
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import matplotlib
+import matplotlib.pyplot as plt
+import plotly.graph_objects as go
+
+# Plot functions the figure workers can run, registered by name by headless_figure
+plot_functions = {}
+
+# State of the headless figure rendering, set up by start_figure_workers
+figure_rendering_state = {'figures_dir': None, 'pool': None, 'futures': [], 'counter': 0, 'output_path': None}
+
+def to_plain_arrays(obj):
+    # Convert tensors to numpy arrays, so figure jobs are pickled as plain arrays and don't hold the device or autograd graphs
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu').numpy()
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_plain_arrays(item) for item in obj)
+    if isinstance(obj, dict):
+        return {key: to_plain_arrays(value) for key, value in obj.items()}
+    return obj
+
+def init_figure_worker():
+    # Figure workers render without a display and with a single thread
+    matplotlib.use('Agg')
+    torch.set_num_threads(1)
+
+def render_figure_job(plot_function_name, args, kwargs, output_path):
+    # Run the registered plot function, show_figure saves the figure to output_path
+    figure_rendering_state['output_path'] = output_path
+    plot_functions[plot_function_name](*args, **kwargs)
+    return output_path
+
+def headless_figure(plot_function):
+    # Register the plot function, so the figure workers can run it by name
+    plot_functions[plot_function.__name__] = plot_function
+
+    @functools.wraps(plot_function)
+    def wrapper(*args, **kwargs):
+        # Render in place when the figure workers weren't started (or when already inside a figure worker)
+        if figure_rendering_state['pool'] is None or figure_rendering_state['output_path'] is not None:
+            return plot_function(*args, **kwargs)
+
+        # Submit the figure job without waiting for it
+        figure_rendering_state['counter'] += 1
+        output_path = os.path.join(figure_rendering_state['figures_dir'], f"{figure_rendering_state['counter']:03d}_{plot_function.__name__}")
+        future = figure_rendering_state['pool'].submit(render_figure_job, plot_function.__name__, to_plain_arrays(args), to_plain_arrays(kwargs), output_path)
+        figure_rendering_state['futures'].append(future)
+
+    return wrapper
+
+def start_figure_workers(figures_dir, num_of_workers=2):
+    # Save the figures of the registered plot functions to figures_dir from background workers. The workers are forked,
+    # so they inherit the plot functions registered so far without re-running the calling script. Call this once the
+    # plot functions are defined and before any data loader or background thread starts, since forking a process with
+    # running threads can deadlock the children
+    os.makedirs(figures_dir, exist_ok=True)
+    pool = ProcessPoolExecutor(max_workers=num_of_workers, mp_context=multiprocessing.get_context('fork'), initializer=init_figure_worker)
+
+    # A fork pool launches all its workers on the first submit
+    pool.submit(int).result()
+    figure_rendering_state['figures_dir'] = figures_dir
+    figure_rendering_state['pool'] = pool
+    atexit.register(wait_for_figures)
+
+def show_figure(fig=None):
+    # Show the figure, or save it to a file when rendering headless
+    output_path = figure_rendering_state['output_path']
+    if output_path is None:
+        if isinstance(fig, go.Figure):
+            fig.show()
+        else:
+            plt.show()
+    elif isinstance(fig, go.Figure):
+        fig.write_html(output_path + '.html')
+    else:
+        fig = plt.gcf() if fig is None else fig
+        fig.savefig(output_path + '.png', bbox_inches='tight')
+        plt.close('all')
+
+def wait_for_figures():
+    # Wait for all the submitted figure jobs and raise if any of them failed
+    for future in figure_rendering_state['futures']:
+        future.result()
+    figure_rendering_state['futures'] = []
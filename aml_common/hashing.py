@@ -0,0 +1,12 @@
+import hashlib
+
+import torch
+
+def hash_model_weights(model):
+    # Hash the names, dtypes, shapes and values of all the model's parameters and buffers
+    weights_hash = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        weights_hash.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode('utf-8'))
+        weights_hash.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return weights_hash.hexdigest()
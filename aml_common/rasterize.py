@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+
+def compute_points_extent(points, margin=0.02):
+    # Compute the bounding box of the points with a small margin, so no point falls outside the grid
+    points = torch.as_tensor(points).detach()
+    (x_min, y_min), (x_max, y_max) = points.amin(dim=0).tolist(), points.amax(dim=0).tolist()
+    x_margin, y_margin = margin * max(x_max - x_min, 1e-6), margin * max(y_max - y_min, 1e-6)
+    return (x_min - x_margin, x_max + x_margin, y_min - y_margin, y_max + y_margin)
+
+def rasterize_points(points, labels=None, num_of_labels=1, extent=None, resolution=512, chunk_size=int(1e7)):
+    # Bin the points (numpy array or tensor) into a (num_of_labels, resolution, resolution) counts grid on
+    # their own device, so only the grid is copied to the CPU
+    points = torch.as_tensor(points)
+    x_min, x_max, y_min, y_max = compute_points_extent(points) if extent is None else extent
+    counts = torch.zeros(num_of_labels * resolution * resolution, dtype=torch.long, device=points.device)
+
+    for start in range(0, points.size(0), chunk_size):
+        chunk_points = points[start:start + chunk_size].detach()
+        cols = torch.floor((chunk_points[:, 0] - x_min) / (x_max - x_min) * resolution).long()
+        rows = torch.floor((chunk_points[:, 1] - y_min) / (y_max - y_min) * resolution).long()
+        inside = (cols >= 0) & (cols < resolution) & (rows >= 0) & (rows < resolution)
+
+        # Each label gets its own plane in the flattened grid
+        flat_indices = rows * resolution + cols
+        if labels is not None:
+            flat_indices = flat_indices + torch.as_tensor(labels[start:start + chunk_size], device=points.device).long() * resolution * resolution
+        counts += torch.bincount(flat_indices[inside], minlength=num_of_labels * resolution * resolution)
+
+    return counts.view(num_of_labels, resolution, resolution).cpu().numpy()
+
+def shade_density_image(counts, label_colors):
+    # Blend the labels colors in each pixel according to their counts
+    total_counts = counts.sum(axis=0)
+    blended_colors = np.einsum('lhw,lc->hwc', counts, np.asarray(label_colors)) / np.maximum(total_counts, 1)[..., None]
+
+    # Shade each pixel according to its log density over a white background
+    max_log_count = np.log1p(total_counts.max())
+    intensity = np.log1p(total_counts) / max_log_count if max_log_count > 0 else np.zeros_like(total_counts, dtype=np.float64)
+    image = 1 - intensity[..., None] * (1 - blended_colors)
+
+    return image
@@ -7,6 +7,9 @@ Original file is located at
     https://colab.research.google.com/drive/1tHRCvNlpn-MYWzYsMNEs5wliNLxotFeK
 """
 
+import os
+import sys
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -18,6 +21,10 @@ from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
+# Make the helpers shared by the exercises importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aml_common.figures import headless_figure, show_figure, start_figure_workers
+
 ################### Complete the code below ###################
 # Define a CNN architecture
 ###############################################################
@@ -42,6 +49,8 @@ test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False)
 # Initialize the model, loss function, and optimizer
 import torch.nn.functional as F
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+FIGURES_DIR = None
+NUM_OF_FIGURE_WORKERS = 1
 
 # Define and initiate the model
 class MnistCnn(nn.Module):
@@ -69,6 +78,39 @@ model = model.to(DEVICE)
 criterion = nn.CrossEntropyLoss()
 optimizer = optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
 
+# Define the plot of the validation loss and accuracy
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+@headless_figure
+def plot_validation_losses_and_accuracies(val_losses, val_accuracies):
+    epochs = torch.arange(1, len(val_losses) + 1, 1)
+    plot = make_subplots(rows=2, cols=1,
+                         subplot_titles=("Validation losses as functions of epoch number",
+                                         "Validation accuracies as functions of epoch number"))
+
+    # Create the first subplot
+    plot.update_xaxes(title_text="Epochs Number", row=1, col=1)
+    plot.update_yaxes(title_text="Validation Loss", row=1, col=1)
+    plot.add_trace(
+        go.Scatter(x=epochs, y=val_losses, mode='lines+markers', name='Average validation loss',
+                   marker=dict(color='#0000FF', size=10)), row=1, col=1
+    )
+
+    # Create the first subplot
+    plot.update_xaxes(title_text="Epochs Number", row=2, col=1)
+    plot.update_yaxes(title_text="Accuracy", row=2, col=1)
+    plot.add_trace(
+        go.Scatter(x=epochs, y=val_accuracies, mode='lines+markers', name='Accuracy',
+                   marker=dict(color='#8B0000', size=10)), row=2, col=1
+    )
+
+    show_figure(plot)
+
+# Start the figure workers now that the plot function is defined, before training starts
+if FIGURES_DIR is not None:
+    start_figure_workers(FIGURES_DIR, NUM_OF_FIGURE_WORKERS)
+
 ################### Complete the code below ###################
 
 # Training loop
@@ -123,27 +165,4 @@ for epoch in range(num_epochs):
 
 ################### Complete the code below ###################
 # plot the validation loss and accuracy
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-
-epochs = torch.arange(1, 11, 1)
-plot = make_subplots(rows=2, cols=1,
-                     subplot_titles=("Validation losses as functions of epoch number",
-                                     "Validation accuracies as functions of epoch number"))
-
-# Create the first subplot
-plot.update_xaxes(title_text="Epochs Number", row=1, col=1)
-plot.update_yaxes(title_text="Validation Loss", row=1, col=1)
-plot.add_trace(
-    go.Scatter(x=epochs, y=val_losses, mode='lines+markers', name='Average validation loss',
-               marker=dict(color='#0000FF', size=10)), row=1, col=1
-)
-
-# Create the first subplot
-plot.update_xaxes(title_text="Epochs Number", row=2, col=1)
-plot.update_yaxes(title_text="Accuracy", row=2, col=1)
-plot.add_trace(
-    go.Scatter(x=epochs, y=val_accuracies, mode='lines+markers', name='Accuracy',
-               marker=dict(color='#8B0000', size=10)), row=2, col=1
-)
-plot.show()
\ No newline at end of file
+plot_validation_losses_and_accuracies(val_losses, val_accuracies)
@@ -7,7 +7,10 @@ Original file is located at
     https://colab.research.google.com/drive/1equOe_nUaKrt0PCGt5CFfoGX1fXwC1H9
 """
 
+import os
+import sys
 import math
+
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -21,6 +24,10 @@ from tqdm import tqdm
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
+# Make the helpers shared by the exercises importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aml_common.figures import headless_figure, show_figure, start_figure_workers, to_plain_arrays
+
 # Set device to cuda if possible
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 SEED = 42
@@ -31,6 +38,8 @@ POSTERIOR_STD = 0.4
 NUM_OF_EPOCH = 30
 DECODER_LR = 1e-3
 LATENT_LR = 1e-2
+FIGURES_DIR = None
+NUM_OF_FIGURE_WORKERS = 2
 
 # Set Random Seed
 torch.manual_seed(SEED)          # Sets the seed for CPU
@@ -88,6 +97,7 @@ def sample_indices_and_images(dataloader, batch_size, num_of_samples_per_digit):
 
     return res_indices, res_images
 
+@headless_figure
 def plot_vae_losses(val_losses):
     plot = make_subplots(rows=1, cols=1, subplot_titles=('Validation losses as functions of number of epoch'))
 
@@ -99,8 +109,9 @@ def plot_vae_losses(val_losses):
     go.Scatter(x=epochs, y=val_losses, mode='lines+markers', name='Average validation loss',
                marker=dict(color='#0000FF', size=10)), row=1, col=1)
 
-    plot.show()
+    show_figure(plot)
 
+@headless_figure
 def present_rec_images(real_images, rec_images_list, chosen_epochs_list):
     num_rows = len(rec_images_list) + 1
     num_cols = len(rec_images_list[0])
@@ -125,12 +136,13 @@ def present_rec_images(real_images, rec_images_list, chosen_epochs_list):
             ax.axis('off')
             ax.set_title(f'Digit {col}')
             if row == 0:
-                ax.imshow(real_images[col].squeeze().to('cpu'), cmap='gray')
+                ax.imshow(to_plain_arrays(real_images[col]).squeeze(), cmap='gray')
             else:
-                ax.imshow(rec_images_list[row - 1][col].squeeze().to('cpu'), cmap='gray')
+                ax.imshow(to_plain_arrays(rec_images_list[row - 1][col]).squeeze(), cmap='gray')
 
-    plt.show()
+    show_figure(fig)
 
+@headless_figure
 def present_gen_images(gen_images_list, chosen_epochs_list):
     num_rows = len(gen_images_list)
     num_cols = len(gen_images_list[0])
@@ -150,9 +162,9 @@ def present_gen_images(gen_images_list, chosen_epochs_list):
         axs = subfig.subplots(nrows=1, ncols=num_cols)
         for col, ax in enumerate(axs):
             ax.axis('off')
-            ax.imshow(gen_images_list[row][col].squeeze().to('cpu'), cmap='gray')
+            ax.imshow(to_plain_arrays(gen_images_list[row][col]).squeeze(), cmap='gray')
 
-    plt.show()
+    show_figure(fig)
 
 def compute_gaussian_log_probs(samples_tensor, mean_tensor, var_tensor):
     tensor1 = torch.log(2 * torch.pi * var_tensor)
@@ -161,17 +173,22 @@ def compute_gaussian_log_probs(samples_tensor, mean_tensor, var_tensor):
 
     return log_probs_vector
 
+@headless_figure
 def present_images_with_log_probs(images, log_probs):
-    num_cols = images.size()[0]
+    num_cols = images.shape[0]
 
     # Create a figure
     fig, axs = plt.subplots(nrows=1, ncols=num_cols, figsize=(20, 2))
     for i in range(10):
-        axs[i].imshow(images[i].squeeze().to('cpu'), cmap='gray')
+        axs[i].imshow(to_plain_arrays(images[i]).squeeze(), cmap='gray')
         axs[i].set_title(f'Log Prob: {log_probs[i]:.2f}')
         axs[i].axis('off')
 
-    plt.show()
+    show_figure(fig)
+
+# Start the figure workers now that the plot functions are defined, before any training starts
+if FIGURES_DIR is not None:
+    start_figure_workers(FIGURES_DIR, NUM_OF_FIGURE_WORKERS)
 
 """**Questions 1 + 2**"""
 
@@ -7,6 +7,15 @@ Original file is located at
     https://colab.research.google.com/drive/1gMX7OMQHuM6exHKJ0Bq7eLprAG1GGlEV
 """
 
+import os
+import copy
+import json
+import sys
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+
 import torch
 from torch import nn
 import torch.optim as optim
@@ -18,8 +27,17 @@ import matplotlib.pyplot as plt
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from matplotlib.colors import Normalize, LinearSegmentedColormap
+from matplotlib.colors import Normalize, LinearSegmentedColormap, to_rgb
 from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
+from scipy.optimize import linear_sum_assignment
+
+# Make the helpers shared by the exercises importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aml_common.figures import headless_figure, show_figure, start_figure_workers, to_plain_arrays
+from aml_common.rasterize import compute_points_extent, rasterize_points, shade_density_image
+from aml_common.checkpoints import CheckpointManager, restore_rng_states
+from aml_common.hashing import hash_model_weights
 
 # Set global variables
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -34,6 +52,19 @@ NUM_OF_CLASSES = 5
 MATCH_FLOW_DELTA_T = 1e-3
 NUM_0F_DATA_POINTS = int(25e4)
 NUM_OF_AFFINE_LAYERS = 15
+OT_EXACT_MAX_BATCH_SIZE = 256
+SINKHORN_REG = 0.05
+SINKHORN_NUM_OF_ITERS = 100
+REFLOW_NUM_OF_PAIRS = int(1e5)
+REFLOW_CACHE_PATH = './data/reflow_couplings.pt'
+PARAREAL_NUM_OF_SEGMENTS = 8
+PARAREAL_TOLERANCE = 1e-4
+BENCHMARK_REPORT_PATH = './benchmark_report.json'
+NFLOW_EXPORT_DIR = './exported_nflow'
+CHECKPOINT_DIR = './checkpoints'
+FIGURES_DIR = None
+NUM_OF_FIGURE_WORKERS = 4
+RUN_BENCHMARKS = False
 
 # Set Random Seed
 torch.manual_seed(SEED)          # Sets the seed for CPU
@@ -111,16 +142,7 @@ def create_olympic_rings(n_points, ring_thickness=0.25, verbose=True):
 
     # Plotting the points
     if verbose:
-        x, y = zip(*sampled_points)
-        colors = labels
-        if len(sampled_points) > 10000:
-            rand_idx = np.random.choice(len(sampled_points), 10000, replace=False)
-            plt.scatter(np.array(x)[rand_idx], np.array(y)[rand_idx], s=1, c=np.array(colors)[rand_idx])
-        else:
-            plt.scatter(x, y, s=1, c=colors)
-        plt.gca().set_aspect('equal', adjustable='box')
-        plt.title('Numpy Sampled Olympic Rings')
-        plt.show()
+        plot_sampled_olympic_rings(sampled_points, labels)
 
     sampled_points = np.asarray(sampled_points)
     # transform labels from strings to ints
@@ -140,15 +162,7 @@ def create_unconditional_olympic_rings(n_points, ring_thickness=0.25, verbose=Tr
     radius = 1
     data = generate_points_on_rings__unconditional(centers, radius, ring_thickness, n_points)
     if verbose:
-        x, y = zip(*data)
-        if len(data) > 10000:
-            rand_idx = np.random.choice(len(data), 10000, replace=False)
-            plt.scatter(np.array(x)[rand_idx], np.array(y)[rand_idx], s=1)
-        else:
-            plt.scatter(x, y, s=1)
-        plt.gca().set_aspect('equal', adjustable='box')
-        plt.title('Numpy Sampled Olympic Rings')
-        plt.show()
+        plot_sampled_olympic_rings(data)
     data = np.asarray(data)
     # normalize data
     data = (data - np.mean(data, axis=0)) / np.std(data, axis=0)
@@ -232,12 +246,190 @@ def compute_gaussian_log_probs(samples_tensor, mean_tensor, var_tensor):
 
     return log_probs_vector
 
+def compute_sinkhorn_plan(cost_matrix, reg=SINKHORN_REG, num_of_iters=SINKHORN_NUM_OF_ITERS):
+    # Use uniform marginals for both sides of the plan
+    num_of_rows, num_of_cols = cost_matrix.size()
+    log_rows_marginal = torch.full((num_of_rows,), -np.log(num_of_rows), device=cost_matrix.device)
+    log_cols_marginal = torch.full((num_of_cols,), -np.log(num_of_cols), device=cost_matrix.device)
+
+    # Scale the cost so the regularization strength doesn't depend on the data scale
+    log_kernel = -cost_matrix / (reg * cost_matrix.max())
+
+    # Run Sinkhorn iterations in the log domain to avoid underflow
+    f = torch.zeros(num_of_rows, device=cost_matrix.device)
+    g = torch.zeros(num_of_cols, device=cost_matrix.device)
+    for _ in range(num_of_iters):
+        f = log_rows_marginal - torch.logsumexp(log_kernel + g.unsqueeze(dim=0), dim=1)
+        g = log_cols_marginal - torch.logsumexp(log_kernel + f.unsqueeze(dim=1), dim=0)
+
+    plan = torch.exp(log_kernel + f.unsqueeze(dim=1) + g.unsqueeze(dim=0))
+    return plan
+
+def compute_ot_coupling(batch, noised_samples, exact_max_batch_size=OT_EXACT_MAX_BATCH_SIZE):
+    # Re-pair the noise samples with the batch points according to a minibatch optimal transport plan
+    with torch.no_grad():
+        # Compute the squared L2 cost of moving each noise sample to each batch point
+        cost_matrix = torch.pow(torch.cdist(batch, noised_samples), 2)
+
+        if batch.size(0) <= exact_max_batch_size:
+            # Small batch - use an exact assignment
+            _, noise_indices = linear_sum_assignment(cost_matrix.cpu().numpy())
+            noise_indices = torch.from_numpy(noise_indices).to(batch.device)
+        else:
+            # Large batch - sample a noise for each point from the Sinkhorn plan
+            plan = compute_sinkhorn_plan(cost_matrix)
+            noise_indices = torch.multinomial(plan, num_samples=1).squeeze(dim=1)
+
+    return noised_samples[noise_indices]
+
+def compute_class_ot_coupling(batch, batch_class, noised_samples, exact_max_batch_size=OT_EXACT_MAX_BATCH_SIZE):
+    # Re-pair the noise samples with the batch points separately within each class
+    coupled_noised_samples = noised_samples.clone()
+    for c in torch.unique(batch_class):
+        class_mask = batch_class == c
+        coupled_noised_samples[class_mask] = compute_ot_coupling(batch[class_mask], noised_samples[class_mask], exact_max_batch_size)
+
+    return coupled_noised_samples
+
+def sample_flow_matching_time(batch_size, method='iid'):
+    # Validate method parameter
+    assert(method in ['iid', 'stratified', 'antithetic']), "Method must be either 'iid', 'stratified' or 'antithetic'"
+
+    if method == 'iid':
+        # Sample time from Uniform distribution of 0 to 1
+        time = uniform_dist.sample((batch_size,)).to(DEVICE)
+    elif method == 'stratified':
+        # Sample one time from each of batch_size equal strata of [0, 1]
+        time = (torch.arange(batch_size, device=DEVICE) + torch.rand(batch_size, device=DEVICE)) / batch_size
+    else:
+        # Sample half of the times and mirror them around 0.5
+        half_time = torch.rand((batch_size + 1) // 2, device=DEVICE)
+        time = torch.cat([half_time, 1 - half_time], dim=0)[:batch_size]
+
+    # Shuffle the times so they aren't correlated with the order of the batch
+    if method != 'iid':
+        time = time[torch.randperm(batch_size, device=DEVICE)]
+
+    return time.unsqueeze(dim=1)
+
+def create_noise_sampler(method='iid', seed=SEED):
+    # Validate method parameter
+    assert(method in ['iid', 'sobol']), "Method must be either 'iid' or 'sobol'"
+
+    if method == 'iid':
+        def sample_noise(batch_size):
+            return mvn_dist.sample((batch_size,)).to(DEVICE)
+    else:
+        # Map scrambled Sobol points through the inverse normal CDF
+        sobol_engine = torch.quasirandom.SobolEngine(dimension=LATENT_DIM, scramble=True, seed=seed)
+
+        def sample_noise(batch_size):
+            uniform_points = sobol_engine.draw(batch_size).to(DEVICE)
+            uniform_points = torch.clamp(uniform_points, 1e-6, 1 - 1e-6)
+            return torch.special.ndtri(uniform_points)
+
+        # Expose the engine, so checkpoints can save and fast-forward its position in the sequence
+        sample_noise.sobol_engine = sobol_engine
+
+    return sample_noise
+
+def compute_sliced_wasserstein_distance(samples, reference_samples, num_of_projections=128, chunk_size=32):
+    # Use the same number of points from both sets
+    num_of_points = min(samples.size(0), reference_samples.size(0))
+    samples = samples[torch.randperm(samples.size(0))[:num_of_points]]
+    reference_samples = reference_samples[torch.randperm(reference_samples.size(0))[:num_of_points]].to(samples.device)
+
+    # Sample random unit directions
+    directions = torch.randn(samples.size(1), num_of_projections, device=samples.device)
+    directions = directions / torch.norm(directions, dim=0, keepdim=True)
+
+    # Project both sets and compare their sorted 1D projections, a chunk of directions at a time
+    sum_of_squares = 0.
+    for start in range(0, num_of_projections, chunk_size):
+        chunk_directions = directions[:, start:start + chunk_size]
+        samples_proj, _ = torch.sort(samples @ chunk_directions, dim=0)
+        reference_proj, _ = torch.sort(reference_samples @ chunk_directions, dim=0)
+        sum_of_squares += torch.sum(torch.pow(samples_proj - reference_proj, 2)).item()
+
+    distance = np.sqrt(sum_of_squares / (num_of_points * num_of_projections))
+    return distance
+
+def compute_mean_pairwise_distance(samples1, samples2, chunk_size=1024):
+    # Compute the mean euclidean distance between all pairs, a chunk of rows at a time
+    samples2 = samples2.to(samples1.device)
+    sum_of_distances = 0.
+    for start in range(0, samples1.size(0), chunk_size):
+        sum_of_distances += torch.cdist(samples1[start:start + chunk_size], samples2).sum().item()
+
+    return sum_of_distances / (samples1.size(0) * samples2.size(0))
+
+def compute_energy_distance(samples, reference_samples, chunk_size=1024):
+    # Energy distance: 2E|X - Y| - E|X - X'| - E|Y - Y'|
+    cross_term = compute_mean_pairwise_distance(samples, reference_samples, chunk_size)
+    samples_term = compute_mean_pairwise_distance(samples, samples, chunk_size)
+    reference_term = compute_mean_pairwise_distance(reference_samples, reference_samples, chunk_size)
+
+    return 2 * cross_term - samples_term - reference_term
+
+def sample_reference_rings(num_of_points, conditional=False, ring_thickness=0.25):
+    # Sample fresh raw ring points (before normalization)
+    if conditional:
+        raw_points, _ = sample_olympic_rings(num_of_points // 5, ring_thickness)
+    else:
+        centers = [(0, 0), (2, 0), (4, 0), (1, -1), (3, -1)]
+        raw_points = generate_points_on_rings__unconditional(centers, 1, ring_thickness, num_of_points)
+    raw_points = np.asarray(raw_points)
+
+    # Normalize the data the same way the training data is normalized and keep the statistics
+    normalization_mean = np.mean(raw_points, axis=0)
+    normalization_std = np.std(raw_points, axis=0)
+    reference_points = (raw_points - normalization_mean) / normalization_std
+    reference_points = torch.from_numpy(reference_points.astype(np.float32)).to(DEVICE)
+
+    return reference_points, normalization_mean, normalization_std
+
+def compute_fraction_inside_rings(samples, normalization_mean, normalization_std, ring_thickness=0.25, chunk_size=65536):
+    # Map the samples back to the rings coordinates
+    centers = torch.tensor([(0, 0), (2, 0), (4, 0), (1, -1), (3, -1)], dtype=torch.float32, device=samples.device)
+    normalization_mean = torch.tensor(normalization_mean, dtype=torch.float32, device=samples.device)
+    normalization_std = torch.tensor(normalization_std, dtype=torch.float32, device=samples.device)
+
+    # Count the points which are inside any of the rings, a chunk at a time
+    num_of_inside_points = 0
+    for start in range(0, samples.size(0), chunk_size):
+        points = samples[start:start + chunk_size] * normalization_std + normalization_mean
+        distances = torch.cdist(points, centers)
+        inside = torch.abs(distances - 1) <= ring_thickness / 2
+        num_of_inside_points += torch.any(inside, dim=1).sum().item()
+
+    return num_of_inside_points / samples.size(0)
+
+@headless_figure
+def plot_sampled_olympic_rings(points, colors=None):
+    # Render the density of all the sampled points as an image, colored by their ring when colors are given
+    if colors is None:
+        labels, label_colors = None, [to_rgb('blue')]
+    else:
+        unique_colors, labels = np.unique(np.asarray(colors), return_inverse=True)
+        label_colors = [to_rgb(color) for color in unique_colors]
+    extent = compute_points_extent(points)
+    counts = rasterize_points(points, labels, num_of_labels=len(label_colors), extent=extent)
+    image = shade_density_image(counts, label_colors)
+
+    fig = plt.figure()
+    plt.imshow(image, extent=extent, origin='lower', interpolation='nearest')
+    plt.gca().set_aspect('equal', adjustable='box')
+    plt.title('Numpy Sampled Olympic Rings')
+    show_figure(fig)
+
+@headless_figure
 def plot_nflow_losses(val_mean_log_probs, val_mean_log_inv_dets):
-    # Plot figure of loss as function of fitting iteration
-    number_of_epoch = len(val_mean_log_probs)
-    mean_losses = [val_mean_log_probs[i] + val_mean_log_inv_dets[i] for i in range(number_of_epoch)]
+    # Plot figure of loss as function of fitting iteration, skipping epochs without validation
+    epochs_list = [i + 1 for i in range(len(val_mean_log_probs)) if val_mean_log_probs[i] is not None]
+    val_mean_log_probs = [val_mean_log_probs[epoch - 1] for epoch in epochs_list]
+    val_mean_log_inv_dets = [val_mean_log_inv_dets[epoch - 1] for epoch in epochs_list]
+    mean_losses = [val_mean_log_probs[i] + val_mean_log_inv_dets[i] for i in range(len(epochs_list))]
 
-    epochs_list = list(range(1, number_of_epoch + 1))
     losses_plot = make_subplots(rows=1, cols=1)
     losses_plot.add_trace(
         go.Scatter(x=epochs_list, y=val_mean_log_probs, name='Log Probs', mode='lines+markers', line=dict(color='blue')),
@@ -255,11 +447,12 @@ def plot_nflow_losses(val_mean_log_probs, val_mean_log_inv_dets):
                                 title_text="Validaion mean losses as functions of number of epoch",
                                 xaxis_title="Number Of Epoch",
                                 yaxis_title="Validaion Mean Loss")
-    losses_plot.show()
+    show_figure(losses_plot)
 
+@headless_figure
 def plot_match_flow_losses(epoch_mean_losses):
     # Plot match flow training losses as a function of epoch
-    epoch_mean_losses = epoch_mean_losses.to('cpu').detach().numpy()
+    epoch_mean_losses = to_plain_arrays(epoch_mean_losses)
     number_of_epoch = len(epoch_mean_losses)
     epochs_list = list(range(1, number_of_epoch + 1))
 
@@ -273,11 +466,12 @@ def plot_match_flow_losses(epoch_mean_losses):
                             title_text="Train mean losses as functions of number of epoch",
                             xaxis_title="Number Of Epoch",
                             yaxis_title="Train Mean Loss")
-    losses_plot.show()
+    show_figure(losses_plot)
 
-def plot_2d_samples(samples_list, title_list, colors=[]):
+@headless_figure
+def plot_2d_samples(samples_list, title_list, colors=[], rasterize=False):
     # If using colore for each point, validate that colors have enough colors
-    assert(len(colors) == 0 or len(colors) == samples_list[0].size(0))
+    assert(len(colors) == 0 or len(colors) == samples_list[0].shape[0])
 
     # Create a figure
     number_of_plots = len(samples_list)
@@ -286,33 +480,50 @@ def plot_2d_samples(samples_list, title_list, colors=[]):
     if number_of_plots == 1:
         axes = [axes]
 
+    # Map the points colors into labels for the rasterized rendering
+    if rasterize:
+        if len(colors) == 0:
+            labels, label_colors = None, [to_rgb('blue')]
+        else:
+            unique_colors, labels = np.unique(np.asarray(colors), return_inverse=True)
+            label_colors = [to_rgb(color) for color in unique_colors]
+
     # Plot each samples from each time flow
     for index in range(len(samples_list)):
         samples = samples_list[index]
-        x = samples[:, 0].to('cpu').detach().numpy()
-        y = samples[:, 1].to('cpu').detach().numpy()
-        if len(colors) == 0:
-            axes[index].scatter(x, y, s=10, c='blue', alpha=0.5)
+        if rasterize:
+            # Render the density of the points as an image over the points own extent
+            extent = compute_points_extent(samples)
+            counts = rasterize_points(samples, labels, num_of_labels=len(label_colors), extent=extent)
+            image = shade_density_image(counts, label_colors)
+            axes[index].imshow(image, extent=extent, origin='lower', interpolation='nearest', aspect='auto')
         else:
-            axes[index].scatter(x, y, s=10, c=colors, alpha=0.5)
+            x = to_plain_arrays(samples[:, 0])
+            y = to_plain_arrays(samples[:, 1])
+            if len(colors) == 0:
+                axes[index].scatter(x, y, s=10, c='blue', alpha=0.5)
+            else:
+                axes[index].scatter(x, y, s=10, c=colors, alpha=0.5)
 
         axes[index].set_title(title_list[index])
         axes[index].grid(True)
 
-        # Set axis limits
-        axes[index].set_xlim(-2.5, 2.5)
-        axes[index].set_ylim(-2.5, 2.5)
+        # Set axis limits (the rasterized image already spans the points extent)
+        if not rasterize:
+            axes[index].set_xlim(-2.5, 2.5)
+            axes[index].set_ylim(-2.5, 2.5)
 
     # Adjust layout
     plt.tight_layout()
 
     # Show the plot
-    plt.show()
+    show_figure(fig)
 
-def plot_points_trajectory(samples_tensor, colors_lst=[], inverse=False, use_time=False):
+@headless_figure
+def plot_points_trajectory(samples_tensor, colors_lst=[], inverse=False, use_time=False, rasterize=False):
     # Get number of steps of each point
-    number_of_points = samples_tensor.size()[0]
-    number_of_steps = samples_tensor.size()[1]
+    number_of_points = samples_tensor.shape[0]
+    number_of_steps = samples_tensor.shape[1]
 
     # Validate we color the points according to time or according to the point
     assert(len(colors_lst) == 0 or len(colors_lst) == number_of_points)
@@ -351,16 +562,34 @@ def plot_points_trajectory(samples_tensor, colors_lst=[], inverse=False, use_tim
       title += ' (Inversed)'
     ax.set_title(title)
 
-    for index in range(number_of_points):
-        trajectory = samples_tensor[index]
-        x = trajectory[:, 0].to('cpu').detach().numpy()
-        y = trajectory[:, 1].to('cpu').detach().numpy()
+    if rasterize:
+        # Copy all trajectories to the CPU at once and draw them as a single line collection
+        trajectories = to_plain_arrays(samples_tensor)
+        segments = np.stack([trajectories[:, :-1], trajectories[:, 1:]], axis=2).reshape(-1, 2, 2)
+
+        # Color each segment according to its step, using the point's color map
         if len(colors_lst) == 0:
-            ax.scatter(x, y, s=100, c=default_cmap(norm(steps)))
-            ax.plot(x, y)
+            segments_colors = np.tile(default_cmap(norm(steps[:-1])), (number_of_points, 1))
         else:
-            cmap = colors_cmaps[colors_lst[index]]
-            ax.scatter(x, y, s=100, c=cmap(norm(steps)))
+            segments_colors = np.empty((number_of_points, number_of_steps - 1, 4))
+            colors_array = np.asarray(colors_lst)
+            for color, cmap in colors_cmaps.items():
+                segments_colors[colors_array == color] = cmap(norm(steps[:-1]))
+            segments_colors = segments_colors.reshape(-1, 4)
+
+        ax.add_collection(LineCollection(segments, colors=segments_colors, linewidths=1))
+        ax.autoscale()
+    else:
+        for index in range(number_of_points):
+            trajectory = samples_tensor[index]
+            x = to_plain_arrays(trajectory[:, 0])
+            y = to_plain_arrays(trajectory[:, 1])
+            if len(colors_lst) == 0:
+                ax.scatter(x, y, s=100, c=default_cmap(norm(steps)))
+                ax.plot(x, y)
+            else:
+                cmap = colors_cmaps[colors_lst[index]]
+                ax.scatter(x, y, s=100, c=cmap(norm(steps)))
 
     # Add colorbar
     bar_title = 'Time' if use_time else 'Steps'
@@ -377,7 +606,11 @@ def plot_points_trajectory(samples_tensor, colors_lst=[], inverse=False, use_tim
             cbar.set_label(bar_title)
 
     ax.legend()
-    plt.show()
+    show_figure(fig)
+
+# Start the figure workers now that the plot functions are defined, before any training starts
+if FIGURES_DIR is not None:
+    start_figure_workers(FIGURES_DIR, NUM_OF_FIGURE_WORKERS)
 
 """**Part1: Normalization Flow**"""
 
@@ -492,17 +725,17 @@ class NormalizationFlow(nn.Module):
 
         return y, log_inverse_jacobian_det
 
-def evaluate_nflow_model(nflow_model, val_loader):
+def evaluate_nflow_model(nflow_model, val_loader, verbose=True):
     with torch.no_grad():
         # Set model with evaluation mode
         nflow_model.eval()
 
-        # Initiate val variables
-        mean_val_epoch_log_probs = 0.
-        mean_val_epoch_log_inv_det = 0.
+        # Initiate val variables, the sums are kept on DEVICE to avoid a sync on every batch
+        sum_val_log_probs = torch.zeros((), device=DEVICE)
+        sum_val_log_inv_det = torch.zeros((), device=DEVICE)
         number_of_seen_samples = 0
 
-        for batch in tqdm(val_loader):
+        for batch in tqdm(val_loader, disable=not verbose):
             # Extract batch from device and move it to DEVIE
             batch = batch[0]
             batch = batch.to(DEVICE)
@@ -511,25 +744,23 @@ def evaluate_nflow_model(nflow_model, val_loader):
             batch_inverse, log_inverse_det = nflow_model.get_inverse_and_log_inverse_jacobian_det(batch)
 
             # Compute PDF of Normal Gaussian for each point in the batch_inverse
-            batch_size = batch.size()[0]
-            batch_log_probs = compute_gaussian_log_probs(samples_tensor=batch_inverse, mean_tensor=torch.zeros(batch_size, LATENT_DIM).to(DEVICE),
-                                              var_tensor=torch.ones(batch_size, LATENT_DIM).to(DEVICE)).unsqueeze(dim=1)
+            batch_log_probs = -0.5 * torch.sum(torch.pow(batch_inverse, 2) + np.log(2 * np.pi), dim=1)
 
-            # Compute the mean of the two loss component
-            mean_batch_log_inverse_det = -1 * log_inverse_det.mean().item()
-            mean_batch_log_probs = -1 * batch_log_probs.mean().item()
-
-            # Update epoch mean losses
-            batch_size = batch.size()[0]
-            mean_val_epoch_log_probs = (mean_val_epoch_log_probs * number_of_seen_samples + mean_batch_log_probs * batch_size) / (number_of_seen_samples + batch_size)
-            mean_val_epoch_log_inv_det = (mean_val_epoch_log_inv_det * number_of_seen_samples + mean_batch_log_inverse_det * batch_size) / (number_of_seen_samples + batch_size)
+            # Update the sums of the two loss component
+            sum_val_log_probs -= batch_log_probs.sum()
+            sum_val_log_inv_det -= log_inverse_det.sum()
 
             # Update number of seen samples
-            number_of_seen_samples += batch_size
+            number_of_seen_samples += batch.size()[0]
+
+        # Compute epoch mean losses
+        mean_val_epoch_log_probs = (sum_val_log_probs / number_of_seen_samples).item()
+        mean_val_epoch_log_inv_det = (sum_val_log_inv_det / number_of_seen_samples).item()
 
         return mean_val_epoch_log_probs, mean_val_epoch_log_inv_det
 
-def train_normalization_flow(train_loader, val_loader, num_epochs=NUM_OF_EPOCH, lr=NORM_FLOW_LR):
+def train_normalization_flow(train_loader, val_loader, num_epochs=NUM_OF_EPOCH, lr=NORM_FLOW_LR, async_validation=False, validate_every=1, validation_time_budget=None,
+                             checkpoint_manager=None):
     nflow_model = NormalizationFlow()
     nflow_model = nflow_model.to(DEVICE)
     optimizer = optim.Adam(nflow_model.parameters(), lr=lr)
@@ -538,7 +769,29 @@ def train_normalization_flow(train_loader, val_loader, num_epochs=NUM_OF_EPOCH,
     val_mean_log_probs = []
     val_mean_log_inv_dets = []
 
-    for epoch in range(num_epochs):
+    # Validation results are attached to the loss curves by epoch, epochs without validation stay None
+    def attach_validation_results(epoch, results):
+        val_mean_log_probs[epoch], val_mean_log_inv_dets[epoch] = results
+
+    # Validate in a background thread, on a snapshot of the weights, while training continues. The (epoch, future) pairs
+    # are kept so their results (and exceptions) are collected in the main thread
+    validation_executor = ThreadPoolExecutor(max_workers=1) if async_validation else None
+    pending_validations = []
+    last_validation_time = perf_counter()
+
+    # Resume from the last checkpoint if there is one
+    start_epoch = 0
+    checkpoint = checkpoint_manager.load() if checkpoint_manager is not None else None
+    if checkpoint is not None:
+        nflow_model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        val_mean_log_probs.extend(checkpoint['val_mean_log_probs'])
+        val_mean_log_inv_dets.extend(checkpoint['val_mean_log_inv_dets'])
+        restore_rng_states(checkpoint['rng_states'])
+        start_epoch = checkpoint['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs):
         # Set model with training mode
         nflow_model.train()
 
@@ -565,21 +818,110 @@ def train_normalization_flow(train_loader, val_loader, num_epochs=NUM_OF_EPOCH,
             mean_batch_loss.backward()
             optimizer.step()
 
+        # Decide whether to validate this epoch - every N epochs or once the time budget has passed
+        val_mean_log_probs.append(None)
+        val_mean_log_inv_dets.append(None)
+        if validation_time_budget is not None:
+            should_validate = perf_counter() - last_validation_time >= validation_time_budget
+        else:
+            should_validate = (epoch + 1) % validate_every == 0
+        should_validate = should_validate or epoch == num_epochs - 1
+
         # Evaluate model on the validation set
-        mean_val_epoch_log_probs, mean_val_epoch_log_inv_det = evaluate_nflow_model(nflow_model, val_loader)
-        val_mean_log_probs.append(mean_val_epoch_log_probs)
-        val_mean_log_inv_dets.append(mean_val_epoch_log_inv_det)
+        if should_validate:
+            last_validation_time = perf_counter()
+            if async_validation:
+                nflow_snapshot = copy.deepcopy(nflow_model)
+                pending_validations.append((epoch, validation_executor.submit(evaluate_nflow_model, nflow_snapshot, val_loader, False)))
+            else:
+                attach_validation_results(epoch, evaluate_nflow_model(nflow_model, val_loader))
 
         # Take step in scheduler
         scheduler.step()
 
+        # Attach the finished background validations, raising if any of them failed
+        for validation_epoch, future in [pending for pending in pending_validations if pending[1].done()]:
+            attach_validation_results(validation_epoch, future.result())
+            pending_validations.remove((validation_epoch, future))
+
+        # Save a checkpoint (validations still running in the background are saved as None)
+        if checkpoint_manager is not None:
+            checkpoint_manager.maybe_save(epoch, num_epochs, lambda: {
+                'model': nflow_model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                'val_mean_log_probs': list(val_mean_log_probs), 'val_mean_log_inv_dets': list(val_mean_log_inv_dets)})
+
+    # Wait for the background validations and checkpoint writes to finish
+    if async_validation:
+        validation_executor.shutdown(wait=True)
+        for validation_epoch, future in pending_validations:
+            attach_validation_results(validation_epoch, future.result())
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+
     # Set model with evaluation mode
     nflow_model.eval()
 
     return nflow_model, val_mean_log_probs, val_mean_log_inv_dets
 
+class ExportableNormalizationFlow(nn.Module):
+    def __init__(self, nflow_model):
+        super(ExportableNormalizationFlow, self).__init__()
+        self.nflow_model = nflow_model
+
+    def forward(self, z):
+        # Sampling - map points from the normal distribution to the data distribution
+        return self.nflow_model(z)
+
+    def inverse(self, y):
+        # Map points from the data distribution back to the normal distribution
+        z, _ = self.nflow_model.get_inverse_and_log_inverse_jacobian_det(y)
+        return z
+
+    def log_density(self, y):
+        # Fused inverse + log inverse jacobian determinant to get the log density of each point
+        z, log_inverse_jacobian_det = self.nflow_model.get_inverse_and_log_inverse_jacobian_det(y)
+        log_probs = -0.5 * torch.sum(torch.pow(z, 2) + np.log(2 * np.pi), dim=1, keepdim=True)
+        return log_probs + log_inverse_jacobian_det
+
+class ExportedEntryPoint(nn.Module):
+    # Expose a single entry point of ExportableNormalizationFlow as forward (required by ONNX)
+    def __init__(self, exportable_nflow, entry_point):
+        super(ExportedEntryPoint, self).__init__()
+        self.exportable_nflow = exportable_nflow
+        self.entry_point = entry_point
+
+    def forward(self, x):
+        return getattr(self.exportable_nflow, self.entry_point)(x)
+
+def export_normalization_flow(nflow_model, export_dir=NFLOW_EXPORT_DIR, export_onnx=False):
+    os.makedirs(export_dir, exist_ok=True)
+
+    # Export a CPU copy of the model, the layers have no data dependent control flow so tracing is exact
+    exportable_nflow = ExportableNormalizationFlow(copy.deepcopy(nflow_model).to('cpu').eval()).eval()
+    example_points = torch.randn(16, LATENT_DIM)
+    with torch.no_grad():
+        traced_nflow = torch.jit.trace_module(exportable_nflow, {'forward': example_points, 'inverse': example_points, 'log_density': example_points})
+        frozen_nflow = torch.jit.freeze(traced_nflow, preserved_attrs=['inverse', 'log_density'])
+
+    # Save a TorchScript module - it can be loaded with torch.jit.load without the training code
+    torchscript_path = os.path.join(export_dir, 'nflow.pt')
+    torch.jit.save(frozen_nflow, torchscript_path)
+    export_paths = {'torchscript': torchscript_path}
+
+    # ONNX graphs have a single entry point, so save one graph for each
+    if export_onnx:
+        for entry_point in ['forward', 'inverse', 'log_density']:
+            onnx_path = os.path.join(export_dir, f'nflow_{entry_point}.onnx')
+            torch.onnx.export(ExportedEntryPoint(exportable_nflow, entry_point), example_points, onnx_path,
+                              input_names=['points'], output_names=['outputs'],
+                              dynamic_axes={'points': {0: 'batch_size'}, 'outputs': {0: 'batch_size'}})
+            export_paths[f'onnx_{entry_point}'] = onnx_path
+
+    return export_paths
+
 train_loader, val_loader = create_unconditional_dataloaders(split=0.96, batch_size=256)
-nflow_model, val_mean_log_probs, val_mean_log_inv_dets = train_normalization_flow(train_loader=train_loader, val_loader=val_loader)
+nflow_model, val_mean_log_probs, val_mean_log_inv_dets = train_normalization_flow(train_loader=train_loader, val_loader=val_loader,
+                                                                                  checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'nflow.pt')))
 
 # Question 1
 plot_nflow_losses(val_mean_log_probs, val_mean_log_inv_dets)
@@ -595,7 +937,7 @@ for seed in seeds:
     samples_list.append(new_points)
     title_list.append(f"Seed {seed}")
 
-plot_2d_samples(samples_list, title_list)
+plot_2d_samples(samples_list, title_list, rasterize=True)
 
 # Question 3
 torch.manual_seed(SEED)
@@ -611,7 +953,7 @@ for index in range(len(nflow_model.layers)):
             samples_list.append(samples)
             title_list.append(f"Time step {int(index/2) + 1}")
 
-plot_2d_samples(samples_list, title_list)
+plot_2d_samples(samples_list, title_list, rasterize=True)
 
 # Question 4
 torch.manual_seed(SEED)
@@ -625,7 +967,7 @@ for layer in nflow_model.layers:
 
 
 samples_tensor = samples_tensor.transpose(0, 1)
-plot_points_trajectory(samples_tensor)
+plot_points_trajectory(samples_tensor, rasterize=True)
 
 # Question 5
 # Sample 3 point from the target distrebution and 2 outside the target distribution
@@ -705,7 +1047,113 @@ class UnconditionalVF(nn.Module):
         output = self.compute_derivative(inputs)
         return output
 
-def train_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_LR):
+def integrate_VF_segment(vf_model, samples, start_time, end_time, num_of_steps, classes=None):
+    # Integrate the vector field from start_time to end_time using Euler method
+    delta_t = (end_time - start_time) / num_of_steps
+    with torch.no_grad():
+        for time in np.linspace(start_time, end_time - delta_t, num_of_steps):
+            time_vec = torch.full((samples.size(0), 1), time, device=samples.device)
+            if classes is None:
+                derivatives = vf_model(samples, time_vec)
+            else:
+                derivatives = vf_model(samples, classes, time_vec)
+            samples = samples + derivatives * delta_t
+
+    return samples
+
+def sample_VF_with_euler(vf_model, samples, num_of_steps, classes=None):
+    # Integrate the vector field from time 0 to time 1 using Euler method
+    return integrate_VF_segment(vf_model, samples, 0., 1., num_of_steps, classes)
+
+# State of each Parareal worker process, set once by the pool initializer
+parareal_worker_state = {}
+
+def init_parareal_worker(vf_model):
+    # Each worker runs a single thread so the fine solves don't compete for cores
+    torch.set_num_threads(1)
+    parareal_worker_state['vf_model'] = vf_model
+
+def parareal_fine_solve(samples, classes, start_time, end_time, num_of_steps):
+    return integrate_VF_segment(parareal_worker_state['vf_model'], samples, start_time, end_time, num_of_steps, classes)
+
+def create_parareal_pool(vf_model, num_of_workers=None):
+    # Create the fine solves workers once per model, so repeated sampling doesn't pay the pool startup.
+    # Workers are forked so they inherit the model without re-running the script
+    num_of_workers = os.cpu_count() if num_of_workers is None else num_of_workers
+    vf_model = copy.deepcopy(vf_model).to('cpu').eval()
+    pool = ProcessPoolExecutor(max_workers=num_of_workers, mp_context=multiprocessing.get_context('fork'),
+                               initializer=init_parareal_worker, initargs=(vf_model, ))
+    # Start the workers now instead of on the first solve
+    for future in [pool.submit(torch.get_num_threads) for _ in range(num_of_workers)]:
+        future.result()
+
+    # Keep the CPU copy of the model (used by the coarse solves) and its weights hash, so the sampling can check
+    # that the workers hold the weights of the model it was given
+    pool.vf_model = vf_model
+    pool.weights_hash = hash_model_weights(vf_model)
+    return pool
+
+def parareal_sample_VF(vf_model, samples, classes=None, num_of_steps=1000, num_of_segments=PARAREAL_NUM_OF_SEGMENTS, coarse_steps_per_segment=1,
+                       tolerance=PARAREAL_TOLERANCE, max_iterations=None, num_of_workers=None, pool=None):
+    # Validate parameters
+    assert(num_of_steps % num_of_segments == 0), "Number of steps must be divisible by the number of segments"
+    assert(max_iterations is None or max_iterations >= 1), "Max iterations must be at least 1"
+    max_iterations = num_of_segments if max_iterations is None else min(max_iterations, num_of_segments)
+
+    # Use the given pool (created by create_parareal_pool for the same weights), or create one for this call
+    owns_pool = pool is None
+    if owns_pool:
+        pool = create_parareal_pool(vf_model, min(num_of_segments, os.cpu_count()) if num_of_workers is None else num_of_workers)
+    else:
+        assert(pool.weights_hash == hash_model_weights(vf_model)), "The pool's workers hold different weights, create a new pool for this model"
+
+    # Fine solves run on CPU worker processes, so the coarse solves use the pool's CPU copy of the model and the samples move to the CPU
+    samples_device = samples.device
+    vf_model = pool.vf_model
+    samples = samples.to('cpu')
+    classes = classes.to('cpu') if classes is not None else None
+
+    # Split [0, 1] into segments
+    boundaries = np.linspace(0, 1, num_of_segments + 1)
+    fine_steps_per_segment = num_of_steps // num_of_segments
+
+    def coarse_solve(segment_samples, segment):
+        return integrate_VF_segment(vf_model, segment_samples, boundaries[segment], boundaries[segment + 1], coarse_steps_per_segment, classes)
+
+    # Predict the segments boundaries using the coarse solver
+    boundary_samples = [samples]
+    coarse_predictions = []
+    for segment in range(num_of_segments):
+        coarse_predictions.append(coarse_solve(boundary_samples[segment], segment))
+        boundary_samples.append(coarse_predictions[segment])
+
+    try:
+        for iteration in range(max_iterations):
+            # After each iteration one more segment is exact, so only solve the segments after it
+            futures = [pool.submit(parareal_fine_solve, boundary_samples[segment], classes, boundaries[segment], boundaries[segment + 1], fine_steps_per_segment)
+                       for segment in range(iteration, num_of_segments)]
+            fine_solutions = [future.result() for future in futures]
+
+            # Apply the Parareal correction sequentially over the segments
+            new_boundary_samples = boundary_samples[:iteration + 1]
+            for segment in range(iteration, num_of_segments):
+                new_coarse_prediction = coarse_solve(new_boundary_samples[segment], segment)
+                new_boundary_samples.append(new_coarse_prediction + fine_solutions[segment - iteration] - coarse_predictions[segment])
+                coarse_predictions[segment] = new_coarse_prediction
+
+            # Stop when the boundaries have converged
+            max_change = max(torch.max(torch.abs(new - old)).item() for new, old in zip(new_boundary_samples, boundary_samples))
+            boundary_samples = new_boundary_samples
+            if max_change < tolerance:
+                break
+    finally:
+        if owns_pool:
+            pool.shutdown()
+
+    return boundary_samples[-1].to(samples_device), iteration + 1
+
+def train_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_LR, use_ot_coupling=False, time_sampling='iid', noise_sampling='iid', loss_curve=None,
+                           checkpoint_manager=None):
     # Initiate Unconditional Vector Field model and move its parameters to DEVICE
     uncon_vf = UnconditionalVF(latent_dim=LATENT_DIM)
     uncon_vf = uncon_vf.to(DEVICE)
@@ -714,8 +1162,26 @@ def train_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_
     optimizer = optim.Adam(uncon_vf.parameters(), lr=lr)
     scheduler = CosineAnnealingLR(optimizer, T_max=num_epochs)
 
+    # Create the noise sampler and start the wall-clock for the loss curve
+    sample_noise = create_noise_sampler(noise_sampling)
+    start_time = perf_counter()
+
     epoch_mean_losses = []
-    for epoch in range(num_epochs):
+
+    # Resume from the last checkpoint if there is one
+    start_epoch = 0
+    checkpoint = checkpoint_manager.load() if checkpoint_manager is not None else None
+    if checkpoint is not None:
+        uncon_vf.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        epoch_mean_losses.extend(checkpoint['epoch_mean_losses'])
+        if hasattr(sample_noise, 'sobol_engine'):
+            sample_noise.sobol_engine.fast_forward(checkpoint['noise_num_generated'])
+        restore_rng_states(checkpoint['rng_states'])
+        start_epoch = checkpoint['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs):
         # Set model with training mode
         uncon_vf.train()
         # Initiate variables
@@ -730,10 +1196,14 @@ def train_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_
             batch_size = batch.size()[0]
 
             # Sample corresponding vectors from standard Gaussian distribution
-            noised_samples = mvn_dist.sample((batch_size,)).to(DEVICE)
+            noised_samples = sample_noise(batch_size)
+
+            # Re-pair noise samples and batch points using minibatch optimal transport
+            if use_ot_coupling:
+                noised_samples = compute_ot_coupling(batch, noised_samples)
 
             # Sample time from Uniform distribution of 0 to 1
-            time = uniform_dist.sample((batch_size,)).unsqueeze(dim=1).to(DEVICE)
+            time = sample_flow_matching_time(batch_size, time_sampling)
 
             # Compute noised vectors at time t according to optimal path with
             # respect to each point in the batch
@@ -761,14 +1231,165 @@ def train_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_
 
         # Update the epoch losses list and take a step in the scheduler
         epoch_mean_losses.append(mean_epoch_loss)
+        if loss_curve is not None:
+            loss_curve.append((perf_counter() - start_time, mean_epoch_loss))
         scheduler.step()
 
+        # Save a checkpoint
+        if checkpoint_manager is not None:
+            checkpoint_manager.maybe_save(epoch, num_epochs, lambda: {
+                'model': uncon_vf.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                'epoch_mean_losses': list(epoch_mean_losses),
+                'noise_num_generated': sample_noise.sobol_engine.num_generated if hasattr(sample_noise, 'sobol_engine') else 0})
+
+    # Wait for the checkpoint writes to finish
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+
     # Move model's mode to evaluation
     uncon_vf.eval()
     return uncon_vf, epoch_mean_losses
 
+def generate_reflow_couplings(vf_model, num_of_pairs=REFLOW_NUM_OF_PAIRS, num_of_steps=1000, batch_size=10000, cache_path=None):
+    # The cache is keyed by the model weights and the generation parameters, so a retrained model or
+    # different parameters never reuse stale couplings
+    cache_metadata = {'weights_hash': hash_model_weights(vf_model), 'num_of_pairs': num_of_pairs, 'num_of_steps': num_of_steps}
+    if cache_path is not None:
+        cache_key = hashlib.sha256(json.dumps(cache_metadata, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        cache_root, cache_extension = os.path.splitext(cache_path)
+        cache_path = f"{cache_root}_{cache_key}{cache_extension}"
+
+    # Load the couplings from the cache if they were already generated with the same model and parameters
+    if cache_path is not None and os.path.exists(cache_path):
+        couplings = torch.load(cache_path)
+        if all(couplings.get(key) == value for key, value in cache_metadata.items()):
+            return couplings['noise'].to(DEVICE), couplings['endpoints'].to(DEVICE)
+
+    # Push noise samples through the model's flow to get their endpoints at time 1
+    noise_lst = []
+    endpoints_lst = []
+    for start in tqdm(range(0, num_of_pairs, batch_size)):
+        noise = mvn_dist.sample((min(batch_size, num_of_pairs - start), )).to(DEVICE)
+        endpoints = sample_VF_with_euler(vf_model, noise, num_of_steps)
+        noise_lst.append(noise)
+        endpoints_lst.append(endpoints)
+
+    noise = torch.cat(noise_lst, dim=0)
+    endpoints = torch.cat(endpoints_lst, dim=0)
+
+    # Save the couplings to the cache
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        torch.save({'noise': noise.cpu(), 'endpoints': endpoints.cpu(), **cache_metadata}, cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+
+    return noise, endpoints
+
+def train_reflow_VF(noise, endpoints, init_vf=None, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_LR, batch_size=BATCH_SIZE, one_step=False):
+    # Initiate the new vector field from the given model (if any) and move its parameters to DEVICE
+    if init_vf is not None:
+        reflow_vf = copy.deepcopy(init_vf)
+    else:
+        reflow_vf = UnconditionalVF(latent_dim=LATENT_DIM)
+    reflow_vf = reflow_vf.to(DEVICE)
+
+    # Create a dataloader over the fixed (noise, endpoint) couplings
+    couplings_loader = DataLoader(TensorDataset(noise, endpoints), batch_size=batch_size, shuffle=True)
+
+    # Initiate ADAM optimizer and Cosine scheduler
+    optimizer = optim.Adam(reflow_vf.parameters(), lr=lr)
+    scheduler = CosineAnnealingLR(optimizer, T_max=num_epochs)
+
+    epoch_mean_losses = []
+    for epoch in range(num_epochs):
+        # Set model with training mode
+        reflow_vf.train()
+        # Initiate variables
+        mean_epoch_loss = 0.
+        number_of_seen_samples = 0
+
+        for noised_samples, batch in tqdm(couplings_loader):
+            batch_size = batch.size()[0]
+
+            # A one step student is always evaluated at time 0, otherwise sample time uniformly
+            if one_step:
+                time = torch.zeros(batch_size, 1, device=DEVICE)
+            else:
+                time = uniform_dist.sample((batch_size,)).unsqueeze(dim=1).to(DEVICE)
+
+            # Compute noised vectors at time t along the straight path of each coupling
+            y_batch = (1 - time) * noised_samples + time * batch
+
+            # Zero the parameter gradients
+            optimizer.zero_grad()
+
+            # Compute the loss with respect to the straight line derivatives
+            uncon_der_batch = reflow_vf(y_batch, time)
+            con_der_batch = batch - noised_samples
+            batch_losses = torch.sum(torch.pow(uncon_der_batch - con_der_batch, 2), dim=1, keepdim=True)
+            mean_batch_loss = batch_losses.mean()
+
+            # Backpropargate and update the model's wights
+            mean_batch_loss.backward()
+            optimizer.step()
+
+            # Update variables
+            with torch.no_grad():
+                mean_epoch_loss = (mean_epoch_loss * number_of_seen_samples + mean_batch_loss.item() * batch_size) / (number_of_seen_samples + batch_size)
+                number_of_seen_samples += batch_size
+
+        # Update the epoch losses list and take a step in the scheduler
+        epoch_mean_losses.append(mean_epoch_loss)
+        scheduler.step()
+
+    # Move model's mode to evaluation
+    reflow_vf.eval()
+    return reflow_vf, epoch_mean_losses
+
+def distill_unconditional_VF(teacher_vf, num_of_pairs=REFLOW_NUM_OF_PAIRS, cache_path=REFLOW_CACHE_PATH, num_epochs=NUM_OF_EPOCH, train_student=True):
+    # Stage 1: Generate (noise, endpoint) couplings using the 1000 steps teacher
+    noise, endpoints = generate_reflow_couplings(teacher_vf, num_of_pairs=num_of_pairs, cache_path=cache_path)
+
+    # Stage 2: Retrain a vector field on the straightened couplings (reflow)
+    reflow_vf, _ = train_reflow_VF(noise, endpoints, init_vf=teacher_vf, num_epochs=num_epochs)
+    stages = {'reflow': reflow_vf}
+
+    # Stage 3: Distill the reflow model into a one step student
+    if train_student:
+        student_noise, student_endpoints = generate_reflow_couplings(reflow_vf, num_of_pairs=num_of_pairs, num_of_steps=100)
+        student_vf, _ = train_reflow_VF(student_noise, student_endpoints, init_vf=reflow_vf, num_epochs=num_epochs, one_step=True)
+        stages['one_step_student'] = student_vf
+
+    return stages
+
+def report_distillation_stages(teacher_vf, stages, steps_list=[1, 2, 4, 8], num_of_samples=10000):
+    # Sample the 1000 steps teacher as reference
+    noise = mvn_dist.sample((num_of_samples, )).to(DEVICE)
+    start_time = perf_counter()
+    teacher_samples = sample_VF_with_euler(teacher_vf, noise, 1000)
+    teacher_time = perf_counter() - start_time
+
+    print(f"\nTeacher (1000 steps): {teacher_time:.3f} sec for {num_of_samples} samples")
+    print(f"\t{'Stage':<18} {'Steps':>6} {'Time (sec)':>11} {'Speedup':>8} {'Sliced W2':>10} {'Coupling L2':>12}")
+
+    # Compare each stage to the teacher using the same noise
+    results = []
+    for name, vf_model in [('teacher', teacher_vf)] + list(stages.items()):
+        # The one step student is only trained at time 0, so only its single step sampling is meaningful
+        for num_of_steps in ([1] if name == 'one_step_student' else steps_list):
+            start_time = perf_counter()
+            samples = sample_VF_with_euler(vf_model, noise, num_of_steps)
+            stage_time = perf_counter() - start_time
+
+            distribution_error = compute_sliced_wasserstein_distance(samples, teacher_samples)
+            coupling_error = torch.norm(samples - teacher_samples, dim=1).mean().item()
+            results.append((name, num_of_steps, stage_time, teacher_time / stage_time, distribution_error, coupling_error))
+            print(f"\t{name:<18} {num_of_steps:>6} {stage_time:>11.4f} {teacher_time / stage_time:>8.1f} {distribution_error:>10.4f} {coupling_error:>12.4f}")
+
+    return results
+
 train_loader, _ = create_unconditional_dataloaders(split=1, verbose=True)
-uncon_vf, epoch_mean_losses = train_unconditional_VF(train_loader=train_loader)
+uncon_vf, epoch_mean_losses = train_unconditional_VF(train_loader=train_loader, checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'unconditional_vf.pt')))
 
 # Question 1
 plot_match_flow_losses(torch.tensor(epoch_mean_losses))
@@ -788,7 +1409,7 @@ for time in np.linspace(0, 1 - MATCH_FLOW_DELTA_T, 1000):
         samples_list.append(samples)
         title_list.append(f"Time {new_time}")
 
-plot_2d_samples(samples_list, title_list)
+plot_2d_samples(samples_list, title_list, rasterize=True)
 
 # Question 3
 num_of_samples = 10
@@ -801,7 +1422,7 @@ for time in np.linspace(0, 1 - MATCH_FLOW_DELTA_T, 1000):
     samples_tensor = torch.cat([samples_tensor, samples.unsqueeze(0)], dim=0)
 
 samples_tensor = samples_tensor.transpose(0, 1)
-plot_points_trajectory(samples_tensor, use_time=True)
+plot_points_trajectory(samples_tensor, use_time=True, rasterize=True)
 
 # Question 4
 num_of_samples = 1000
@@ -819,7 +1440,7 @@ for sigma_t in sigma_t_list:
     samples_at_time_1.append(samples)
     title_list.append(f"Smples at time 1 with delta time of: {sigma_t}")
 
-plot_2d_samples(samples_at_time_1, title_list)
+plot_2d_samples(samples_at_time_1, title_list, rasterize=True)
 
 # Compute the inverse trajectory of the selected points - Flow Matching
 inside_points = inside_points_org
@@ -866,6 +1487,11 @@ class EmbeddedUnconditionalVF(nn.Module):
             nn.Linear(64, latent_dim)
         )
 
+        # Folded first layer, computed lazily by fold_embedding and not saved in the state dict
+        self.register_buffer('folded_weight', None, persistent=False)
+        self.register_buffer('class_bias_table', None, persistent=False)
+        self.folded_weights_version = None
+
     def forward(self, y, c, t):
         # Compute embedding of class tensor
         embedded_vec = self.embedding(c)
@@ -877,7 +1503,64 @@ class EmbeddedUnconditionalVF(nn.Module):
         output = self.compute_derivative(inputs)
         return output
 
-def train_embedded_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_LR):
+    def weights_version(self):
+        # In-place updates (optimizer steps, load_state_dict) bump the parameters versions and moving the
+        # model changes their storage, so together they identify the weights the folding was computed from
+        first_layer = self.compute_derivative[0]
+        return tuple((param.data_ptr(), param._version) for param in (self.embedding.weight, first_layer.weight, first_layer.bias))
+
+    def fold_embedding(self):
+        # Reuse the folded first layer as long as its weights haven't changed
+        weights_version = self.weights_version()
+        if self.class_bias_table is not None and self.folded_weights_version == weights_version:
+            return self.class_bias_table
+
+        # The class part of the first layer's input is constant along the whole flow, so precompute
+        # each class's contribution to the first layer (together with its bias) as a bias table
+        first_layer = self.compute_derivative[0]
+        latent_dim = first_layer.in_features - self.embedding.embedding_dim - 1
+        self.folded_weights_version = weights_version
+        with torch.no_grad():
+            embedding_weight = first_layer.weight[:, latent_dim:-1]
+            self.class_bias_table = self.embedding.weight @ embedding_weight.T + first_layer.bias
+
+            # Keep only the weights of the prior samples and the time inputs
+            self.folded_weight = torch.cat([first_layer.weight[:, :latent_dim], first_layer.weight[:, -1:]], dim=1).T.contiguous()
+
+        return self.class_bias_table
+
+    def folded_forward(self, y, class_bias, t):
+        # Compute the first layer as a matmul of the prior samples and time plus the gathered class biases
+        hidden = torch.addmm(class_bias, torch.cat([y, t], dim=1), self.folded_weight)
+
+        # Pass to the rest of the neural network and return predicted derivatives
+        output = self.compute_derivative[1:](hidden)
+        return output
+
+def sample_conditional_VF_folded(emb_vf, samples, classes, num_of_steps=1000):
+    # Get the per class bias table of the first layer (folded again only if the weights changed)
+    class_bias_table = emb_vf.fold_embedding()
+
+    # Group the points by class so each class runs as a contiguous block
+    sorted_classes, order = torch.sort(classes, stable=True)
+    samples = samples[order]
+    class_bias = class_bias_table[sorted_classes]
+
+    # Integrate the vector field from time 0 to time 1 using Euler method
+    delta_t = 1 / num_of_steps
+    with torch.no_grad():
+        for time in np.linspace(0, 1 - delta_t, num_of_steps):
+            time_vec = torch.full((samples.size(0), 1), time, device=samples.device)
+            samples = samples + emb_vf.folded_forward(samples, class_bias, time_vec) * delta_t
+
+    # Restore the original order of the points
+    unsorted_samples = torch.empty_like(samples)
+    unsorted_samples[order] = samples
+
+    return unsorted_samples
+
+def train_embedded_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MATCH_FLOW_LR, use_ot_coupling=False, time_sampling='iid', noise_sampling='iid', loss_curve=None,
+                                    checkpoint_manager=None):
     # Initiate Unconditional Vector Field model and move its parameters to DEVICE
     emb_uncon_vf = EmbeddedUnconditionalVF(latent_dim=LATENT_DIM, num_of_class=NUM_OF_CLASSES, embedding_dim=EMBEDDING_DIM)
     emb_uncon_vf = emb_uncon_vf.to(DEVICE)
@@ -886,8 +1569,26 @@ def train_embedded_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MA
     optimizer = optim.Adam(emb_uncon_vf.parameters(), lr=lr)
     scheduler = CosineAnnealingLR(optimizer, T_max=num_epochs)
 
+    # Create the noise sampler and start the wall-clock for the loss curve
+    sample_noise = create_noise_sampler(noise_sampling)
+    start_time = perf_counter()
+
     epoch_mean_losses = []
-    for epoch in range(num_epochs):
+
+    # Resume from the last checkpoint if there is one
+    start_epoch = 0
+    checkpoint = checkpoint_manager.load() if checkpoint_manager is not None else None
+    if checkpoint is not None:
+        emb_uncon_vf.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        epoch_mean_losses.extend(checkpoint['epoch_mean_losses'])
+        if hasattr(sample_noise, 'sobol_engine'):
+            sample_noise.sobol_engine.fast_forward(checkpoint['noise_num_generated'])
+        restore_rng_states(checkpoint['rng_states'])
+        start_epoch = checkpoint['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs):
         # Set model with training mode
         emb_uncon_vf.train()
         # Initiate variables
@@ -904,10 +1605,14 @@ def train_embedded_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MA
             batch_size = batch_sample.size()[0]
 
             # Sample corresponding vectors from standard Gaussian distribution
-            noised_samples = mvn_dist.sample((batch_size,)).to(DEVICE)
+            noised_samples = sample_noise(batch_size)
+
+            # Re-pair noise samples and batch points of the same class using minibatch optimal transport
+            if use_ot_coupling:
+                noised_samples = compute_class_ot_coupling(batch_sample, batch_class, noised_samples)
 
             # Sample time from Uniform distribution of 0 to 1
-            time = uniform_dist.sample((batch_size,)).unsqueeze(dim=1).to(DEVICE)
+            time = sample_flow_matching_time(batch_size, time_sampling)
 
             # Compute noised vectors at time t according to optimal path with
             # respect to each point in the batch
@@ -935,15 +1640,29 @@ def train_embedded_unconditional_VF(train_loader, num_epochs=NUM_OF_EPOCH, lr=MA
 
         # Update the epoch losses list and take a step in the scheduler
         epoch_mean_losses.append(mean_epoch_loss)
+        if loss_curve is not None:
+            loss_curve.append((perf_counter() - start_time, mean_epoch_loss))
         scheduler.step()
 
+        # Save a checkpoint
+        if checkpoint_manager is not None:
+            checkpoint_manager.maybe_save(epoch, num_epochs, lambda: {
+                'model': emb_uncon_vf.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                'epoch_mean_losses': list(epoch_mean_losses),
+                'noise_num_generated': sample_noise.sobol_engine.num_generated if hasattr(sample_noise, 'sobol_engine') else 0})
+
+    # Wait for the checkpoint writes to finish
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+
     # Move model's mode to evaluation
     emb_uncon_vf.eval()
     return emb_uncon_vf, epoch_mean_losses
 
 # Question 1 + Train the model
 train_loader, _, int_to_label = create_conditional_dataloaders(split=1, verbose=True)
-emb_uncon_vf, epoch_mean_losses = train_embedded_unconditional_VF(train_loader=train_loader)
+emb_uncon_vf, epoch_mean_losses = train_embedded_unconditional_VF(train_loader=train_loader,
+                                                                  checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'embedded_unconditional_vf.pt')))
 
 # Plot Losses (Not asked)
 plot_match_flow_losses(torch.tensor(epoch_mean_losses))
@@ -962,7 +1681,7 @@ for time in np.linspace(0, 1 - MATCH_FLOW_DELTA_T, 1000):
 
 samples_tensor = samples_tensor.transpose(0, 1)
 colors = [int_to_label[c] for c in colors_indices]
-plot_points_trajectory(samples_tensor, colors_lst=colors, use_time=True)
+plot_points_trajectory(samples_tensor, colors_lst=colors, use_time=True, rasterize=True)
 
 # Question 3
 num_of_samples = 3000
@@ -970,12 +1689,239 @@ samples = mvn_dist.sample((num_of_samples, )).to(DEVICE)
 classes = torch.from_numpy(np.random.choice(list(int_to_label.keys()), size=num_of_samples)).to(DEVICE)
 color_name_map = {'blue': 'b', 'black': 'k', 'red': 'r', 'yellow': 'y', 'green': 'g'}
 
-
-for time in np.linspace(0, 1 - MATCH_FLOW_DELTA_T, 1000):
-    time_vec = time * torch.ones(num_of_samples, 1).to(DEVICE)
-    samples = samples + emb_uncon_vf(samples, classes, time_vec) * MATCH_FLOW_DELTA_T
+# Use the embedding-folded inference path, the class embeddings are constant along the flow
+samples = sample_conditional_VF_folded(emb_uncon_vf, samples, classes, num_of_steps=int(1 / MATCH_FLOW_DELTA_T))
 
 samples_list = [samples]
 colors = [color_name_map[int_to_label[c]] for c in classes.tolist()]
 title_list = ["Plot of 3000 points at time 1"]
-plot_2d_samples(samples_list, title_list, colors)
\ No newline at end of file
+plot_2d_samples(samples_list, title_list, colors, rasterize=True)
+
+"""**Benchmarks**
+
+Optional benchmarks, enabled by setting RUN_BENCHMARKS to True.
+"""
+
+def benchmark_ot_coupling(steps_list=[1, 2, 4, 8, 16, 32, 100, 1000], num_of_samples=3000, num_epochs=NUM_OF_EPOCH):
+    # Create fresh reference data for scoring samples
+    reference_points = torch.from_numpy(create_unconditional_olympic_rings(n_points=num_of_samples, verbose=False).astype(np.float32)).to(DEVICE)
+    train_loader, _ = create_unconditional_dataloaders(split=1)
+
+    # Train one model with independent pairing and one with minibatch OT pairing
+    vf_models = {}
+    for use_ot_coupling in [False, True]:
+        torch.manual_seed(SEED)
+        vf_models[use_ot_coupling], _ = train_unconditional_VF(train_loader=train_loader, num_epochs=num_epochs, use_ot_coupling=use_ot_coupling)
+
+    # Score the samples of each model as a function of the number of Euler steps
+    print("\nSliced Wasserstein distance to the data as a function of the number of sampling steps:")
+    print(f"\t{'Steps':>6} {'Independent':>12} {'OT coupling':>12}")
+    for num_of_steps in steps_list:
+        distances = []
+        for use_ot_coupling in [False, True]:
+            torch.manual_seed(SEED)
+            samples = mvn_dist.sample((num_of_samples, )).to(DEVICE)
+            samples = sample_VF_with_euler(vf_models[use_ot_coupling], samples, num_of_steps)
+            distances.append(compute_sliced_wasserstein_distance(samples, reference_points))
+        print(f"\t{num_of_steps:>6} {distances[0]:>12.4f} {distances[1]:>12.4f}")
+
+    return vf_models
+
+def benchmark_parareal_sampling(vf_model, num_of_classes=None, num_of_samples=3000, num_of_steps=1000, segments_list=[4, 8, 16], error_target=1e-3):
+    torch.manual_seed(SEED)
+    samples = mvn_dist.sample((num_of_samples, )).to('cpu')
+    classes = torch.randint(0, num_of_classes, (num_of_samples, )) if num_of_classes is not None else None
+    cpu_vf_model = copy.deepcopy(vf_model).to('cpu').eval()
+
+    # Serial Euler baseline on the CPU
+    start_time = perf_counter()
+    serial_samples = sample_VF_with_euler(cpu_vf_model, samples, num_of_steps, classes)
+    serial_time = perf_counter() - start_time
+
+    print(f"\nSerial Euler ({num_of_steps} steps): {serial_time:.3f} sec, error target: {error_target:.1e}")
+    print(f"\t{'Segments':>8} {'Iterations':>10} {'Time (sec)':>11} {'Speedup':>8} {'Max error':>10}")
+
+    # The workers are started once, outside the timings
+    pool = create_parareal_pool(cpu_vf_model)
+
+    # For each number of segments, find the fewest Parareal iterations reaching the error target against the
+    # serial Euler solution, and time sampling with that number of iterations
+    results = []
+    try:
+        for num_of_segments in segments_list:
+            for num_of_iterations in range(1, num_of_segments + 1):
+                start_time = perf_counter()
+                parareal_samples, _ = parareal_sample_VF(cpu_vf_model, samples, classes, num_of_steps=num_of_steps, num_of_segments=num_of_segments,
+                                                         tolerance=0., max_iterations=num_of_iterations, pool=pool)
+                parareal_time = perf_counter() - start_time
+                max_error = torch.max(torch.abs(parareal_samples - serial_samples)).item()
+                if max_error <= error_target:
+                    break
+
+            results.append((num_of_segments, num_of_iterations, parareal_time, serial_time / parareal_time, max_error))
+            print(f"\t{num_of_segments:>8} {num_of_iterations:>10} {parareal_time:>11.4f} {serial_time / parareal_time:>8.2f} {max_error:>10.2e}")
+    finally:
+        pool.shutdown()
+
+    return results
+
+def time_sampler(sample_fn, batch_size, num_of_steps, num_of_repeats=3):
+    # Warm up and then take the median latency over the repeats
+    sample_fn(batch_size, num_of_steps)
+    latencies = []
+    for _ in range(num_of_repeats):
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = perf_counter()
+        sample_fn(batch_size, num_of_steps)
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        latencies.append(perf_counter() - start_time)
+
+    return float(np.median(latencies))
+
+def run_generative_benchmark_suite(nflow_model, uncon_vf, emb_uncon_vf, report_path=BENCHMARK_REPORT_PATH, batch_sizes=[1, 100, 1000, 10000],
+                                   steps_list=[10, 100, 1000], quality_num_of_samples=10000):
+    # Define the samplers - each one gets a batch size and a number of steps (ignored by the normalization flow)
+    def sample_nflow(batch_size, num_of_steps):
+        with torch.no_grad():
+            return nflow_model(mvn_dist.sample((batch_size, )).to(DEVICE))
+
+    def sample_uncon_vf(batch_size, num_of_steps):
+        return sample_VF_with_euler(uncon_vf, mvn_dist.sample((batch_size, )).to(DEVICE), num_of_steps)
+
+    def sample_emb_uncon_vf(batch_size, num_of_steps):
+        classes = torch.randint(0, NUM_OF_CLASSES, (batch_size, ), device=DEVICE)
+        return sample_conditional_VF_folded(emb_uncon_vf, mvn_dist.sample((batch_size, )).to(DEVICE), classes, num_of_steps)
+
+    samplers = {
+        'NormalizationFlow': (sample_nflow, [len(nflow_model.layers)], False),
+        'UnconditionalVF': (sample_uncon_vf, steps_list, False),
+        'EmbeddedUnconditionalVF': (sample_emb_uncon_vf, steps_list, True),
+    }
+
+    # Sample fresh reference data for scoring the samples
+    references = {conditional: sample_reference_rings(quality_num_of_samples, conditional) for conditional in [False, True]}
+
+    report = {'device': str(DEVICE), 'seed': SEED, 'samplers': {}}
+    for name, (sample_fn, sampler_steps_list, conditional) in samplers.items():
+        print(f"\nBenchmarking {name}")
+        reference_points, normalization_mean, normalization_std = references[conditional]
+        sampler_report = {'timings': [], 'quality': []}
+
+        # Measure latency and throughput
+        for num_of_steps in sampler_steps_list:
+            for batch_size in batch_sizes:
+                latency = time_sampler(sample_fn, batch_size, num_of_steps)
+                sampler_report['timings'].append({'batch_size': batch_size, 'num_of_steps': num_of_steps,
+                                                  'latency_sec': latency, 'samples_per_sec': batch_size / latency})
+                print(f"\tSteps {num_of_steps:>5}, batch {batch_size:>6}: {latency:.4f} sec, {batch_size / latency:.1f} samples/sec")
+
+        # Score samples quality against the fresh reference data
+        for num_of_steps in sampler_steps_list:
+            torch.manual_seed(SEED)
+            samples = sample_fn(quality_num_of_samples, num_of_steps)
+            quality = {'num_of_steps': num_of_steps,
+                       'sliced_wasserstein': compute_sliced_wasserstein_distance(samples, reference_points),
+                       'energy_distance': compute_energy_distance(samples, reference_points),
+                       'fraction_inside_rings': compute_fraction_inside_rings(samples, normalization_mean, normalization_std)}
+            sampler_report['quality'].append(quality)
+            print(f"\tSteps {num_of_steps:>5}: SW {quality['sliced_wasserstein']:.4f}, energy {quality['energy_distance']:.4f}, "
+                  f"inside rings {quality['fraction_inside_rings']:.3f}")
+
+        report['samplers'][name] = sampler_report
+
+    # Write a diffable JSON report
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+    return report
+
+def evaluate_uncon_VF_loss(vf_model, val_loader, seed=SEED):
+    # Compute the flow matching loss on held-out data with a fixed i.i.d. time and noise draw
+    torch.manual_seed(seed)
+    sum_of_losses = 0.
+    number_of_seen_samples = 0
+    with torch.no_grad():
+        for batch in val_loader:
+            batch = batch[0].to(DEVICE)
+            noised_samples = mvn_dist.sample((batch.size(0),)).to(DEVICE)
+            time = uniform_dist.sample((batch.size(0),)).unsqueeze(dim=1).to(DEVICE)
+            y_batch = (1 - time) * noised_samples + time * batch
+            batch_losses = torch.sum(torch.pow(vf_model(y_batch, time) - (batch - noised_samples), 2), dim=1)
+            sum_of_losses += batch_losses.sum().item()
+            number_of_seen_samples += batch.size(0)
+
+    return sum_of_losses / number_of_seen_samples
+
+def benchmark_low_discrepancy_sampling(num_epochs=NUM_OF_EPOCH,
+                                       configurations=[('iid', 'iid'), ('stratified', 'iid'), ('antithetic', 'iid'), ('iid', 'sobol'), ('stratified', 'sobol')]):
+    train_loader, val_loader = create_unconditional_dataloaders(split=0.96)
+
+    # Train a model for each (time sampling, noise sampling) configuration and record its loss curve
+    results = {}
+    for time_sampling, noise_sampling in configurations:
+        torch.manual_seed(SEED)
+        loss_curve = []
+        vf_model, _ = train_unconditional_VF(train_loader=train_loader, num_epochs=num_epochs, time_sampling=time_sampling,
+                                             noise_sampling=noise_sampling, loss_curve=loss_curve)
+        results[(time_sampling, noise_sampling)] = (loss_curve, evaluate_uncon_VF_loss(vf_model, val_loader))
+
+    # Report train loss as a function of wall-clock and the final held-out loss
+    print("\nTrain loss as a function of wall-clock time:")
+    for (time_sampling, noise_sampling), (loss_curve, val_loss) in results.items():
+        curve = ", ".join(f"{elapsed:.0f}s: {loss:.4f}" for elapsed, loss in loss_curve)
+        print(f"\ttime={time_sampling:<10} noise={noise_sampling:<5} held-out loss {val_loss:.4f} | {curve}")
+
+    return results
+
+def benchmark_exported_nflow(nflow_model, batch_sizes=[1, 10, 100, 1000, 10000, 100000, 1000000], num_of_repeats=5, export_dir=NFLOW_EXPORT_DIR):
+    # Export the model and load it back as it would be loaded in a service
+    export_paths = export_normalization_flow(nflow_model, export_dir)
+    exported_nflow = torch.jit.load(export_paths['torchscript'])
+    eager_nflow = ExportableNormalizationFlow(copy.deepcopy(nflow_model).to('cpu').eval()).eval()
+
+    def time_entry_point(entry_point_fn, points):
+        entry_point_fn(points)
+        latencies = []
+        for _ in range(num_of_repeats):
+            start_time = perf_counter()
+            entry_point_fn(points)
+            latencies.append(perf_counter() - start_time)
+        return float(np.median(latencies))
+
+    print(f"\n{'Entry point':<12} {'Batch':>8} {'Eager (sec)':>12} {'Exported (sec)':>15} {'Speedup':>8} {'Max diff':>10}")
+    results = []
+    with torch.no_grad():
+        for entry_point in ['forward', 'inverse', 'log_density']:
+            for batch_size in batch_sizes:
+                points = torch.randn(batch_size, LATENT_DIM)
+                eager_fn = getattr(eager_nflow, entry_point)
+                exported_fn = getattr(exported_nflow, entry_point)
+
+                # Check numerical equivalence with the eager model
+                max_diff = torch.max(torch.abs(eager_fn(points) - exported_fn(points))).item()
+                assert(max_diff < 1e-4), f"Exported {entry_point} doesn't match the eager model (max diff {max_diff})"
+
+                eager_time = time_entry_point(eager_fn, points)
+                exported_time = time_entry_point(exported_fn, points)
+                results.append((entry_point, batch_size, eager_time, exported_time, max_diff))
+                print(f"{entry_point:<12} {batch_size:>8} {eager_time:>12.5f} {exported_time:>15.5f} {eager_time / exported_time:>8.2f} {max_diff:>10.2e}")
+
+    return results
+
+
+if RUN_BENCHMARKS:
+    run_generative_benchmark_suite(nflow_model, uncon_vf, emb_uncon_vf)
+    benchmark_low_discrepancy_sampling()
+    benchmark_exported_nflow(nflow_model)
+
+    benchmark_ot_coupling()
+
+    # Compare Parareal sampling latency to serial Euler sampling
+    benchmark_parareal_sampling(uncon_vf)
+    benchmark_parareal_sampling(emb_uncon_vf, num_of_classes=NUM_OF_CLASSES)
+
+    # Distill the unconditional vector field into a few steps sampler
+    distillation_stages = distill_unconditional_VF(uncon_vf)
+    report_distillation_stages(uncon_vf, distillation_stages)
@@ -9,22 +9,54 @@ Original file is located at
 
 """### **Code from models.py**"""
 
+import math
+import contextlib
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision.models import resnet18
 
 
+@contextlib.contextmanager
+def preserve_batchnorm_stats(module):
+    # Restore the BatchNorm running statistics of the module when the block ends
+    saved_buffers = [(buffer, buffer.clone()) for sub_module in module.modules() if isinstance(sub_module, nn.modules.batchnorm._BatchNorm)
+                     for buffer in sub_module.buffers()]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, saved_buffer in saved_buffers:
+                buffer.copy_(saved_buffer)
+
+
 class Encoder(nn.Module):
-    def __init__(self, D=128, device='cuda'):
+    def __init__(self, D=128, device='cuda', use_checkpointing=False):
         super(Encoder, self).__init__()
         self.resnet = resnet18(pretrained=False).to(device)
         self.resnet.conv1 = nn.Conv2d(3, 64, kernel_size=(3, 3), stride=1)
         self.resnet.maxpool = nn.Identity()
         self.resnet.fc = nn.Linear(512, 512)
         self.fc = nn.Sequential(nn.BatchNorm1d(512), nn.ReLU(inplace=True), nn.Linear(512, D))
+        self.use_checkpointing = use_checkpointing
+
+    def checkpointed_resnet(self, x):
+        # Same computation as self.resnet(x), but only the inputs of the residual stages are kept for the backward
+        # and their activations are recomputed. The recomputation restores the stages' BatchNorm running statistics,
+        # so they are updated once per step as without checkpointing
+        x = self.resnet.maxpool(self.resnet.relu(self.resnet.bn1(self.resnet.conv1(x))))
+        for layer in [self.resnet.layer1, self.resnet.layer2, self.resnet.layer3, self.resnet.layer4]:
+            x = checkpoint(layer, x, use_reentrant=False,
+                           context_fn=lambda layer=layer: (contextlib.nullcontext(), preserve_batchnorm_stats(layer)))
+        x = torch.flatten(self.resnet.avgpool(x), 1)
+        return self.resnet.fc(x)
 
     def forward(self, x):
-        x = self.resnet(x)
+        if self.use_checkpointing and self.training and torch.is_grad_enabled():
+            x = self.checkpointed_resnet(x)
+        else:
+            x = self.resnet(x)
         x = self.fc(x)
         return x
 
@@ -67,8 +99,191 @@ test_transform = transforms.Compose([
     transforms.Normalize((0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261))
 ])
 
+"""### **Batched tensor augmentations**"""
+
+def rgb_to_grayscale(images):
+    # Same weights as torchvision's Grayscale, images of shape (B, 3, H, W)
+    return (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).unsqueeze(dim=1)
+
+
+def rgb_to_hsv(images):
+    r, g, b = images.unbind(dim=1)
+    max_c = images.max(dim=1).values
+    min_c = images.min(dim=1).values
+    eq_c = max_c == min_c
+
+    # Saturation, avoiding division by zero for gray pixels
+    cr = max_c - min_c
+    ones = torch.ones_like(max_c)
+    s = cr / torch.where(eq_c, ones, max_c)
+
+    # Hue
+    cr_divisor = torch.where(eq_c, ones, cr)
+    rc = (max_c - r) / cr_divisor
+    gc = (max_c - g) / cr_divisor
+    bc = (max_c - b) / cr_divisor
+    hr = (max_c == r) * (bc - gc)
+    hg = ((max_c == g) & (max_c != r)) * (2.0 + rc - bc)
+    hb = ((max_c != g) & (max_c != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+
+    return torch.stack([h, s, max_c], dim=1)
+
+
+def hsv_to_rgb(images):
+    h, s, v = images.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+
+    # Select the RGB values of each pixel according to its hue sector
+    mask = (i.unsqueeze(dim=1) == torch.arange(6, device=i.device).view(-1, 1, 1)).to(images.dtype)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+
+    return torch.einsum("bijk,bxijk->bxjk", mask, a4)
+
+
+class BatchAugmentation(nn.Module):
+    # Applies train_transform to a whole uint8 batch of images on tensors, with random parameters (including the order of
+    # the color jitter adjustments) drawn for each sample
+    def __init__(self, crop_scale=(0.2, 1.0), crop_ratio=(3 / 4, 4 / 3), flip_p=0.5, brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1,
+                 grayscale_p=0.2, blur_p=0.5, blur_sigma=(0.1, 2.0), mean=(0.4914, 0.4822, 0.4465), std=(0.247, 0.243, 0.261)):
+        super(BatchAugmentation, self).__init__()
+        self.crop_scale = crop_scale
+        self.crop_log_ratio = (math.log(crop_ratio[0]), math.log(crop_ratio[1]))
+        self.flip_p = flip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.grayscale_p = grayscale_p
+        self.blur_p = blur_p
+        self.blur_sigma = blur_sigma
+        self.register_buffer('mean', torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, 3, 1, 1))
+
+    def uniform(self, batch_size, low, high, device):
+        return torch.empty(batch_size, device=device).uniform_(low, high)
+
+    def random_resized_crop_and_flip(self, images):
+        batch_size, channels, height, width = images.size()
+
+        # Sample 10 crop sizes (as fractions of the image) for each sample and keep the first one which fits in the image,
+        # like RandomResizedCrop does, which falls back to the whole (square) image when none fits
+        area = self.uniform((batch_size, 10), self.crop_scale[0], self.crop_scale[1], images.device)
+        ratio = torch.exp(self.uniform((batch_size, 10), self.crop_log_ratio[0], self.crop_log_ratio[1], images.device))
+        crop_w = torch.sqrt(area * ratio)
+        crop_h = torch.sqrt(area / ratio)
+        fits = (crop_w <= 1) & (crop_h <= 1)
+        first_fit = torch.argmax(fits.int(), dim=1, keepdim=True)
+        crop_w = torch.where(fits.any(dim=1), torch.gather(crop_w, 1, first_fit).squeeze(dim=1), 1.0)
+        crop_h = torch.where(fits.any(dim=1), torch.gather(crop_h, 1, first_fit).squeeze(dim=1), 1.0)
+
+        # Sample the crop centers for each sample
+        center_x = crop_w / 2 + torch.rand(batch_size, device=images.device) * (1 - crop_w)
+        center_y = crop_h / 2 + torch.rand(batch_size, device=images.device) * (1 - crop_h)
+        flip = torch.where(torch.rand(batch_size, device=images.device) < self.flip_p, -1.0, 1.0)
+
+        # Crop, resize and flip all samples at once with an affine sampling grid
+        theta = torch.zeros(batch_size, 2, 3, device=images.device)
+        theta[:, 0, 0] = crop_w * flip
+        theta[:, 0, 2] = 2 * center_x - 1
+        theta[:, 1, 1] = crop_h
+        theta[:, 1, 2] = 2 * center_y - 1
+        grid = F.affine_grid(theta, [batch_size, channels, height, width], align_corners=False)
+
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+
+    def adjust_colors(self, images, adjustment, factor):
+        # Apply one of the four color jitter adjustments, with a factor for each image
+        if adjustment == 0:
+            return torch.clamp(images * factor.view(-1, 1, 1, 1), 0, 1)
+        if adjustment == 1:
+            factor = factor.view(-1, 1, 1, 1)
+            mean = rgb_to_grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+            return torch.clamp(factor * images + (1 - factor) * mean, 0, 1)
+        if adjustment == 2:
+            factor = factor.view(-1, 1, 1, 1)
+            return torch.clamp(factor * images + (1 - factor) * rgb_to_grayscale(images), 0, 1)
+        hsv_images = rgb_to_hsv(images)
+        hue = torch.remainder(hsv_images[:, 0] + factor.view(-1, 1, 1), 1.0)
+        return hsv_to_rgb(torch.stack([hue, hsv_images[:, 1], hsv_images[:, 2]], dim=1))
+
+    def color_jitter(self, images):
+        batch_size = images.size(0)
+
+        # Draw the brightness, contrast, saturation and hue factors and the order of the adjustments for each sample
+        factors = torch.stack([self.uniform(batch_size, 1 - self.brightness, 1 + self.brightness, images.device),
+                               self.uniform(batch_size, 1 - self.contrast, 1 + self.contrast, images.device),
+                               self.uniform(batch_size, 1 - self.saturation, 1 + self.saturation, images.device),
+                               self.uniform(batch_size, -self.hue, self.hue, images.device)], dim=1)
+        orders = torch.argsort(torch.rand(batch_size, 4, device=images.device), dim=1)
+
+        # At each position of the order, apply every adjustment to the samples that have it there
+        images = images.clone()
+        for position in range(4):
+            for adjustment in range(4):
+                indices = torch.nonzero(orders[:, position] == adjustment).squeeze(dim=1)
+                if indices.numel() > 0:
+                    images[indices] = self.adjust_colors(images[indices], adjustment, factors[indices, adjustment])
+
+        return images
+
+    def random_grayscale(self, images):
+        grayscale_mask = (torch.rand(images.size(0), device=images.device) < self.grayscale_p).view(-1, 1, 1, 1)
+        return torch.where(grayscale_mask, rgb_to_grayscale(images).expand_as(images), images)
+
+    def random_gaussian_blur(self, images):
+        batch_size, channels, height, width = images.size()
+
+        # Build a 3x3 gaussian kernel for each sample
+        sigma = self.uniform(batch_size, self.blur_sigma[0], self.blur_sigma[1], images.device).view(-1, 1)
+        offsets = torch.arange(-1, 2, device=images.device, dtype=images.dtype).view(1, -1)
+        kernel_1d = torch.exp(-torch.pow(offsets, 2) / (2 * torch.pow(sigma, 2)))
+        kernel_1d = kernel_1d / kernel_1d.sum(dim=1, keepdim=True)
+        kernel_2d = kernel_1d.unsqueeze(dim=2) * kernel_1d.unsqueeze(dim=1)
+
+        # Blur all samples at once with a grouped convolution (one group per sample channel)
+        weight = kernel_2d.repeat_interleave(channels, dim=0).unsqueeze(dim=1)
+        padded_images = F.pad(images.reshape(1, batch_size * channels, height, width), (1, 1, 1, 1), mode='reflect')
+        blurred_images = F.conv2d(padded_images, weight, groups=batch_size * channels).view(batch_size, channels, height, width)
+
+        blur_mask = (torch.rand(batch_size, device=images.device) < self.blur_p).view(-1, 1, 1, 1)
+        return torch.where(blur_mask, blurred_images, images)
+
+    def forward(self, images):
+        with torch.no_grad():
+            images = images.float() / 255
+            images = self.random_resized_crop_and_flip(images)
+            images = self.color_jitter(images)
+            images = self.random_grayscale(images)
+            images = self.random_gaussian_blur(images)
+            images = (images - self.mean) / self.std
+
+        return images
+
 """### **My Code**"""
 
+import os
+import sys
+import copy
+import json
+import queue
+import hashlib
+import struct
+import threading
+import shutil
+import subprocess
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
 import faiss
 import torch
 import torch.nn as nn
@@ -89,6 +304,13 @@ from sklearn.manifold import TSNE
 from sklearn.metrics import roc_curve, auc, silhouette_score
 from sklearn.cluster import KMeans
 
+# Make the helpers shared by the exercises importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aml_common.figures import headless_figure, show_figure, start_figure_workers, to_plain_arrays
+from aml_common.rasterize import compute_points_extent, rasterize_points, shade_density_image
+from aml_common.checkpoints import CheckpointManager, restore_rng_states
+from aml_common.hashing import hash_model_weights
+
 """**Global Variables**"""
 
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -107,6 +329,19 @@ WEIGHT_DECAY = 1e-6
 NUM_OF_EPOCHS = 30
 LP_NUM_OF_EPOCHS = 10
 NUM_OF_CLASSES = 10
+FIGURES_DIR = None
+NUM_OF_FIGURE_WORKERS = 4
+IMAGE_STORE_DIR = './data/uint8_store'
+MODEL_ARTIFACTS_DIR = './artifacts'
+EMBEDDING_CACHE_DIR = './data/embedding_cache'
+EMBEDDING_CACHE_DTYPE = 'float32'
+FAISS_INDEX_DIR = None
+CHECKPOINT_DIR = './checkpoints'
+NEIGHBOR_MINING_EVERY = None
+MODEL_ARTIFACT_ALIGNMENT = 64
+CIFAR10_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR10_STD = (0.247, 0.243, 0.261)
+RUN_BENCHMARKS = False
 
 """**Random Seed**"""
 
@@ -130,6 +365,269 @@ class CombinedDataset(Dataset):
         return sample1, sample2
 
 
+class ImageStore:
+    # Memory-mapped uint8 images (N, 3, 32, 32) and labels of a dataset split, shared by all its consumers
+    def __init__(self, images, labels, name, is_train, mean=CIFAR10_MEAN, std=CIFAR10_STD):
+        self.images = images
+        self.labels = labels
+        self.name = name
+        self.is_train = is_train
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def gather_uint8(self, indices):
+        # Gather all the images with a single fancy index on the memory map
+        if isinstance(indices, torch.Tensor):
+            indices = indices.cpu().numpy()
+        images = torch.from_numpy(self.images[np.asarray(indices)])
+        labels = torch.from_numpy(self.labels[np.asarray(indices)])
+        return images, labels
+
+    def gather(self, indices, device=DEVICE):
+        # Gather the images and normalize them like test_transform, all at once
+        images, labels = self.gather_uint8(indices)
+        images = images.to(device).float() / 255
+        images = (images - self.mean.to(device)) / self.std.to(device)
+        return images, labels
+
+
+class ImageStoreLoader:
+    # Yields normalized (images, labels) batches of an image store using batched gathers, with the images on device
+    def __init__(self, store, batch_size=BATCH_SIZE, shuffle=False, indices=None, device=DEVICE):
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.indices = np.arange(len(store)) if indices is None else np.asarray(indices)
+        self.device = device
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices[torch.randperm(len(self.indices)).numpy()] if self.shuffle else self.indices
+        for start in range(0, len(indices), self.batch_size):
+            yield self.store.gather(indices[start:start + self.batch_size], self.device)
+
+
+class NeighborPairsLoader:
+    # Yields batches of images together with their paired neighbor images, in the same format as a CombinedDataset dataloader
+    def __init__(self, store, pair_indices, batch_size=BATCH_SIZE, shuffle=False):
+        self.store = store
+        self.pair_indices = np.asarray(pair_indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.store) + self.batch_size - 1) // self.batch_size
+
+    def swap_pair_indices(self, pair_indices):
+        # Replace the whole pairs table with a single reference assignment, batches after the swap use the new pairs
+        self.pair_indices = np.asarray(pair_indices)
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.store)).numpy() if self.shuffle else np.arange(len(self.store))
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            # Read the table once per batch, so a concurrent swap never mixes two tables in a batch
+            pair_indices = self.pair_indices
+            yield self.store.gather(batch_indices), self.store.gather(pair_indices[batch_indices])
+
+
+class NeighborMiner:
+    # Re-mines the neighbor pairs of a NeighborPairsLoader every mine_every training steps from a snapshot of the encoder
+    # being trained. The mining (embedding the dataset, the kNN self-join and the pairs table swap) runs in a background
+    # thread, if the previous mining is still running the refresh is skipped so training never waits for it
+    def __init__(self, pairs_loader, mine_every=1000, k=3, seed=SEED):
+        self.pairs_loader = pairs_loader
+        self.mine_every = mine_every
+        self.k = k
+        self.generator = torch.Generator().manual_seed(seed)
+        # Guards the random stream, the pairs table and the refreshes count, which the mining thread updates together
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_mining = None
+        self.cancelled = False
+        self.num_of_steps = 0
+        self.num_of_refreshes = 0
+
+    def mine(self, encoder_snapshot):
+        # Embed the dataset with the snapshot and find the k nearest neighbors of every image
+        # The mining is dropped as soon as the miner is stopped (training already ended), checked between the embedded batches
+        dataloader = ImageStoreLoader(self.pairs_loader.store, batch_size=BATCH_SIZE, shuffle=False)
+        data_img_encoder_reps, _ = compute_images_representations(dataloader, encoder_snapshot, verbose=False, should_stop=lambda: self.cancelled)
+        if data_img_encoder_reps is None:
+            return
+        _, nearest_neighbors_indices = knn_self_join(data_img_encoder_reps, k=self.k)
+
+        # Randomly select one neighbor of each image, using a separate generator to keep the training random stream unchanged
+        with self.lock:
+            if self.cancelled:
+                return
+            random_indices = torch.randint(0, self.k, (nearest_neighbors_indices.size(0), 1), generator=self.generator)
+            selected_neighbors_indices = torch.gather(nearest_neighbors_indices.cpu(), 1, random_indices).squeeze(dim=1)
+            self.pairs_loader.swap_pair_indices(selected_neighbors_indices.numpy())
+            self.num_of_refreshes += 1
+
+    def step(self, encoder):
+        self.num_of_steps += 1
+        if self.num_of_steps % self.mine_every != 0:
+            return
+
+        # Skip this refresh if the previous mining is still running, and raise if it failed
+        if self.pending_mining is not None:
+            if not self.pending_mining.done():
+                return
+            self.pending_mining.result()
+
+        # Mine from a snapshot of the weights, so training can keep updating the encoder
+        encoder_snapshot = copy.deepcopy(encoder).eval()
+        self.pending_mining = self.executor.submit(self.mine, encoder_snapshot)
+
+    def stop(self):
+        # Cancel the mining in progress, its pairs would only be swapped in after training. It stops at its next batch,
+        # so waiting for it is short, and raise if it failed
+        self.cancelled = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        pending_mining, self.pending_mining = self.pending_mining, None
+        if pending_mining is not None and not pending_mining.cancelled():
+            pending_mining.result()
+
+    def state_dict(self):
+        # The current pairs table, the mining schedule and random stream, so a resumed training continues from the same pairs and schedule.
+        # They are read under the lock, so a concurrent mining never leaves them out of sync
+        with self.lock:
+            return {'pair_indices': np.array(self.pairs_loader.pair_indices), 'num_of_steps': self.num_of_steps,
+                    'num_of_refreshes': self.num_of_refreshes, 'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        with self.lock:
+            self.pairs_loader.swap_pair_indices(state['pair_indices'])
+            self.num_of_steps = state['num_of_steps']
+            self.num_of_refreshes = state['num_of_refreshes']
+            self.generator.set_state(state['generator'])
+
+
+class FaissIndexManager:
+    # Builds a FAISS index once per embeddings set (identified by the caller's index_id) and index configuration, keeps the
+    # last few in memory and, only when index_dir is given, persists them to disk. Without an index_id the index is built
+    # for the single call. Supported index types: 'flat' (exact), 'ivf_flat', 'ivf_pq' and 'hnsw'
+    def __init__(self, index_type='flat', index_dir=None, nlist=1024, nprobe=16, pq_m=16, pq_nbits=8, hnsw_m=32, ef_construction=200, ef_search=64,
+                 max_cached_indexes=4):
+        assert(index_type in ['flat', 'ivf_flat', 'ivf_pq', 'hnsw']), "Index type must be either 'flat', 'ivf_flat', 'ivf_pq' or 'hnsw'"
+        self.index_type = index_type
+        self.index_dir = index_dir
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.max_cached_indexes = max_cached_indexes
+        self.cached_indexes = {}
+
+    def config_description(self):
+        if self.index_type == 'flat':
+            return 'flat'
+        if self.index_type == 'ivf_flat':
+            return f"ivf_flat_nlist{self.nlist}"
+        if self.index_type == 'ivf_pq':
+            return f"ivf_pq_nlist{self.nlist}_m{self.pq_m}_nbits{self.pq_nbits}"
+        return f"hnsw_m{self.hnsw_m}_efc{self.ef_construction}"
+
+    def build_index(self, samples_np):
+        num_of_samples, dim = samples_np.shape
+        if self.index_type == 'flat':
+            index = faiss.IndexFlatL2(dim)
+        elif self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(dim, self.hnsw_m)
+            index.hnsw.efConstruction = self.ef_construction
+        else:
+            # Keep at least 39 training points per list, as FAISS recommends
+            nlist = max(1, min(self.nlist, num_of_samples // 39))
+            quantizer = faiss.IndexFlatL2(dim)
+            if self.index_type == 'ivf_flat':
+                index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+            else:
+                assert(dim % self.pq_m == 0), "Embeddings dimension must be divisible by pq_m"
+                index = faiss.IndexIVFPQ(quantizer, dim, nlist, self.pq_m, self.pq_nbits)
+            index.train(samples_np)
+        index.add(samples_np)
+        return index
+
+    def apply_search_parameters(self, index):
+        if self.index_type in ['ivf_flat', 'ivf_pq']:
+            index.nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            index.hnsw.efSearch = self.ef_search
+        return index
+
+    def get_index(self, samples_np, index_id=None):
+        # Without an id the embeddings set can't be recognized again, so its index is neither cached nor persisted
+        assert(index_id is not None or self.index_dir is None), "Persisted indexes must be given an index_id"
+        if index_id is None:
+            return self.apply_search_parameters(self.build_index(samples_np))
+
+        # Key the index by the caller's id of the embeddings set (e.g. their embedding cache key) and the index configuration
+        key = index_id[:32] + '_' + self.config_description()
+        if key in self.cached_indexes:
+            return self.cached_indexes[key]
+
+        # Load the persisted index, or build it and persist it (to a temporary file which is then renamed)
+        index_path = os.path.join(self.index_dir, key + '.index') if self.index_dir is not None else None
+        if index_path is not None and os.path.exists(index_path):
+            index = faiss.read_index(index_path)
+        else:
+            index = self.build_index(samples_np)
+            if index_path is not None:
+                os.makedirs(self.index_dir, exist_ok=True)
+                faiss.write_index(index, index_path + '.tmp')
+                os.replace(index_path + '.tmp', index_path)
+
+        # Keep only the most recently built indexes in memory
+        if len(self.cached_indexes) >= self.max_cached_indexes:
+            self.cached_indexes.pop(next(iter(self.cached_indexes)))
+        self.cached_indexes[key] = self.apply_search_parameters(index)
+        return self.cached_indexes[key]
+
+    def search(self, samples_tensor, query_vectors, k, index_id=None):
+        # Convert to contiguous float32 arrays, without copying when the tensors already are on the CPU in float32
+        samples_np = np.ascontiguousarray(samples_tensor.detach().cpu().numpy(), dtype=np.float32)
+        query_vectors_np = np.ascontiguousarray(query_vectors.detach().cpu().numpy(), dtype=np.float32)
+        return self.get_index(samples_np, index_id).search(query_vectors_np, k)
+
+
+class TwoViewCIFAR10Dataset(Dataset):
+    # Serves the stored uint8 images, both views are augmented from the same image after collation
+    def __init__(self, is_train=True):
+        self.store = get_image_store('cifar10', is_train)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.store.images[idx])), int(self.store.labels[idx])
+
+
+class TwoViewAugmentedLoader:
+    # Wraps a uint8 images dataloader and yields two augmented views of each batch,
+    # in the same format as a CombinedDataset dataloader
+    def __init__(self, dataloader, augmentation):
+        self.dataloader = dataloader
+        self.augmentation = augmentation
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for images, labels in self.dataloader:
+            images = images.to(DEVICE, non_blocking=True)
+            yield (self.augmentation(images), labels), (self.augmentation(images), labels)
+
+
 class VICReg(nn.Module):
     def __init__(self, encoder, projector):
         super(VICReg, self).__init__()
@@ -154,24 +652,238 @@ class LinearProber(nn.Module):
         x = self.fc(x)
         return x
 
+
+class BlockedGramSquaredNorm(torch.autograd.Function):
+    # Computes ||Z^T Z||_F^2 tile by tile, the backward recomputes the tiles instead of keeping the D x D matrix
+    @staticmethod
+    def forward(ctx, z, block_size):
+        ctx.save_for_backward(z)
+        ctx.block_size = block_size
+        squared_norm = z.new_zeros(())
+        for i in range(0, z.size(1), block_size):
+            # The matrix is symmetric, so each tile above the diagonal is counted twice
+            for j in range(i, z.size(1), block_size):
+                tile = z[:, i:i + block_size].T @ z[:, j:j + block_size]
+                squared_norm += (1 if i == j else 2) * torch.sum(tile * tile)
+        return squared_norm
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # The gradient of ||Z^T Z||_F^2 is 4 Z (Z^T Z), computed one column tile at a time
+        z, = ctx.saved_tensors
+        block_size = ctx.block_size
+        grad = torch.zeros_like(z)
+        for j in range(0, z.size(1), block_size):
+            for i in range(0, z.size(1), block_size):
+                tile = z[:, i:i + block_size].T @ z[:, j:j + block_size]
+                grad[:, j:j + block_size] += z[:, i:i + block_size] @ tile
+        return 4 * grad_output * grad, None
+
+
+def split_batch_norm_forward(batch_norm, x):
+    # Normalize each of the num_splits equal chunks of the batch with its own statistics, in the same order as
+    # separate forward passes would, so the running statistics are updated exactly as they would be by those passes
+    if batch_norm.num_splits == 1 or not batch_norm.training:
+        return super(type(batch_norm), batch_norm).forward(x)
+
+    assert(x.size(0) % batch_norm.num_splits == 0), "Batch size must be divisible by the number of splits"
+    return torch.cat([super(type(batch_norm), batch_norm).forward(chunk) for chunk in x.chunk(batch_norm.num_splits, dim=0)], dim=0)
+
+
+class SplitBatchNorm1d(nn.BatchNorm1d):
+    def __init__(self, num_features, num_splits=1, **kwargs):
+        super(SplitBatchNorm1d, self).__init__(num_features, **kwargs)
+        self.num_splits = num_splits
+
+    def forward(self, x):
+        return split_batch_norm_forward(self, x)
+
+
+class SplitBatchNorm2d(nn.BatchNorm2d):
+    def __init__(self, num_features, num_splits=1, **kwargs):
+        super(SplitBatchNorm2d, self).__init__(num_features, **kwargs)
+        self.num_splits = num_splits
+
+    def forward(self, x):
+        return split_batch_norm_forward(self, x)
+
+
+class VICRegLoss(nn.Module):
+    # VICReg objectives without covariance masks. The squared off-diagonal covariances are the squared Frobenius norm
+    # of the covariance minus its squared diagonal (the variances), and ||Zc^T Zc||_F = ||Zc Zc^T||_F lets us use the
+    # smaller of the two Gram matrices. When block_size is given the D x D Gram matrix is computed in tiles.
+    def __init__(self, gamma=GAMMA, epsilon=EPSILON, block_size=None):
+        super(VICRegLoss, self).__init__()
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.block_size = block_size
+
+    def off_diagonal_cov_loss(self, proj_reps, var_proj):
+        num_of_samples, proj_dim = proj_reps.shape
+        centered_reps = proj_reps - proj_reps.mean(dim=0, keepdim=True)
+
+        # Compute the squared Frobenius norm of the (unnormalized) covariance
+        if self.block_size is not None and self.block_size < proj_dim:
+            gram_squared_norm = BlockedGramSquaredNorm.apply(centered_reps, self.block_size)
+        elif num_of_samples < proj_dim:
+            gram_squared_norm = torch.sum(torch.pow(centered_reps @ centered_reps.T, 2))
+        else:
+            gram_squared_norm = torch.sum(torch.pow(centered_reps.T @ centered_reps, 2))
+
+        cov_squared_norm = gram_squared_norm / (num_of_samples - 1) ** 2
+        return (cov_squared_norm - torch.sum(torch.pow(var_proj, 2))) / proj_dim
+
+    def forward(self, proj_reps1, proj_reps2):
+        # Compute the invariance objective loss
+        inv_loss = torch.mean(torch.pow(proj_reps1 - proj_reps2, 2))
+
+        # Compute the variance objective loss
+        var_proj1 = torch.var(proj_reps1, dim=0)
+        var_proj2 = torch.var(proj_reps2, dim=0)
+
+        hinge_loss1 = torch.mean(torch.relu(self.gamma - torch.sqrt(var_proj1 + self.epsilon)))
+        hinge_loss2 = torch.mean(torch.relu(self.gamma - torch.sqrt(var_proj2 + self.epsilon)))
+
+        var_loss = hinge_loss1 + hinge_loss2
+
+        # Compute the covariance objective loss
+        cov_loss = self.off_diagonal_cov_loss(proj_reps1, var_proj1) + self.off_diagonal_cov_loss(proj_reps2, var_proj2)
+
+        return inv_loss, var_loss, cov_loss
+
 """**Auxiliary Functions**"""
 
-def create_CIFAR10_dataloader(is_train=True, use_augmentations=True, batch_size=BATCH_SIZE):
-    if use_augmentations:
+def get_model_config(model):
+    # Return the class name and constructor arguments needed to rebuild the model
+    if isinstance(model, Encoder):
+        return 'Encoder', {'D': model.fc[-1].out_features}
+    if isinstance(model, Projector):
+        return 'Projector', {'D': model.model[0].in_features, 'proj_dim': model.model[0].out_features}
+    if isinstance(model, LinearProber):
+        return 'LinearProber', {'D': model.fc.in_features, 'encoder_D': model.encoder.fc[-1].out_features}
+    raise ValueError(f"Unsupported model type: {type(model).__name__}")
+
+def build_model_on_meta(class_name, config):
+    # Build the model without allocating or initializing its weights, they are assigned when loading
+    with torch.device('meta'):
+        if class_name == 'Encoder':
+            return Encoder(D=config['D'], device='meta')
+        if class_name == 'Projector':
+            return Projector(D=config['D'], proj_dim=config['proj_dim'])
+        if class_name == 'LinearProber':
+            return LinearProber(encoder=Encoder(D=config['encoder_D'], device='meta'), D=config['D'])
+    raise ValueError(f"Unsupported model type: {class_name}")
+
+def save_model_artifact(model, path):
+    # Artifact layout: 8 bytes little-endian header length, a JSON header with the model config and the tensors
+    # dtypes, shapes and offsets, then the raw tensors, each aligned to MODEL_ARTIFACT_ALIGNMENT bytes
+    class_name, config = get_model_config(model)
+    arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in model.state_dict().items()}
+
+    tensors_header = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = (offset + MODEL_ARTIFACT_ALIGNMENT - 1) // MODEL_ARTIFACT_ALIGNMENT * MODEL_ARTIFACT_ALIGNMENT
+        tensors_header[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+
+    header = json.dumps({'class': class_name, 'config': config, 'tensors': tensors_header}).encode('utf-8')
+    # Pad the header so the data section starts aligned as well
+    header += b' ' * (-(8 + len(header)) % MODEL_ARTIFACT_ALIGNMENT)
+    data_start = 8 + len(header)
+
+    # Write to a temporary file and rename, so readers never map a partially written artifact
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'wb') as artifact_file:
+        artifact_file.write(struct.pack('<Q', len(header)))
+        artifact_file.write(header)
+        for name, array in arrays.items():
+            artifact_file.seek(data_start + tensors_header[name]['offset'])
+            artifact_file.write(array.tobytes())
+    os.replace(path + '.tmp', path)
+
+def load_model_artifact(path, device=DEVICE):
+    # Read the header
+    with open(path, 'rb') as artifact_file:
+        header_length, = struct.unpack('<Q', artifact_file.read(8))
+        header = json.loads(artifact_file.read(header_length))
+    data_start = 8 + header_length
+
+    # Map the data copy-on-write, so processes loading the same artifact share its pages until they write to them
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start)
+    state_dict = {}
+    for name, tensor_header in header['tensors'].items():
+        dtype = np.dtype(tensor_header['dtype'])
+        num_of_bytes = dtype.itemsize * int(np.prod(tensor_header['shape']))
+        array = data[tensor_header['offset']:tensor_header['offset'] + num_of_bytes].view(dtype).reshape(tensor_header['shape'])
+        state_dict[name] = torch.from_numpy(array)
+
+    # Assign the mapped tensors to a model built on the meta device, they are only copied when moved off the CPU
+    model = build_model_on_meta(header['class'], header['config'])
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device).eval()
+
+# Registry of the image stores, each split is converted once and shared by every consumer
+image_stores = {}
+
+# The MNIST to CIFAR10 format part of mnist_test_transform, applied once when the MNIST store is converted
+mnist_to_cifar10_format = transforms.Compose([transforms.Grayscale(num_output_channels=3), transforms.Resize((32, 32))])
+
+def get_image_store(name, is_train):
+    # Validate parameters
+    assert(name in ['cifar10', 'mnist']), "Name must be either 'cifar10' or 'mnist'"
+
+    # Return the store if it was already opened
+    split = f"{name}_{'train' if is_train else 'test'}"
+    if split in image_stores:
+        return image_stores[split]
+
+    images_path = os.path.join(IMAGE_STORE_DIR, f"{split}_images.npy")
+    labels_path = os.path.join(IMAGE_STORE_DIR, f"{split}_labels.npy")
+
+    # Convert the split once into uint8 images and labels arrays
+    if not os.path.exists(images_path) or not os.path.exists(labels_path):
+        if name == 'cifar10':
+            dataset = CIFAR10(root='./data', train=is_train, download=True)
+            images = dataset.data.transpose(0, 3, 1, 2)
+            labels = np.asarray(dataset.targets, dtype=np.int64)
+        else:
+            # Apply the MNIST to CIFAR10 format part of mnist_test_transform once
+            dataset = MNIST(root='./data', train=is_train, download=True)
+            images = np.stack([np.asarray(mnist_to_cifar10_format(dataset[i][0])) for i in range(len(dataset))]).transpose(0, 3, 1, 2)
+            labels = dataset.targets.numpy().astype(np.int64)
+
+        # Write to temporary files and rename, so a partially written store is never opened
+        os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+        np.save(images_path + '.tmp.npy', np.ascontiguousarray(images))
+        np.save(labels_path + '.tmp.npy', labels)
+        os.replace(images_path + '.tmp.npy', images_path)
+        os.replace(labels_path + '.tmp.npy', labels_path)
+
+    # Memory map the images, so all consumers (and worker processes) share the same pages
+    image_stores[split] = ImageStore(np.load(images_path, mmap_mode='r'), np.load(labels_path), name, is_train)
+    return image_stores[split]
+
+def create_CIFAR10_dataloader(is_train=True, use_augmentations=True, batch_size=BATCH_SIZE, batched_augmentations=False, num_workers=4):
+    if use_augmentations and batched_augmentations:
+        # Create a dataset which decodes each image once and augment both views on whole batches
+        dataset = TwoViewCIFAR10Dataset(is_train=is_train)
+        images_loader = DataLoader(dataset, batch_size=batch_size, shuffle=is_train, num_workers=num_workers, pin_memory=DEVICE.type == 'cuda')
+        dataloader = TwoViewAugmentedLoader(images_loader, BatchAugmentation().to(DEVICE))
+    elif use_augmentations:
         # Create datasets
         dataset1 = CIFAR10(root='./data', train=is_train, transform=train_transform, download=True)
         dataset2 = CIFAR10(root='./data', train=is_train, transform=train_transform, download=True)
 
         # Create dataloader
-        dataloader = DataLoader(CombinedDataset(dataset1, dataset2), batch_size=batch_size, shuffle=is_train, num_workers=4)
+        dataloader = DataLoader(CombinedDataset(dataset1, dataset2), batch_size=batch_size, shuffle=is_train, num_workers=num_workers)
     else:
-        # Create dataset
-        dataset = CIFAR10(root='./data', train=is_train, transform=test_transform, download=True)
-        # Create dataloader
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=is_train, num_workers=4)
+        # Create a dataloader over the shared uint8 store, normalized like test_transform
+        dataloader = ImageStoreLoader(get_image_store('cifar10', is_train), batch_size=batch_size, shuffle=is_train)
 
     return dataloader
 
+@headless_figure
 def plot_VICReg_losses(train_objectives_losses, test_objectives_losses):
     # Plot match flow training losses as a function of epoch
     number_of_epoch = len(train_objectives_losses)
@@ -207,10 +919,11 @@ def plot_VICReg_losses(train_objectives_losses, test_objectives_losses):
         showlegend=True,
         legend=dict(x=1.02, y=1, traceorder='normal')
     )
-    losses_plot.show()
+    show_figure(losses_plot)
 
 
-def plot_2d_samples(samples, labels, use_CIFAR10_labels_bools, centers=None, title=""):
+@headless_figure
+def plot_2d_samples(samples, labels, use_CIFAR10_labels_bools, centers=None, title="", rasterize=False):
     # Validate parameters
     assert(labels.shape[0] == len(use_CIFAR10_labels_bools))
     assert(labels.shape[1] == samples.shape[0])
@@ -239,9 +952,20 @@ def plot_2d_samples(samples, labels, use_CIFAR10_labels_bools, centers=None, tit
         cifar10_handlers.append(mpatches.Patch(color=color, label=labels_to_objects[label]))
         cluster_handlers.append(mpatches.Patch(color=color, label=f"Cluster #{label}"))
 
+    # Compute the extent of the rasterized images with a small margin
+    if rasterize:
+        extent = compute_points_extent(samples)
+        label_colors = [colormap(norm(label))[:3] for label in range(10)]
+
     # Create a scatter plots
     for i in range(num_of_plots):
-        axs[i].scatter(samples[:, 0], samples[: , 1], c=labels[i, :], cmap='tab10', marker='o')
+        if rasterize:
+            # Render the density of the points as an image with per class color blending
+            counts = rasterize_points(samples, labels[i, :], num_of_labels=10, extent=extent)
+            image = shade_density_image(counts, label_colors)
+            axs[i].imshow(image, extent=extent, origin='lower', interpolation='nearest', aspect='auto')
+        else:
+            axs[i].scatter(samples[:, 0], samples[: , 1], c=labels[i, :], cmap='tab10', marker='o')
         # Mark centers in black
         if centers is not None:
             axs[i].scatter(centers[:, 0], centers[:, 1], c='black', marker='x', s=200)
@@ -257,7 +981,7 @@ def plot_2d_samples(samples, labels, use_CIFAR10_labels_bools, centers=None, tit
     plt.subplots_adjust(top=0.9)
     plt.suptitle(title, y=1.05)
 
-    plt.show()
+    show_figure(fig)
 
 
 def unnormalize_CIFAR10_image(image):
@@ -265,20 +989,20 @@ def unnormalize_CIFAR10_image(image):
     Unnormalize a tensor image taken from CIFAR10 database back to its
     original representation.
     """
-    image = image.to(DEVICE)
-    mean = torch.tensor([0.4914, 0.4822, 0.4465]).to(DEVICE)
-    std = torch.tensor([0.2470, 0.2435, 0.2616]).to(DEVICE)
+    mean = torch.tensor([0.4914, 0.4822, 0.4465], device=image.device)
+    std = torch.tensor([0.2470, 0.2435, 0.2616], device=image.device)
     image = image * std[:, None, None] + mean[:, None, None]
 
     return image
 
 
+@headless_figure
 def present_neighbors_images(labels, selected_images, neighbors_tensor, title):
     # Validate parameters
-    assert(len(labels) == selected_images.size(0))
-    assert(len(labels) == neighbors_tensor.size(0))
+    assert(len(labels) == selected_images.shape[0])
+    assert(len(labels) == neighbors_tensor.shape[0])
     num_of_images = len(labels)
-    num_of_neighbors = neighbors_tensor.size(1)
+    num_of_neighbors = neighbors_tensor.shape[1]
 
     # Create a legend with distinct colors for each class
     labels_to_objects = {0: 'Airplane', 1: 'Automobile', 2: 'Bird', 3: 'Cat', 4: 'Deer', 5: 'Dog', 6: 'Frog', 7: 'Horse', 8: 'Ship', 9: 'Truck'}
@@ -298,19 +1022,20 @@ def present_neighbors_images(labels, selected_images, neighbors_tensor, title):
 
         # Add images
         axs[row][0].set_title("Selected Image", y=-0.5)
-        image = unnormalize_CIFAR10_image(selected_images[row])
+        image = unnormalize_CIFAR10_image(torch.as_tensor(selected_images[row]))
         axs[row][0].imshow(image.cpu().permute(1, 2, 0))
         axs[row][0].axis('off')
 
         for col in range(1, num_of_neighbors + 1):
             axs[row][col].set_title(f"Neighbor #{col}", y=-0.5)
-            image = unnormalize_CIFAR10_image(neighbors_tensor[row, col - 1])
+            image = unnormalize_CIFAR10_image(torch.as_tensor(neighbors_tensor[row, col - 1]))
             axs[row][col].imshow(image.cpu().permute(1, 2, 0))
             axs[row][col].axis('off')
 
-    plt.show()
+    show_figure(fig)
 
 
+@headless_figure
 def plot_ROC_curves(fpr_lst, tpr_lst, titles):
     # Validate parameters
     assert(len(titles) == len(fpr_lst))
@@ -337,16 +1062,17 @@ def plot_ROC_curves(fpr_lst, tpr_lst, titles):
                       height=500,
                       )
 
-    fig.show()
+    show_figure(fig)
 
 
+@headless_figure
 def plot_images(images_tensor, titles):
     # Validate parameters
-    assert(len(titles) == images_tensor.size(0))
+    assert(len(titles) == images_tensor.shape[0])
 
     # Initiate variables
-    num_of_rows = images_tensor.size(0)
-    num_of_images = images_tensor.size(1)
+    num_of_rows = images_tensor.shape[0]
+    num_of_images = images_tensor.shape[1]
 
     # Create a figure
     fig = plt.figure(constrained_layout=True, figsize=(8, 0.5 * num_of_images))
@@ -359,55 +1085,170 @@ def plot_images(images_tensor, titles):
         subfig_axs = subfig.subplots(nrows=1, ncols=num_of_images, gridspec_kw={'hspace': 0.5})
 
         for col, ax in enumerate(subfig_axs):
-            image = unnormalize_CIFAR10_image(images_tensor[row, col])
+            image = unnormalize_CIFAR10_image(torch.as_tensor(images_tensor[row, col]))
             ax.imshow(image.cpu().permute(1, 2, 0))
             ax.axis('off')
 
-    plt.show()
+    show_figure(fig)
+
+# Start the figure workers now that the plot functions are defined, before any training starts
+if FIGURES_DIR is not None:
+    start_figure_workers(FIGURES_DIR, NUM_OF_FIGURE_WORKERS)
 
 """## **Section 3 - VICReg**
 
 **Quetion 1**
 """
 
-def compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model):
-    # Compute projections for both batches
-    proj_reps1 = vicreg_model(augm_images_batch1)
-    proj_reps2 = vicreg_model(augm_images_batch2)
-
-    # Compute the invariance objective loss
-    inv_loss = torch.mean(torch.pow(proj_reps1 - proj_reps2, 2))
-
-    # Compute the variance objective loss
-    var_proj1 = torch.var(proj_reps1, dim=0)
-    var_proj2 = torch.var(proj_reps2, dim=0)
-
-    std_proj1 = torch.sqrt(var_proj1 + EPSILON)
-    std_proj2 = torch.sqrt(var_proj2 + EPSILON)
-
-    hinge_loss1 = torch.mean(torch.relu(GAMMA - std_proj1))
-    hinge_loss2 = torch.mean(torch.relu(GAMMA - std_proj2))
-
-    var_loss = hinge_loss1 + hinge_loss2
-
-    # Compute the covariance objective loss
-    cov_proj1 = torch.cov(proj_reps1.T)
-    cov_proj2 = torch.cov(proj_reps2.T)
-
-    assert(PROJ_DIM == cov_proj1.size(0))
-    diag_mask = torch.eye(PROJ_DIM, device=DEVICE).bool()
-    off_diagonal_cov_proj1 = cov_proj1.masked_select(~diag_mask)
-    off_diagonal_cov_proj2 = cov_proj2.masked_select(~diag_mask)
-
-    cov_proj1_loss = (1 / PROJ_DIM) * torch.sum(torch.pow(off_diagonal_cov_proj1, 2))
-    cov_proj2_loss = (1 / PROJ_DIM) * torch.sum(torch.pow(off_diagonal_cov_proj2, 2))
+def measure_peak_memory_mb(function):
+    # Run the function and return its peak memory above the memory in use before it (in MB). Only the CUDA measurement is
+    # exact, the CPU one is an approximation for reports and must not be used to enforce a memory budget
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start_memory = torch.cuda.memory_allocated()
+        function()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - start_memory) / 2 ** 20
+
+    # On the CPU sample the resident set size from a background thread. Peaks shorter than the sampling interval are missed,
+    # and memory the allocator keeps (or returns to the system) from earlier runs shifts the result
+    page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def read_resident_memory():
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * page_size
+
+    start_memory = read_resident_memory()
+    peak_memory = [start_memory]
+    done = threading.Event()
+
+    def sample_memory():
+        while not done.is_set():
+            peak_memory[0] = max(peak_memory[0], read_resident_memory())
+            done.wait(0.001)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    try:
+        function()
+    finally:
+        done.set()
+        sampler.join()
+
+    return (max(peak_memory[0], read_resident_memory()) - start_memory) / 2 ** 20
+
+
+def convert_to_split_batchnorm(module):
+    # Replace the BatchNorm layers of the module with split BatchNorm layers sharing the same parameters and buffers,
+    # so existing optimizers and state_dict keys stay valid. The layers split only inside split_batchnorm_views
+    for name, child in module.named_children():
+        if type(child) in [nn.BatchNorm1d, nn.BatchNorm2d]:
+            split_batch_norm_class = SplitBatchNorm1d if isinstance(child, nn.BatchNorm1d) else SplitBatchNorm2d
+            split_batch_norm = split_batch_norm_class(child.num_features, eps=child.eps, momentum=child.momentum,
+                                                      affine=child.affine, track_running_stats=child.track_running_stats)
+            split_batch_norm.weight, split_batch_norm.bias = child.weight, child.bias
+            split_batch_norm.running_mean, split_batch_norm.running_var = child.running_mean, child.running_var
+            split_batch_norm.num_batches_tracked = child.num_batches_tracked
+            split_batch_norm.train(child.training)
+            setattr(module, name, split_batch_norm)
+        else:
+            convert_to_split_batchnorm(child)
+
+    return module
+
+
+@contextlib.contextmanager
+def split_batchnorm_views(module, num_splits=2):
+    # Normalize each of the num_splits views concatenated along the batch with its own BatchNorm statistics.
+    # The previous number of splits is restored on exit, so the views can be nested, e.g. around the backward
+    # of a checkpointed encoder whose recomputed forward must split the batch as well
+    split_batch_norms = [child for child in module.modules() if isinstance(child, (SplitBatchNorm1d, SplitBatchNorm2d))]
+    assert(len(split_batch_norms) > 0), "Module must be converted using convert_to_split_batchnorm first"
+    previous_num_splits = [split_batch_norm.num_splits for split_batch_norm in split_batch_norms]
+    for split_batch_norm in split_batch_norms:
+        split_batch_norm.num_splits = num_splits
+    try:
+        yield module
+    finally:
+        for split_batch_norm, split_num_splits in zip(split_batch_norms, previous_num_splits):
+            split_batch_norm.num_splits = split_num_splits
+
+
+def is_out_of_memory_error(error):
+    # CUDA raises a dedicated error, while a failed CPU allocation raises a plain RuntimeError
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "can't allocate memory" in str(error) or 'not enough memory' in str(error)
+
+
+def measure_VICReg_step(batch_size, use_checkpointing=False, num_of_steps=2):
+    # Measure the peak memory (in MB) and the time (in seconds) of a VICReg training step on random images
+    torch.manual_seed(SEED)
+    encoder = Encoder(D=ENCODER_DIM, device=DEVICE, use_checkpointing=use_checkpointing).to(DEVICE)
+    vicreg_model = VICReg(encoder, Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM)).to(DEVICE).train()
+    optimizer = optim.Adam(vicreg_model.parameters(), lr=LEARNING_RATE, betas=BETAS, weight_decay=WEIGHT_DECAY)
+    augm_images_batch1 = torch.randn(batch_size, 3, 32, 32, device=DEVICE)
+    augm_images_batch2 = torch.randn(batch_size, 3, 32, 32, device=DEVICE)
+
+    def step():
+        inv_loss, var_loss, cov_loss = compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model)
+        optimizer.zero_grad()
+        (LAMBDA * inv_loss + MU * var_loss + NU * cov_loss).backward()
+        optimizer.step()
+
+    # The first step also allocates the optimizer state, so it is the one measured for memory
+    peak_memory = measure_peak_memory_mb(step)
+    start_time = perf_counter()
+    for _ in range(num_of_steps):
+        step()
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return peak_memory, (perf_counter() - start_time) / num_of_steps
+
+
+def find_largest_VICReg_batch_config(target_batch_size, memory_budget_mb, min_batch_size=BATCH_SIZE):
+    # Find the largest batch size (up to target_batch_size, halving from it) whose training step fits in the memory
+    # budget, preferring not to checkpoint the encoder when both fit since checkpointing recomputes the activations
+    assert(DEVICE.type == 'cuda'), "Memory budgets can only be enforced on CUDA, where the peak memory is measured exactly"
+    batch_size = target_batch_size
+    while batch_size >= min_batch_size:
+        for use_checkpointing in [False, True]:
+            try:
+                peak_memory, step_time = measure_VICReg_step(batch_size, use_checkpointing)
+            except RuntimeError as error:
+                if not is_out_of_memory_error(error):
+                    raise
+                if DEVICE.type == 'cuda':
+                    torch.cuda.empty_cache()
+                continue
+            if peak_memory <= memory_budget_mb:
+                return {'batch_size': batch_size, 'use_checkpointing': use_checkpointing,
+                        'peak_memory_mb': peak_memory, 'step_time': step_time}
+        batch_size //= 2
+
+    return None
+
+
+def compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model, vicreg_criterion=None, single_forward=False):
+    # Use the default VICReg objectives when no loss module is given
+    vicreg_criterion = VICRegLoss() if vicreg_criterion is None else vicreg_criterion
 
-    cov_loss = cov_proj1_loss + cov_proj2_loss
+    # Compute projections for both batches
+    if single_forward:
+        # Forward both batches at once, with separate BatchNorm statistics for each batch. A checkpointed encoder
+        # recomputes its forward in the backward, so callers must keep the views split until after the backward
+        with split_batchnorm_views(vicreg_model, num_splits=2):
+            proj_reps1, proj_reps2 = vicreg_model(torch.cat([augm_images_batch1, augm_images_batch2], dim=0)).chunk(2, dim=0)
+    else:
+        proj_reps1 = vicreg_model(augm_images_batch1)
+        proj_reps2 = vicreg_model(augm_images_batch2)
 
-    return inv_loss, var_loss, cov_loss
+    # Compute the invariance, variance and covariance objective losses, in fp32 even when the model runs under autocast
+    with torch.autocast(device_type=DEVICE.type, enabled=False):
+        return vicreg_criterion(proj_reps1.float(), proj_reps2.float())
 
 
-def test_VICReg(test_loader, vicreg_model):
+def test_VICReg(test_loader, vicreg_model, vicreg_criterion=None):
     # Change model mode to evaluation
     vicreg_model.eval()
 
@@ -425,7 +1266,7 @@ def test_VICReg(test_loader, vicreg_model):
         augm_images_batch2 = batch2[0].to(DEVICE)
 
         # Compute losses on batch
-        inv_loss, var_loss, cov_loss = compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model)
+        inv_loss, var_loss, cov_loss = compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model, vicreg_criterion)
 
         # Compute VICReg loss
         vicreg_loss = LAMBDA * inv_loss + MU * var_loss + NU * cov_loss
@@ -440,21 +1281,60 @@ def test_VICReg(test_loader, vicreg_model):
     return vicreg_avg_loss, inv_avg_loss, var_avg_loss, cov_avg_loss
 
 
-def train_VICReg(vicreg_model, train_loader, test_loader=None, num_epochs=NUM_OF_EPOCHS, lr=LEARNING_RATE, betas=BETAS, weight_decay=WEIGHT_DECAY, lam=LAMBDA, mu=MU, nu=NU, evaluate=False):
+def train_VICReg(vicreg_model, train_loader, test_loader=None, num_epochs=NUM_OF_EPOCHS, lr=LEARNING_RATE, betas=BETAS, weight_decay=WEIGHT_DECAY, lam=LAMBDA, mu=MU, nu=NU, evaluate=False, vicreg_criterion=None,
+                 use_bf16=False, channels_last=False, compile_step=False, single_forward=False, checkpoint_manager=None, neighbor_miner=None,
+                 memory_budget_mb=None, target_batch_size=None):
     # Validate parameters
     assert(not evaluate or test_loader!=None), "test dataloder must be given when using evaluation"
-
-    # Move VICReg model to DEVICE
+    assert(memory_budget_mb is None or (train_loader is None and target_batch_size is not None)), \
+        "When given a memory budget, the train dataloader is built from the target batch size and must not be given"
+
+    # Pick the largest batch size (and whether to checkpoint the encoder) whose training step fits in the memory budget
+    if memory_budget_mb is not None:
+        batch_config = find_largest_VICReg_batch_config(target_batch_size, memory_budget_mb)
+        assert(batch_config is not None), f"No batch size of at least {BATCH_SIZE} fits in {memory_budget_mb} MB"
+        print(f"Training with batch size {batch_config['batch_size']} (encoder checkpointing: {batch_config['use_checkpointing']}, "
+              f"peak memory: {batch_config['peak_memory_mb']:.1f} MB)")
+        train_loader = create_CIFAR10_dataloader(is_train=True, use_augmentations=True, batch_size=batch_config['batch_size'])
+        vicreg_model.encoder.use_checkpointing = batch_config['use_checkpointing']
+
+    # Move VICReg model to DEVICE. A single forward converts the model's own BatchNorm layers in place (sharing their
+    # parameters and buffers), so the caller's model is trained, and outside split views the layers act as plain BatchNorm
     vicreg_model = vicreg_model.to(DEVICE)
+    if single_forward:
+        vicreg_model = convert_to_split_batchnorm(vicreg_model)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    vicreg_model = vicreg_model.to(memory_format=memory_format)
 
     # Initiate ADAM optimizer
     optimizer = optim.Adam(vicreg_model.parameters(), lr=lr, betas=betas, weight_decay=weight_decay)
 
+    # Forward both views and compute the objectives, optionally under bf16 autocast and compiled
+    def compute_step_losses(augm_images_batch1, augm_images_batch2):
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16, enabled=use_bf16):
+            return compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model, vicreg_criterion, single_forward)
+
+    if compile_step:
+        compute_step_losses = torch.compile(compute_step_losses)
+
     # Train + evaluation for each epoch
     train_objectives_losses = []
     test_objectives_losses = []
 
-    for epoch in range(num_epochs):
+    # Resume from the last checkpoint if there is one
+    start_epoch = 0
+    checkpoint = checkpoint_manager.load() if checkpoint_manager is not None else None
+    if checkpoint is not None:
+        vicreg_model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        train_objectives_losses.extend(checkpoint['train_objectives_losses'])
+        test_objectives_losses.extend(checkpoint['test_objectives_losses'])
+        restore_rng_states(checkpoint['rng_states'])
+        if neighbor_miner is not None and 'neighbor_miner' in checkpoint:
+            neighbor_miner.load_state_dict(checkpoint['neighbor_miner'])
+        start_epoch = checkpoint['epoch'] + 1
+
+    for epoch in range(start_epoch, num_epochs):
         print(f"Train: Epoch {epoch + 1}")
         # Change model mode to train
         vicreg_model.train()
@@ -469,22 +1349,30 @@ def train_VICReg(vicreg_model, train_loader, test_loader=None, num_epochs=NUM_OF
         # Iterate the dataset
         for batch1, batch2 in tqdm(train_loader):
             # Get images batches, move them to DEVICE and compute their size
-            augm_images_batch1 = batch1[0].to(DEVICE)
-            augm_images_batch2 = batch2[0].to(DEVICE)
+            augm_images_batch1 = batch1[0].to(DEVICE, memory_format=memory_format)
+            augm_images_batch2 = batch2[0].to(DEVICE, memory_format=memory_format)
 
-            # Compute losses on batch
-            inv_loss, var_loss, cov_loss = compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, vicreg_model)
+            # Keep the BatchNorm views split through the backward, where a checkpointed encoder recomputes its forward
+            with split_batchnorm_views(vicreg_model, num_splits=2) if single_forward else contextlib.nullcontext():
+                # Compute losses on batch
+                inv_loss, var_loss, cov_loss = compute_step_losses(augm_images_batch1, augm_images_batch2)
 
-            # Compute VICReg loss
-            vicreg_loss = lam * inv_loss + mu * var_loss + nu * cov_loss
+                # Compute VICReg loss
+                vicreg_loss = lam * inv_loss + mu * var_loss + nu * cov_loss
 
-            # Zero the parameter gradients
-            optimizer.zero_grad()
+                # Zero the parameter gradients
+                optimizer.zero_grad()
 
-            # Backpropargate and update the model's parameters
-            vicreg_loss.backward()
+                # Backpropargate the loss
+                vicreg_loss.backward()
+
+            # Update the model's parameters
             optimizer.step()
 
+            # Let the neighbor miner refresh the neighbor pairs from the updated encoder
+            if neighbor_miner is not None:
+                neighbor_miner.step(vicreg_model.encoder)
+
             # Update batch losses variables
             if evaluate:
                 with torch.no_grad():
@@ -500,7 +1388,20 @@ def train_VICReg(vicreg_model, train_loader, test_loader=None, num_epochs=NUM_OF
                 # update train losses
                 train_objectives_losses.append((vicreg_avg_loss, inv_avg_loss, var_avg_loss, cov_avg_loss))
                 # update test losses
-                test_objectives_losses.append(test_VICReg(test_loader, vicreg_model))
+                test_objectives_losses.append(test_VICReg(test_loader, vicreg_model, vicreg_criterion))
+
+        # Save a checkpoint
+        if checkpoint_manager is not None:
+            checkpoint_manager.maybe_save(epoch, num_epochs, lambda: {
+                'model': vicreg_model.state_dict(), 'optimizer': optimizer.state_dict(),
+                'train_objectives_losses': list(train_objectives_losses), 'test_objectives_losses': list(test_objectives_losses),
+                **({'neighbor_miner': neighbor_miner.state_dict()} if neighbor_miner is not None else {})})
+
+    # Wait for the checkpoint writes to finish, and stop the neighbor mining whose pairs are no longer needed
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    if neighbor_miner is not None:
+        neighbor_miner.stop()
 
     return train_objectives_losses, test_objectives_losses
 
@@ -514,38 +1415,164 @@ projector_q1 = Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM).to(DEVICE)
 vicreg_q1 = VICReg(encoder_q1, projector_q1).to(DEVICE)
 
 # Train VICReg model and get train and test losses
-train_objectives_losses, test_objectives_losses = train_VICReg(vicreg_model=vicreg_q1, train_loader=train_loader, test_loader=test_loader, evaluate=True)
+train_objectives_losses, test_objectives_losses = train_VICReg(vicreg_model=vicreg_q1, train_loader=train_loader, test_loader=test_loader, evaluate=True,
+                                                               checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'vicreg_q1.pt')))
 
 # Plot losses
 plot_VICReg_losses(train_objectives_losses, test_objectives_losses)
 
 """**Question 2**"""
 
-def compute_images_representations(dataloader, encoder):
-    # Set encoder mode to evaluation
-    encoder.eval()
-
-    # Initiate empty global lists
-    data_img_encoders_lst = []
-    data_labels_lst = []
-
-    # Iterate the dataset and compute encoders
-    for images, labels in tqdm(dataloader):
-        images = images.to(DEVICE)
-        labels = labels.to(DEVICE)
-
-        # Compute encoders for images
-        img_encoders = encoder(images)
-
-        # Append results to global lists
-        data_img_encoders_lst.append(img_encoders.detach())
-        data_labels_lst.append(labels.detach())
-
-    # Concatenate results
-    data_img_encoders = torch.cat(data_img_encoders_lst, dim=0)
-    data_labels = torch.cat(data_labels_lst, dim=0)
-
-    return data_img_encoders, data_labels
+def get_num_of_samples(dataloader):
+    # Number of samples a dataloader yields per epoch
+    if isinstance(dataloader, ImageStoreLoader):
+        return len(dataloader.indices)
+    return len(dataloader.dataset)
+
+def prefetch_batches(dataloader, num_of_prefetched_batches=2):
+    # Load the next batches in a background thread (into pinned memory when using CUDA) while the current batch is processed
+    batches_queue = queue.Queue(maxsize=num_of_prefetched_batches)
+    end_of_data = object()
+    stop_loading = threading.Event()
+
+    # Gather the image store batches on the CPU, so they are pinned and copied to DEVICE asynchronously
+    if isinstance(dataloader, ImageStoreLoader):
+        dataloader = ImageStoreLoader(dataloader.store, dataloader.batch_size, dataloader.shuffle, dataloader.indices, device='cpu')
+
+    def put_batch(item):
+        # Wait for room in the queue unless the consumer stopped early, return whether the item was queued
+        while not stop_loading.is_set():
+            try:
+                batches_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load_batches():
+        try:
+            for images, labels in dataloader:
+                if DEVICE.type == 'cuda' and images.device.type == 'cpu':
+                    images = images.pin_memory()
+                if not put_batch((images, labels)):
+                    return
+            put_batch(end_of_data)
+        except BaseException as error:
+            put_batch(error)
+
+    loader_thread = threading.Thread(target=load_batches, daemon=True)
+    loader_thread.start()
+    try:
+        while True:
+            batch = batches_queue.get()
+            if batch is end_of_data:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            images, labels = batch
+            yield images.to(DEVICE, non_blocking=True), labels
+    finally:
+        # Release the loader thread also when the consumer stops before the end of the data
+        stop_loading.set()
+        loader_thread.join()
+
+def compute_multi_encoder_representations(dataloader, encoders, output_paths=None, output_dtype=np.float32, verbose=True, should_stop=None):
+    # Set encoders mode to evaluation
+    for encoder in encoders:
+        encoder.eval()
+
+    # The labels are preallocated on the CPU, the representations of each encoder once their size is known
+    num_of_samples = get_num_of_samples(dataloader)
+    output_paths = [None] * len(encoders) if output_paths is None else output_paths
+    all_img_encoders = [None] * len(encoders)
+    output_memmaps = [None] * len(encoders)
+    data_labels = torch.empty(num_of_samples, dtype=torch.int64)
+    offset = 0
+    start_time = perf_counter()
+
+    # Iterate the dataset once, each batch is loaded and normalized once and forwarded by every encoder,
+    # without building autograd graphs
+    with torch.inference_mode():
+        for images, labels in tqdm(prefetch_batches(dataloader), total=len(dataloader), disable=not verbose):
+            # Give up between batches when the caller asks to stop, e.g. a cancelled background mining
+            if should_stop is not None and should_stop():
+                return None, None
+            batch_size = images.size(0)
+            for index, encoder in enumerate(encoders):
+                # Compute encoders for images
+                img_encoders = encoder(images)
+
+                # Allocate the output (a memory-mapped .npy file when an output path is given) as a regular tensor
+                if all_img_encoders[index] is None:
+                    with torch.inference_mode(False):
+                        if output_paths[index] is not None:
+                            output_memmaps[index] = np.lib.format.open_memmap(output_paths[index], mode='w+', dtype=output_dtype,
+                                                                              shape=(num_of_samples, img_encoders.size(1)))
+                            all_img_encoders[index] = torch.from_numpy(output_memmaps[index])
+                        else:
+                            all_img_encoders[index] = torch.empty(num_of_samples, img_encoders.size(1), dtype=img_encoders.dtype, device=DEVICE)
+
+                # Write results by offset
+                data_img_encoders = all_img_encoders[index]
+                data_img_encoders[offset:offset + batch_size] = img_encoders.to(data_img_encoders.device, data_img_encoders.dtype)
+
+            data_labels[offset:offset + batch_size] = labels.cpu()
+            offset += batch_size
+
+    assert(offset == num_of_samples), "Dataloader yielded a different number of samples than expected"
+    for output_memmap in output_memmaps:
+        if output_memmap is not None:
+            output_memmap.flush()
+
+    if verbose:
+        elapsed_time = perf_counter() - start_time
+        print(f"Computed {num_of_samples} representations with {len(encoders)} encoders in {elapsed_time:.1f} sec "
+              f"({num_of_samples / elapsed_time:.1f} images/sec)")
+
+    return all_img_encoders, data_labels
+
+def compute_images_representations(dataloader, encoder, output_path=None, output_dtype=np.float32, verbose=True, should_stop=None):
+    all_img_encoders, data_labels = compute_multi_encoder_representations(dataloader, [encoder], [output_path], output_dtype, verbose, should_stop)
+    return (None, None) if all_img_encoders is None else (all_img_encoders[0], data_labels)
+
+def get_multi_encoder_representations(encoders, store, dtype=EMBEDDING_CACHE_DTYPE, return_cache_keys=False):
+    # Cache key of each encoder weights, the dataset split and the transform that produces the encoder inputs
+    transform = test_transform if store.name == 'cifar10' else transforms.Compose([*mnist_to_cifar10_format.transforms, *test_transform.transforms])
+    cache_keys = [hashlib.sha256(f"{hash_model_weights(encoder)}|{store.name}|{store.is_train}|{transform}|{dtype}".encode('utf-8')).hexdigest()
+                  for encoder in encoders]
+    reps_paths = [os.path.join(EMBEDDING_CACHE_DIR, f"{cache_key}_reps.npy") for cache_key in cache_keys]
+    labels_path = os.path.join(EMBEDDING_CACHE_DIR, f"{store.name}_{'train' if store.is_train else 'test'}_labels.npy")
+
+    # Compute the representations of all the missing encoders in a single pass, write to temporary files and rename
+    missing_indices = [index for index, reps_path in enumerate(reps_paths) if not os.path.exists(reps_path)]
+    missing_indices = list({reps_paths[index]: index for index in missing_indices}.values())
+    if len(missing_indices) > 0 or not os.path.exists(labels_path):
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        dataloader = ImageStoreLoader(store, batch_size=BATCH_SIZE, shuffle=False)
+        missing_encoders = [encoders[index] for index in missing_indices]
+        missing_paths = [reps_paths[index] + '.tmp.npy' for index in missing_indices]
+        if len(missing_encoders) > 0:
+            _, data_labels = compute_multi_encoder_representations(dataloader, missing_encoders, missing_paths, np.dtype(dtype))
+        else:
+            data_labels = torch.from_numpy(np.array(store.labels))
+        np.save(labels_path + '.tmp.npy', data_labels.numpy())
+        for index in missing_indices:
+            os.replace(reps_paths[index] + '.tmp.npy', reps_paths[index])
+        os.replace(labels_path + '.tmp.npy', labels_path)
+
+    # Map the cached representations as CPU tensors in their cache dtype, without reading or copying them (copy-on-write,
+    # so the cache files are never modified). The consumers convert the dtype and device where they need to
+    all_img_encoders = [torch.from_numpy(np.load(reps_path, mmap_mode='c')) for reps_path in reps_paths]
+    data_labels = torch.from_numpy(np.load(labels_path))
+
+    # The cache keys identify the representations sets, e.g. for keying the indexes built over them
+    if return_cache_keys:
+        return all_img_encoders, data_labels, cache_keys
+    return all_img_encoders, data_labels
+
+def get_images_representations(encoder, store, dtype=EMBEDDING_CACHE_DTYPE):
+    all_img_encoders, data_labels = get_multi_encoder_representations([encoder], store, dtype)
+    return all_img_encoders[0], data_labels
 
 def map_and_present_plot(data_encoder_reps, data_labels, method, use_CIFAR10_labels_bools, title, centers=None):
     # Validate method parameter
@@ -560,7 +1587,7 @@ def map_and_present_plot(data_encoder_reps, data_labels, method, use_CIFAR10_lab
 
     # Prepare data representations to fit
     if centers is not None:
-        data_to_fit = torch.cat([centers, data_encoder_reps], dim=0)
+        data_to_fit = torch.cat([centers.cpu().float(), data_encoder_reps.cpu().float()], dim=0)
     else:
         data_to_fit = data_encoder_reps
 
@@ -589,13 +1616,11 @@ def map_and_present_plot(data_encoder_reps, data_labels, method, use_CIFAR10_lab
     title = f"{title} - 2D plot using {method} method"
 
     # Plot the new representations in 2D space
-    plot_2d_samples(samples=data_encoder_reps_2d, labels=data_labels_np, use_CIFAR10_labels_bools=use_CIFAR10_labels_bools, centers=centers_2d ,title=title)
+    plot_2d_samples(samples=data_encoder_reps_2d, labels=data_labels_np, use_CIFAR10_labels_bools=use_CIFAR10_labels_bools, centers=centers_2d ,title=title, rasterize=True)
 
 
-# Load CIFAR10 test dataset without augmentations
-test_loader = create_CIFAR10_dataloader(is_train=False, use_augmentations=False)
-# Compute new Encoder representation given to each image in the dataset
-data_encoder_reps, data_labels = compute_images_representations(test_loader, encoder_q1)
+# Compute (or load the cached) new Encoder representation given to each image in the CIFAR10 test dataset
+data_encoder_reps, data_labels = get_images_representations(encoder_q1, get_image_store('cifar10', is_train=False))
 # Map and plot representation to 2D space using PCA and T-SNE methods
 title="VICReg's encoder representations (S3.Q1., with generated neighbors)"
 map_and_present_plot(data_encoder_reps, data_labels, method='PCA', use_CIFAR10_labels_bools=[True], title=title)
@@ -603,12 +1628,15 @@ map_and_present_plot(data_encoder_reps, data_labels, method='TSNE', use_CIFAR10_
 
 """**Question 3**"""
 
-def train_LinearProber(encoder, num_epochs=LP_NUM_OF_EPOCHS, lr=LEARNING_RATE, betas=BETAS, weight_decay=WEIGHT_DECAY):
+def train_LinearProber(encoder, num_epochs=LP_NUM_OF_EPOCHS, lr=LEARNING_RATE, betas=BETAS, weight_decay=WEIGHT_DECAY,
+                       use_bf16=False, channels_last=False, compile_step=False):
     # Get CIFAR10 train data-loader without augmentations
     train_loader = create_CIFAR10_dataloader(is_train=True, use_augmentations=False)
 
     # Initiate Linear prober model
     lp_model = LinearProber(encoder=encoder, D=ENCODER_DIM).to(DEVICE)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    lp_model = lp_model.to(memory_format=memory_format)
 
     # Freeze encoder's parameters
     for param in lp_model.encoder.parameters():
@@ -622,20 +1650,26 @@ def train_LinearProber(encoder, num_epochs=LP_NUM_OF_EPOCHS, lr=LEARNING_RATE, b
     optimizer = optim.Adam(lp_model.parameters(), lr=lr, betas=betas, weight_decay=weight_decay)
     criterion = nn.CrossEntropyLoss()
 
+    # Predict the labels, optionally under bf16 autocast and compiled, and compute the loss in fp32
+    def compute_step_loss(images, labels):
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16, enabled=use_bf16):
+            pred_labels = lp_model(images)
+        return criterion(pred_labels.float(), labels)
+
+    if compile_step:
+        compute_step_loss = torch.compile(compute_step_loss)
+
     # Train the model
     for epoch in range(num_epochs):
         print(f"Train: Epoch {epoch + 1}")
 
         for images, labels in tqdm(train_loader):
             # Get images and labels batches and move them to DEVICE
-            images = images.to(DEVICE)
+            images = images.to(DEVICE, memory_format=memory_format)
             labels = labels.to(DEVICE)
 
-            # Use the model to predict the images's labels
-            pred_labels = lp_model(images)
-
-            # Compute the loss using the criterion
-            loss = criterion(pred_labels, labels)
+            # Use the model to predict the images's labels and compute the loss using the criterion
+            loss = compute_step_loss(images, labels)
 
             # Zero the parameter gradients
             optimizer.zero_grad()
@@ -699,14 +1733,11 @@ projector_q4 = Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM).to(DEVICE)
 vicreg_q4 = VICReg(encoder_q4, projector_q4).to(DEVICE)
 
 # Train the VICReg model
-train_VICReg(vicreg_model=vicreg_q4, train_loader=train_loader, mu=0., evaluate=False)
+train_VICReg(vicreg_model=vicreg_q4, train_loader=train_loader, mu=0., evaluate=False, checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'vicreg_q4.pt')))
 
 # Stage 2: Perform PCA visualization like in Q2
-# Load CIFAR10 test dataset without augmentations
-test_loader = create_CIFAR10_dataloader(is_train=False, use_augmentations=False)
-
-# Compute new encoder representation given to each image in the dataset
-data_img_encoders, data_labels = compute_images_representations(test_loader, encoder_q4)
+# Compute (or load the cached) new encoder representation given to each image in the CIFAR10 test dataset
+data_img_encoders, data_labels = get_images_representations(encoder_q4, get_image_store('cifar10', is_train=False))
 
 # Map and plot representation into 2D space using PCA method
 title="VICReg's encoder representations (S3.Q4., using generated neighbors and no variance objective)"
@@ -723,7 +1754,11 @@ print(f"Linear prober accuracy using VICReg's encoder representations (S3.Q4., w
 
 """**Question 5**"""
 
-def find_k_nearest_neighbors(samples_tensor, query_vectors, k, query_vectors_in_samples=False):
+# Exact index manager used by default, it keeps the indexes of the last embeddings sets in memory (and persists them
+# when FAISS_INDEX_DIR is set)
+exact_index_manager = FaissIndexManager(index_type='flat', index_dir=FAISS_INDEX_DIR)
+
+def find_k_nearest_neighbors(samples_tensor, query_vectors, k, query_vectors_in_samples=False, index_manager=None, index_id=None, query_indices=None):
     # Validate parameters
     assert(k <= samples_tensor.size(0))
     assert(samples_tensor.size(1) == query_vectors.size(1))
@@ -731,21 +1766,21 @@ def find_k_nearest_neighbors(samples_tensor, query_vectors, k, query_vectors_in_
     # Get the number of samples
     num_of_samples = samples_tensor.size(0)
 
-    # Convert tensors to numpy arrays and ensure they are float32
-    samples_np = samples_tensor.cpu().detach().numpy().astype(np.float32)
-    query_vectors_np = query_vectors.cpu().detach().numpy().astype(np.float32)
-
-    # Step 1: Build a FAISS L2 index
-    index = faiss.IndexFlatL2(samples_np.shape[1])
-    index.add(samples_np)
+    # Step 1 + 2: Get the FAISS index of the samples (built once per samples set, keyed by index_id when given) and query it to find the nearest neighbors
+    index_manager = exact_index_manager if index_manager is None else index_manager
+    distances, indices = index_manager.search(samples_tensor, query_vectors, k+1, index_id)
 
-    # Step 2: Query the index to find the nearest neighbors
-    distances, indices = index.search(query_vectors_np, k+1)
-
-    # Exclude result of the query vector if they already included in the samples_tensor
+    # Exclude the query vectors from their results by index if they are included in the samples_tensor (query_indices are their
+    # rows in the samples_tensor, by default the queries are the samples themselves), so duplicated samples are still neighbors
     if query_vectors_in_samples:
-        indices = indices[:, 1:]
-        distances = distances[:, 1:]
+        if query_indices is None:
+            assert(query_vectors.size(0) == num_of_samples), "Query indices must be given unless the queries are the samples themselves"
+            query_indices = np.arange(num_of_samples)
+        is_self = indices == np.asarray(query_indices).reshape(-1, 1)
+        # Stable sort moves the self match (if found) to the end of each row, keeping the order of the other results
+        order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+        indices = np.take_along_axis(indices, order, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
     else:
         indices = indices[:, :k]
         distances = distances[:, :k]
@@ -757,34 +1792,73 @@ def find_k_nearest_neighbors(samples_tensor, query_vectors, k, query_vectors_in_
     return distances, indices
 
 
+def knn_self_join(embeddings, k, query_block_size=2048, database_block_size=8192):
+    # Find the k nearest neighbors of every embedding among all the other embeddings (exact, squared L2 distances).
+    # Query blocks are compared against database blocks using ||q||^2 + ||x||^2 - 2<q, x>, keeping a running top-k
+    # per query row, so the memory is O(query_block_size * database_block_size) for any number of rows. The blocks run
+    # one after another, each block operation already uses all of torch's intra-op threads.
+    # Self matches are excluded by index, so duplicated embeddings are still found as neighbors of each other
+    embeddings = embeddings.detach().float()
+    num_of_samples = embeddings.size(0)
+    assert(k < num_of_samples), "k must be smaller than the number of embeddings"
+
+    squared_norms = torch.sum(torch.pow(embeddings, 2), dim=1)
+    all_distances = torch.empty(num_of_samples, k, device=embeddings.device)
+    all_indices = torch.empty(num_of_samples, k, dtype=torch.int64, device=embeddings.device)
+
+    # Inference mode is thread-local, so it is entered here, in the thread running the join
+    @torch.inference_mode()
+    def join_query_block(query_start):
+        query_end = min(query_start + query_block_size, num_of_samples)
+        queries = embeddings[query_start:query_end]
+        best_distances = torch.full((query_end - query_start, k), float('inf'), device=embeddings.device)
+        best_indices = torch.full((query_end - query_start, k), -1, dtype=torch.int64, device=embeddings.device)
+
+        for database_start in range(0, num_of_samples, database_block_size):
+            database_end = min(database_start + database_block_size, num_of_samples)
+            distances = squared_norms[query_start:query_end].unsqueeze(dim=1) + squared_norms[database_start:database_end].unsqueeze(dim=0) \
+                        - 2 * queries @ embeddings[database_start:database_end].T
+            distances.clamp_(min=0)
+
+            # Exclude the self matches of the rows shared by the query and database blocks
+            overlap = torch.arange(max(query_start, database_start), min(query_end, database_end), device=embeddings.device)
+            distances[overlap - query_start, overlap - database_start] = float('inf')
+
+            # Merge the block into the running top-k
+            database_indices = torch.arange(database_start, database_end, device=embeddings.device).expand(query_end - query_start, -1)
+            best_distances, positions = torch.topk(torch.cat([best_distances, distances], dim=1), k, dim=1, largest=False, sorted=True)
+            best_indices = torch.gather(torch.cat([best_indices, database_indices], dim=1), 1, positions)
+
+        all_distances[query_start:query_end] = best_distances
+        all_indices[query_start:query_end] = best_indices
+
+    for query_start in range(0, num_of_samples, query_block_size):
+        join_query_block(query_start)
+
+    return all_distances, all_indices
+
+
 def create_CIFAR10_dataloader_using_knn(encoder, is_train):
     # Move encoder to DEVICE and set its mode to evaliation
     encoder = encoder.to(DEVICE)
     encoder.eval()
 
-    # Create dataset
-    orginal_dataset = CIFAR10(root='./data', train=is_train, transform=test_transform, download=True)
-    orginal_dataloader = DataLoader(orginal_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
-    number_of_samples = len(orginal_dataset)
+    # Get the images store
+    store = get_image_store('cifar10', is_train)
+    number_of_samples = len(store)
 
-    # Compute the encoder representation of each image in the dataset
-    data_img_encoder_reps, _ = compute_images_representations(orginal_dataloader, encoder)
+    # Compute (or load the cached) encoder representation of each image in the dataset
+    data_img_encoder_reps, _ = get_images_representations(encoder, store)
 
     # Find the three nearest neighbors for each encoder representraion in the dataset
-    _, nearest_neighbors_indices = find_k_nearest_neighbors(samples_tensor=data_img_encoder_reps, query_vectors=data_img_encoder_reps, k=3, query_vectors_in_samples=True) # size (number_of_samples, 3)
+    _, nearest_neighbors_indices = knn_self_join(data_img_encoder_reps.to(DEVICE), k=3) # size (number_of_samples, 3)
 
     # Randomly select one neighbor index for each sample in the dataset
     random_indices = torch.randint(0, 3, (number_of_samples, )).unsqueeze(dim=1).to(DEVICE)
     selected_neighbors_indices = torch.gather(nearest_neighbors_indices, 1, random_indices).squeeze(dim=1) #size (number_of_samples)
 
-    # Create neighbors dataset according to the selected indices
-    neighbors_dataset = Subset(dataset=orginal_dataset, indices=selected_neighbors_indices.cpu().tolist())
-
-    # Combine orginal and neighbors datasets
-    combined_dataset = CombinedDataset(orginal_dataset, neighbors_dataset)
-
-    # Create a dataloader
-    neighbors_dataloader = DataLoader(combined_dataset, batch_size=BATCH_SIZE, shuffle=is_train, num_workers=4)
+    # Create a dataloader which pairs each image with its selected neighbor
+    neighbors_dataloader = NeighborPairsLoader(store, selected_neighbors_indices.cpu().numpy(), batch_size=BATCH_SIZE, shuffle=is_train)
 
     return neighbors_dataloader
 
@@ -798,8 +1872,12 @@ encoder_q5 = Encoder(D=ENCODER_DIM, device=DEVICE).to(DEVICE)
 projector_q5 = Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM).to(DEVICE)
 vicreg_q5 = VICReg(encoder_q5, projector_q5)
 
+# Optionally let the encoder being trained re-mine its own neighbor pairs every NEIGHBOR_MINING_EVERY steps
+neighbor_miner = NeighborMiner(neighbors_dataloader, mine_every=NEIGHBOR_MINING_EVERY) if NEIGHBOR_MINING_EVERY is not None else None
+
 # Train the VICReg model
-train_VICReg(vicreg_model=vicreg_q5, train_loader=neighbors_dataloader, num_epochs=1, evaluate=False)
+train_VICReg(vicreg_model=vicreg_q5, train_loader=neighbors_dataloader, num_epochs=1, evaluate=False, neighbor_miner=neighbor_miner,
+             checkpoint_manager=CheckpointManager(os.path.join(CHECKPOINT_DIR, 'vicreg_q5.pt')))
 
 # Stage 2: Perform linear probing like in Q3
 # Train linear pober model
@@ -855,86 +1933,160 @@ def find_k_distant_neighbors(samples_tensor, query_vectors, k):
     return distances, indices
 
 
+class FarthestNeighborIndex:
+    # Exact k farthest neighbors search. With c the samples centroid, p the projections of (x - c) on the top PCA
+    # directions and r the norms of the residuals outside them, Cauchy-Schwarz on the residuals gives the upper bound
+    #   ||q - x||^2 <= ||q - c||^2 + ||x - c||^2 - 2<p_q, p_x> + 2 r_q r_x
+    # The exact distances to a small precomputed pool of extreme points (the extremes along each direction and the
+    # points farthest from the centroid) give a lower bound on the k-th farthest distance, so only the samples whose
+    # upper bound reaches it need their exact distance computed
+    def __init__(self, samples_tensor, num_of_directions=16, pool_size=256):
+        self.samples = samples_tensor.detach().to(DEVICE, torch.float32)
+        self.centroid = self.samples.mean(dim=0)
+        centered_samples = self.samples - self.centroid
+
+        # Project the samples on their top PCA directions
+        num_of_directions = min(num_of_directions, self.samples.size(1), self.samples.size(0))
+        _, _, self.directions = torch.pca_lowrank(centered_samples, q=num_of_directions, center=False)
+        self.projections = centered_samples @ self.directions
+        self.centered_squared_norms = torch.sum(torch.pow(centered_samples, 2), dim=1)
+        self.residual_norms = torch.sqrt(torch.clamp(self.centered_squared_norms - torch.sum(torch.pow(self.projections, 2), dim=1), min=0))
+
+        # Precompute the candidates pool
+        per_direction = max(1, pool_size // (3 * num_of_directions))
+        per_direction = min(per_direction, self.samples.size(0))
+        self.pool_indices = torch.unique(torch.cat([
+            torch.topk(self.projections, per_direction, dim=0).indices.flatten(),
+            torch.topk(-self.projections, per_direction, dim=0).indices.flatten(),
+            torch.topk(self.centered_squared_norms, min(pool_size // 3, self.samples.size(0))).indices]))
+
+    def search(self, query_vectors, k, queries_chunk_size=1024):
+        assert(k <= self.pool_indices.size(0)), "k must not be larger than the candidates pool"
+        query_vectors = query_vectors.detach().float().to(self.samples.device)
+        all_distances, all_indices = [], []
+        self.num_of_exact_distances = 0
+
+        for start in range(0, query_vectors.size(0), queries_chunk_size):
+            queries = query_vectors[start:start + queries_chunk_size]
+            centered_queries = queries - self.centroid
+            queries_projections = centered_queries @ self.directions
+            queries_centered_squared_norms = torch.sum(torch.pow(centered_queries, 2), dim=1)
+            queries_residual_norms = torch.sqrt(torch.clamp(queries_centered_squared_norms - torch.sum(torch.pow(queries_projections, 2), dim=1), min=0))
+
+            # Lower bound of the k-th farthest distance from the exact distances to the pool
+            pool_distances = torch.cdist(queries, self.samples[self.pool_indices], compute_mode='donot_use_mm_for_euclid_dist').pow(2)
+            kth_farthest_lower_bound = torch.topk(pool_distances, k, dim=1).values[:, -1]
+
+            # Upper bounds of the distances to all the samples, with a small tolerance for rounding errors
+            upper_bounds = queries_centered_squared_norms.unsqueeze(dim=1) + self.centered_squared_norms.unsqueeze(dim=0) \
+                           - 2 * queries_projections @ self.projections.T + 2 * queries_residual_norms.unsqueeze(dim=1) * self.residual_norms.unsqueeze(dim=0)
+            candidates_mask = upper_bounds * (1 + 1e-5) + 1e-5 >= kth_farthest_lower_bound.unsqueeze(dim=1)
+
+            # Exact distances to the remaining candidates of each query
+            for query, query_candidates_mask in zip(queries, candidates_mask):
+                candidates_indices = torch.nonzero(query_candidates_mask).squeeze(dim=1)
+                candidates_distances = torch.sum(torch.pow(self.samples[candidates_indices] - query, 2), dim=1)
+                distances, positions = torch.topk(candidates_distances, k)
+                all_distances.append(distances)
+                all_indices.append(candidates_indices[positions])
+                self.num_of_exact_distances += candidates_indices.size(0)
+
+        return torch.stack(all_distances, dim=0), torch.stack(all_indices, dim=0)
+
+
+# Farthest neighbor indexes of the last embeddings sets, keyed by their embedding cache key
+farthest_neighbor_indexes = {}
+
+def get_farthest_neighbor_index(samples_tensor, index_id, max_cached_indexes=4):
+    # Build the index (PCA projections and candidates pool) once per embeddings set
+    if index_id in farthest_neighbor_indexes:
+        return farthest_neighbor_indexes[index_id]
+
+    # Keep only the most recently built indexes in memory
+    if len(farthest_neighbor_indexes) >= max_cached_indexes:
+        farthest_neighbor_indexes.pop(next(iter(farthest_neighbor_indexes)))
+    farthest_neighbor_indexes[index_id] = FarthestNeighborIndex(samples_tensor)
+    return farthest_neighbor_indexes[index_id]
+
+
 def select_classes_images(is_train=False):
-    # Get CIFAR10 train dataset without augmentations
-    dataset = CIFAR10(root='./data', train=is_train, transform=test_transform, download=True)
+    # Get CIFAR10 images store
+    store = get_image_store('cifar10', is_train)
 
     # Shuffle samples selections
-    shuffled_dataset_indices = np.arange(len(dataset))
+    shuffled_dataset_indices = np.arange(len(store))
     np.random.shuffle(shuffled_dataset_indices)
 
-    # Initiate dictionary
+    # Select the first shuffled image of each class
     labels = list(range(NUM_OF_CLASSES))
-    selected_images = {}
+    shuffled_labels = store.labels[shuffled_dataset_indices]
+    selected_indices = [shuffled_dataset_indices[np.argmax(shuffled_labels == label)] for label in labels]
 
-    for index in shuffled_dataset_indices:
-        image, label = dataset[shuffled_dataset_indices[index]]
-        if label not in selected_images.keys():
-            selected_images[label] = image.unsqueeze(dim=0)
-            if len(selected_images.keys()) == NUM_OF_CLASSES:
-                break
+    # Gather all the selected images at once
+    selected_images_tensor, _ = store.gather(selected_indices)
 
-    image_list = [selected_images[label].to(DEVICE) for label in range(NUM_OF_CLASSES)]
-    selected_images_tensor = torch.cat(image_list, dim=0).to(DEVICE)
+    return labels, selected_images_tensor, np.asarray(selected_indices)
 
-    return labels, selected_images_tensor
 
+def find_images_neighbors_using_knn(store, encoders, selected_images_tensor, selected_indices, distant=False):
+    # Accept a single encoder or a list of encoders, whose representations are computed in a single pass
+    single_encoder = isinstance(encoders, nn.Module)
+    encoders = [encoders] if single_encoder else encoders
 
-def find_images_neighbors_using_knn(dataset, encoder, selected_images_tensor, distant=False):
-    # Set encoder mode to evaluation
-    encoder = encoder.eval()
+    # Set encoders mode to evaluation
+    for encoder in encoders:
+        encoder.eval()
 
-    # Initiate global lists
+    # Get the number of selected images
     number_of_selected_images = selected_images_tensor.size(0)
-    all_neighbors_list = []
-
-    # Compute the encoder representations of the images in the datasets
-    dataloader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
-    data_img_encoder_reps, _ = compute_images_representations(dataloader, encoder)
 
-    # Compute the encoder representations of the selected images
-    selected_img_encoder_reps = encoder(selected_images_tensor)
+    # Compute (or load the cached) encoders representations of the images in the datasets
+    all_img_encoder_reps, _, reps_cache_keys = get_multi_encoder_representations(encoders, store, return_cache_keys=True)
 
-    # Find the 5 nearest/distant neighbors for each encoder representraion in the dataset
-    if distant:
-        _, neighbors_indices = find_k_distant_neighbors(samples_tensor=data_img_encoder_reps, query_vectors=selected_img_encoder_reps, k=5) # size (number_of_samples, 5)
-    else:
-        _, neighbors_indices = find_k_nearest_neighbors(samples_tensor=data_img_encoder_reps, query_vectors=selected_img_encoder_reps, k=5, query_vectors_in_samples=True) # size (number_of_samples, 5)
+    all_neighbors_tensors = []
+    for encoder, data_img_encoder_reps, reps_cache_key in zip(encoders, all_img_encoder_reps, reps_cache_keys):
+        # Compute the encoder representations of the selected images
+        with torch.inference_mode():
+            selected_img_encoder_reps = encoder(selected_images_tensor)
 
-    # Build neighbors tensor for each selected images
-    for i in range(number_of_selected_images):
-        neighbors_images = [dataset[j][0].unsqueeze(dim=0) for j in neighbors_indices[i]]
-        neighbors_images_tensor = torch.cat(neighbors_images, dim=0).unsqueeze(0)
-        all_neighbors_list.append(neighbors_images_tensor)
+        # Find the 5 nearest/distant neighbors for each encoder representraion in the dataset
+        if distant:
+            _, neighbors_indices = get_farthest_neighbor_index(data_img_encoder_reps, reps_cache_key).search(selected_img_encoder_reps, k=5) # size (number_of_samples, 5)
+        else:
+            _, neighbors_indices = find_k_nearest_neighbors(samples_tensor=data_img_encoder_reps, query_vectors=selected_img_encoder_reps, k=5, query_vectors_in_samples=True,
+                                                            index_id=reps_cache_key, query_indices=selected_indices) # size (number_of_samples, 5)
 
-    # Concatenate global lists into tensors
-    all_neighbors_tensor = torch.cat(all_neighbors_list, dim=0)
+        # Gather the neighbors images of all selected images at once
+        all_neighbors_tensor, _ = store.gather(neighbors_indices.flatten())
+        all_neighbors_tensors.append(all_neighbors_tensor.view(number_of_selected_images, neighbors_indices.size(1), *all_neighbors_tensor.shape[1:]))
 
-    return all_neighbors_tensor
+    return all_neighbors_tensors[0] if single_encoder else all_neighbors_tensors
 
 
-# Load train dataloader without augmentations
-train_dataset = CIFAR10(root='./data', train=True, transform=test_transform, download=True)
+# Get the train images store (normalized like test_transform when gathered)
+train_dataset = get_image_store('cifar10', is_train=True)
 
 # Select 10 random images from the training set, one from each class
-labels, selected_images_tensor = select_classes_images(is_train=True)
+labels, selected_images_tensor, selected_indices = select_classes_images(is_train=True)
 
 # For each selected image, use encoder representations to find its five nearest neighbors in the dataset
-nearest_neighbors_q1 = find_images_neighbors_using_knn(train_dataset, encoder_q1, selected_images_tensor, distant=False)
-nearest_neighbors_q5 = find_images_neighbors_using_knn(train_dataset, encoder_q5, selected_images_tensor, distant=False)
+nearest_neighbors_q1, nearest_neighbors_q5 = find_images_neighbors_using_knn(train_dataset, [encoder_q1, encoder_q5], selected_images_tensor, selected_indices, distant=False)
 
 # Plot the images together with their nearest neighbors
 present_neighbors_images(labels, selected_images_tensor, nearest_neighbors_q1, title="Five nearest neighbors for VICReg's encoder representations (S3.Q1., with generated neighbors)")
 present_neighbors_images(labels, selected_images_tensor, nearest_neighbors_q5, title="Five nearest neighbors for VICReg's encoder representations (S3.Q5., without generated neighbors)")
 
 # For each selected image, use encoder representations to find its five distant neighbors in the dataset
-distant_neighbors_q1 = find_images_neighbors_using_knn(train_dataset, encoder_q1, selected_images_tensor, distant=True)
-distant_neighbors_q5 = find_images_neighbors_using_knn(train_dataset, encoder_q5, selected_images_tensor, distant=True)
+distant_neighbors_q1, distant_neighbors_q5 = find_images_neighbors_using_knn(train_dataset, [encoder_q1, encoder_q5], selected_images_tensor, selected_indices, distant=True)
 
 # Plot the images together with their distant neighbors
 present_neighbors_images(labels, selected_images_tensor, distant_neighbors_q1, title="Five distant neighbors using VICReg's encoder representations (S3.Q1., with generated neighbors):s")
 present_neighbors_images(labels, selected_images_tensor, distant_neighbors_q5, title="Five distant neighbors for VICReg's encoder representations (S3.Q5., without generated neighbors)")
 
+# Save the encoders as memory-mapped artifacts, so downstream jobs can load them without retraining
+save_model_artifact(encoder_q1, os.path.join(MODEL_ARTIFACTS_DIR, 'encoder_q1.bin'))
+save_model_artifact(encoder_q5, os.path.join(MODEL_ARTIFACTS_DIR, 'encoder_q5.bin'))
+
 """# **Section 4 - Downstream Applications**
 
 ## **4.1 - Anomaly Detection**
@@ -949,44 +2101,42 @@ mnist_test_transform = transforms.Compose([
     *test_transform.transforms # Use test_transform for CIFAR10 images
 ])
 
-def compute_density_estimtion(cifar10_dataset, minst_dataset, encoder, k):
-    # Create CIFAR10 train dataloaders
-    cifar10_train_loader = create_CIFAR10_dataloader(is_train=True, use_augmentations=False)
-
-    # Create test dataloader for CIFAR10 and MNIST datasets
-    cifar10_test_loader = DataLoader(cifar10_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
-    minst_test_loader = DataLoader(minst_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
-
-    # Compute encoder presentations for each dataloader
-    cifar10_train_encoder_reps, _ = compute_images_representations(cifar10_train_loader, encoder)
-    cifar10_test_encoder_reps, _ = compute_images_representations(cifar10_test_loader, encoder)
-    mnist_test_encoder_reps, _ = compute_images_representations(minst_test_loader, encoder)
+def compute_density_estimtion(cifar10_dataset, minst_dataset, encoders, k):
+    # Compute (or load the cached) encoders presentations for the CIFAR10 train and test and the MNIST test image stores,
+    # each store is passed once for all the encoders
+    all_cifar10_train_encoder_reps, _, cifar10_train_cache_keys = get_multi_encoder_representations(encoders, get_image_store('cifar10', is_train=True), return_cache_keys=True)
+    all_cifar10_test_encoder_reps, _ = get_multi_encoder_representations(encoders, cifar10_dataset)
+    all_mnist_test_encoder_reps, _ = get_multi_encoder_representations(encoders, minst_dataset)
 
-    # Compute the (square) L2 distances of the 2 nearest neighbors of each test sample
-    cifar10_test_distances, _ = find_k_nearest_neighbors(samples_tensor=cifar10_train_encoder_reps, query_vectors=cifar10_test_encoder_reps, k=k, query_vectors_in_samples=False)
-    mnist_test_distances, _ = find_k_nearest_neighbors(samples_tensor=cifar10_train_encoder_reps, query_vectors=mnist_test_encoder_reps, k=k, query_vectors_in_samples=False)
+    density_estimations = []
+    for cifar10_train_encoder_reps, cifar10_train_cache_key, cifar10_test_encoder_reps, mnist_test_encoder_reps in \
+            zip(all_cifar10_train_encoder_reps, cifar10_train_cache_keys, all_cifar10_test_encoder_reps, all_mnist_test_encoder_reps):
+        # Compute the (square) L2 distances of the 2 nearest neighbors of each test sample, using the index of the train representations
+        cifar10_test_distances, _ = find_k_nearest_neighbors(samples_tensor=cifar10_train_encoder_reps, query_vectors=cifar10_test_encoder_reps, k=k, query_vectors_in_samples=False,
+                                                             index_id=cifar10_train_cache_key)
+        mnist_test_distances, _ = find_k_nearest_neighbors(samples_tensor=cifar10_train_encoder_reps, query_vectors=mnist_test_encoder_reps, k=k, query_vectors_in_samples=False,
+                                                           index_id=cifar10_train_cache_key)
 
-    # Compute the density estimation for each test sample
-    cifar10_test_density_estimation = (1 / k) * torch.sum(torch.sqrt(cifar10_test_distances), dim=1)
-    mnist_test_density_estimation = (1 / k) * torch.sum(torch.sqrt(mnist_test_distances), dim=1)
+        # Compute the density estimation for each test sample
+        cifar10_test_density_estimation = (1 / k) * torch.sum(torch.sqrt(cifar10_test_distances), dim=1)
+        mnist_test_density_estimation = (1 / k) * torch.sum(torch.sqrt(mnist_test_distances), dim=1)
+        density_estimations.append((cifar10_test_density_estimation, mnist_test_density_estimation))
 
-    return cifar10_test_density_estimation, mnist_test_density_estimation
+    return density_estimations
 
 
 # Set the number of desired neighbors
 number_of_neighbors = 2
 
-# Creates datasets (initiate those datasets here to be used by Q3)
-cifar10_test_dataset = CIFAR10(root='./data', train=False, transform=test_transform, download=True)
-minst_test_dataset = MNIST(root='./data', train=False, transform=mnist_test_transform, download=True)
+# Get the test images stores (initiate those stores here to be used by Q3), MNIST images are stored after
+# the first part of mnist_test_transform and normalized like CIFAR10 images when gathered
+cifar10_test_dataset = get_image_store('cifar10', is_train=False)
+minst_test_dataset = get_image_store('mnist', is_train=False)
 
 # Compute the density estimation for VICReg's encoder representations (S3.Q1., with generated neighbors)
-cifar10_test_de_q1, mnist_test_de_q1 =  compute_density_estimtion(cifar10_dataset=cifar10_test_dataset, minst_dataset=minst_test_dataset,
-                                                                  encoder=encoder_q1, k=number_of_neighbors)
-
-# Compute the density estimation for VICReg's encoder representations (S3.Q5., without generated neighbors)
-cifar10_test_de_q5, mnist_test_de_q5 =  compute_density_estimtion(cifar10_dataset=cifar10_test_dataset, minst_dataset=minst_test_dataset,
-                                                                  encoder=encoder_q5, k=number_of_neighbors)
+# and (S3.Q5., without generated neighbors), passing each dataset once for both encoders
+(cifar10_test_de_q1, mnist_test_de_q1), (cifar10_test_de_q5, mnist_test_de_q5) = compute_density_estimtion(cifar10_dataset=cifar10_test_dataset, minst_dataset=minst_test_dataset,
+                                                                                                           encoders=[encoder_q1, encoder_q5], k=number_of_neighbors)
 
 """**Question 2**"""
 
@@ -1025,26 +2175,23 @@ _, most_anomalous_q1_indices = torch.topk(density_estimations_q1, k=7, largest=T
 # Find the most anomalous images using VICReg's encoder representations (S3.Q5., without generated neighbors)
 _, most_anomalous_q5_indices = torch.topk(density_estimations_q5, k=7, largest=True)
 
-most_anomalous_q1_imgs = []
-most_anomalous_q5_imgs = []
+# Gather the most anomalous images, indices after the CIFAR10 images belong to MNIST images
+def gather_anomalous_images(most_anomalous_indices):
+    most_anomalous_indices = most_anomalous_indices.cpu()
+    is_mnist = most_anomalous_indices >= number_of_cifar10_images
+    images = torch.empty(most_anomalous_indices.size(0), 3, 32, 32, device=DEVICE)
+    if (~is_mnist).any():
+        images[~is_mnist], _ = cifar10_test_dataset.gather(most_anomalous_indices[~is_mnist])
+    if is_mnist.any():
+        images[is_mnist], _ = minst_test_dataset.gather(most_anomalous_indices[is_mnist] - number_of_cifar10_images)
+    return images
 
-for i in range(7):
-    index_q1 = most_anomalous_q1_indices[i]
-    index_q5 = most_anomalous_q5_indices[i]
-
-    if index_q1 > number_of_cifar10_images:
-        most_anomalous_q1_imgs.append(minst_test_dataset[index_q1 - number_of_cifar10_images][0].unsqueeze(dim=0).to(DEVICE))
-    else:
-        most_anomalous_q1_imgs.append(cifar10_test_dataset[index_q1][0].unsqueeze(dim=0).to(DEVICE))
-
-    if index_q5 > number_of_cifar10_images:
-        most_anomalous_q5_imgs.append(minst_test_dataset[index_q5 - number_of_cifar10_images][0].unsqueeze(dim=0).to(DEVICE))
-    else:
-        most_anomalous_q5_imgs.append(cifar10_test_dataset[index_q5][0].unsqueeze(dim=0).to(DEVICE))
+most_anomalous_q1_imgs = gather_anomalous_images(most_anomalous_q1_indices)
+most_anomalous_q5_imgs = gather_anomalous_images(most_anomalous_q5_indices)
 
 # Create a tensor of images
-images_q1 = torch.cat(most_anomalous_q1_imgs, dim=0).unsqueeze(dim=0)
-images_q5 = torch.cat(most_anomalous_q5_imgs, dim=0).unsqueeze(dim=0)
+images_q1 = most_anomalous_q1_imgs.unsqueeze(dim=0)
+images_q5 = most_anomalous_q5_imgs.unsqueeze(dim=0)
 images_tensor = torch.cat([images_q1, images_q5], dim=0)
 
 # Plot the images
@@ -1057,14 +2204,13 @@ plot_images(images_tensor=images_tensor, titles=titles)
 **Question 1**
 """
 
-# Create CIFAR10 train dataloaders
-cifar10_train_loader = create_CIFAR10_dataloader(is_train=True, use_augmentations=False)
-
-# Compute CIFAR10 training dataset representations using VICReg's encoder (S3.Q1., with generated neighbors)
-data_img_encoder_q1_reps, data_img_encoder_q1_labels = compute_images_representations(cifar10_train_loader, encoder_q1)
+# Get CIFAR10 train images store
+cifar10_train_store = get_image_store('cifar10', is_train=True)
 
-# Compute CIFAR10 training dataset representations using VICReg's encoder (S3.Q5., without generated neighbors)
-data_img_encoder_q5_reps, data_img_encoder_q5_labels = compute_images_representations(cifar10_train_loader, encoder_q5)
+# Compute (or load the cached) CIFAR10 training dataset representations using VICReg's encoders (S3.Q1., with generated neighbors)
+# and (S3.Q5., without generated neighbors) in a single pass
+(data_img_encoder_q1_reps, data_img_encoder_q5_reps), cifar10_train_labels = get_multi_encoder_representations([encoder_q1, encoder_q5], cifar10_train_store)
+data_img_encoder_q1_labels, data_img_encoder_q5_labels = cifar10_train_labels, cifar10_train_labels
 
 # Convert VICReg's encoders representations to numpy
 data_img_encoder_q1_reps_np = data_img_encoder_q1_reps.cpu().numpy()
@@ -1086,8 +2232,8 @@ kmeans_q5_labels = torch.from_numpy(kmeans.labels_).to(DEVICE)
 """**Question 2**"""
 
 # Create label tensors according to each encoder representation
-encoder_q1_labels = torch.cat([kmeans_q1_labels.unsqueeze(dim=0), data_img_encoder_q1_labels.unsqueeze(dim=0)], dim=0)
-encoder_q5_labels = torch.cat([kmeans_q5_labels.unsqueeze(dim=0), data_img_encoder_q5_labels.unsqueeze(dim=0)], dim=0)
+encoder_q1_labels = torch.cat([kmeans_q1_labels.cpu().unsqueeze(dim=0), data_img_encoder_q1_labels.unsqueeze(dim=0)], dim=0)
+encoder_q5_labels = torch.cat([kmeans_q5_labels.cpu().unsqueeze(dim=0), data_img_encoder_q5_labels.unsqueeze(dim=0)], dim=0)
 
 # Map images VICReg's encoders representations into 2D space using TSNE method and plot two figures with diffrent labels
 # (1) labeled according to clusters
@@ -1112,3 +2258,392 @@ print(f"Silhouette score for VICReg's encoder representations (S3.Q1., with gene
 # Encoder from S3.Q5:
 encoder_q5_score = silhouette_score(data_img_encoder_q5_reps_np, kmeans_q5_labels.cpu().numpy(), metric='l2')
 print(f"Silhouette score for VICReg's encoder representations (S3.Q5., without generated neighbors): {encoder_q5_score:.4f}")
+
+"""# **Benchmarks**
+
+Optional benchmarks, enabled by setting RUN_BENCHMARKS to True.
+"""
+
+def benchmark_augmented_dataloaders(workers_list=[0, 2, 4, 8], num_of_batches=50):
+    # Compare the two views throughput of the PIL based loader with the batched tensor augmentations loader
+    print(f"\n{'Workers':>7} {'PIL (img/sec)':>14} {'Batched (img/sec)':>18}")
+    results = []
+    for num_workers in workers_list:
+        throughputs = []
+        for batched_augmentations in [False, True]:
+            dataloader = create_CIFAR10_dataloader(is_train=True, use_augmentations=True, batched_augmentations=batched_augmentations, num_workers=num_workers)
+            num_of_images = 0
+            start_time = perf_counter()
+            for index, (batch1, batch2) in enumerate(dataloader):
+                # Count the time until both views are on DEVICE
+                augm_images_batch1 = batch1[0].to(DEVICE)
+                augm_images_batch2 = batch2[0].to(DEVICE)
+                num_of_images += augm_images_batch1.size(0)
+                if index + 1 == num_of_batches:
+                    break
+            if DEVICE.type == 'cuda':
+                torch.cuda.synchronize()
+            throughputs.append(num_of_images / (perf_counter() - start_time))
+
+        results.append((num_workers, throughputs[0], throughputs[1]))
+        print(f"{num_workers:>7} {throughputs[0]:>14.1f} {throughputs[1]:>18.1f}")
+
+    return results
+
+
+def masked_cov_loss(proj_reps):
+    # The previous covariance objective, which builds the covariance and a diagonal mask
+    cov_proj = torch.cov(proj_reps.T)
+    diag_mask = torch.eye(proj_reps.size(1), device=proj_reps.device).bool()
+    return (1 / proj_reps.size(1)) * torch.sum(torch.pow(cov_proj.masked_select(~diag_mask), 2))
+
+
+def benchmark_VICReg_loss(proj_dims=[512, 2048, 4096, 8192], batch_size=BATCH_SIZE, block_size=1024, num_of_repeats=5):
+    # Compare the time and peak memory of a forward and backward of the covariance objective
+    criterions = {'masked': None, 'frobenius': VICRegLoss(), 'blocked': VICRegLoss(block_size=block_size)}
+    print(f"\n{'Proj dim':>8} {'Loss':>10} {'Time (ms)':>10} {'Peak (MB)':>10} {'Max diff':>10}")
+    results = []
+    for proj_dim in proj_dims:
+        proj_reps = torch.randn(batch_size, proj_dim, device=DEVICE, requires_grad=True)
+        var_proj = torch.var(proj_reps, dim=0)
+        reference_loss, reference_grad = None, None
+        for name, criterion in criterions.items():
+            def step():
+                loss = masked_cov_loss(proj_reps) if criterion is None else criterion.off_diagonal_cov_loss(proj_reps, var_proj)
+                grad, = torch.autograd.grad(loss, proj_reps, retain_graph=True)
+                return loss.detach(), grad
+
+            peak_memory = measure_peak_memory_mb(step)
+            start_time = perf_counter()
+            for _ in range(num_of_repeats):
+                loss, grad = step()
+            if DEVICE.type == 'cuda':
+                torch.cuda.synchronize()
+            step_time = (perf_counter() - start_time) / num_of_repeats * 1000
+
+            # Compare the loss and its gradient with the masked implementation
+            if reference_loss is None:
+                reference_loss, reference_grad = loss, grad
+            max_diff = max(abs(loss - reference_loss).item(), torch.max(torch.abs(grad - reference_grad)).item())
+
+            results.append((proj_dim, name, step_time, peak_memory, max_diff))
+            print(f"{proj_dim:>8} {name:>10} {step_time:>10.2f} {peak_memory:>10.1f} {max_diff:>10.2e}")
+
+    return results
+
+
+def benchmark_fast_training_modes(num_epochs=1, lp_num_epochs=1):
+    # Report the VICReg epoch time and the linear prober accuracy of every combination of the fast training options
+    train_loader = create_CIFAR10_dataloader(is_train=True, use_augmentations=True, batched_augmentations=True)
+    print(f"\n{'bf16':>5} {'Channels last':>13} {'Compiled':>8} {'Epoch (sec)':>11} {'LP accuracy (%)':>15}")
+    results = []
+    for use_bf16 in [False, True]:
+        for channels_last in [False, True]:
+            for compile_step in [False, True]:
+                torch.manual_seed(SEED)
+                encoder = Encoder(D=ENCODER_DIM, device=DEVICE).to(DEVICE)
+                vicreg_model = VICReg(encoder, Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM)).to(DEVICE)
+                options = dict(use_bf16=use_bf16, channels_last=channels_last, compile_step=compile_step)
+
+                start_time = perf_counter()
+                train_VICReg(vicreg_model=vicreg_model, train_loader=train_loader, num_epochs=num_epochs, **options)
+                epoch_time = (perf_counter() - start_time) / num_epochs
+
+                lp_model = train_LinearProber(encoder=encoder, num_epochs=lp_num_epochs, **options)
+                accuracy = test_LinearProber(lp_model)
+
+                results.append((use_bf16, channels_last, compile_step, epoch_time, accuracy))
+                print(f"{str(use_bf16):>5} {str(channels_last):>13} {str(compile_step):>8} {epoch_time:>11.1f} {accuracy:>15.2f}")
+
+    return results
+
+
+def benchmark_checkpointed_VICReg(batch_sizes=[256, 512, 1024, 2048, 4096]):
+    # Report the peak memory and step time of a VICReg training step with and without encoder checkpointing
+    print(f"\n{'Batch size':>10} {'Checkpointing':>13} {'Peak (MB)':>10} {'Step (sec)':>10}")
+    results = []
+    for batch_size in batch_sizes:
+        for use_checkpointing in [False, True]:
+            try:
+                peak_memory, step_time = measure_VICReg_step(batch_size, use_checkpointing)
+            except RuntimeError as error:
+                if not is_out_of_memory_error(error):
+                    raise
+                if DEVICE.type == 'cuda':
+                    torch.cuda.empty_cache()
+                peak_memory, step_time = float('inf'), float('inf')
+
+            results.append((batch_size, use_checkpointing, peak_memory, step_time))
+            print(f"{batch_size:>10} {str(use_checkpointing):>13} {peak_memory:>10.1f} {step_time:>10.3f}")
+
+    return results
+
+
+def benchmark_split_batchnorm(batch_size=BATCH_SIZE, num_of_steps=5):
+    # Compare the step time of two forward passes with a single split BatchNorm forward pass and check their losses and gradients match
+    torch.manual_seed(SEED)
+    vicreg_model = VICReg(Encoder(D=ENCODER_DIM, device=DEVICE), Projector(D=ENCODER_DIM, proj_dim=PROJ_DIM)).to(DEVICE).train()
+    split_vicreg_model = convert_to_split_batchnorm(copy.deepcopy(vicreg_model))
+    augm_images_batch1 = torch.randn(batch_size, 3, 32, 32, device=DEVICE)
+    augm_images_batch2 = torch.randn(batch_size, 3, 32, 32, device=DEVICE)
+
+    results = {}
+    for name, model, single_forward in [('two passes', vicreg_model, False), ('single pass', split_vicreg_model, True)]:
+        def step():
+            model.zero_grad(set_to_none=True)
+            with split_batchnorm_views(model, num_splits=2) if single_forward else contextlib.nullcontext():
+                inv_loss, var_loss, cov_loss = compute_VICReg_batch_losses(augm_images_batch1, augm_images_batch2, model, single_forward=single_forward)
+                loss = LAMBDA * inv_loss + MU * var_loss + NU * cov_loss
+                loss.backward()
+            return loss.detach()
+
+        # Both models start from the same state, so their first losses and gradients must match
+        loss = step()
+        grads = [param.grad.detach().clone() for param in model.parameters()]
+        start_time = perf_counter()
+        for _ in range(num_of_steps):
+            step()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        results[name] = (loss, grads, (perf_counter() - start_time) / num_of_steps)
+
+    (two_pass_loss, two_pass_grads, two_pass_time), (single_pass_loss, single_pass_grads, single_pass_time) = results['two passes'], results['single pass']
+    assert(torch.allclose(two_pass_loss, single_pass_loss, rtol=1e-4, atol=1e-5)), \
+        f"Losses differ (two passes: {two_pass_loss.item():.6f}, single pass: {single_pass_loss.item():.6f})"
+    assert(all(torch.allclose(two_pass_grad, single_pass_grad, rtol=1e-3, atol=1e-5) for two_pass_grad, single_pass_grad in zip(two_pass_grads, single_pass_grads))), \
+        "Gradients of the two passes and the single pass differ"
+    print(f"Two passes: {two_pass_time:.3f} sec/step, single pass: {single_pass_time:.3f} sec/step ({two_pass_time / single_pass_time:.2f}x)")
+    print(f"Losses and gradients match (two passes: {two_pass_loss.item():.6f}, single pass: {single_pass_loss.item():.6f})")
+
+    return results
+
+
+# Self contained loaders run in fresh interpreters by benchmark_model_artifact_loading (this script can't be imported
+# without running it). Each prints its load time and a checksum of the weights, which reads every loaded page
+TORCH_LOAD_CHILD_CODE = """
+import sys, time, torch
+start_time = time.perf_counter()
+state_dict = torch.load(sys.argv[1], map_location='cpu')
+checksum = sum(tensor.double().sum().item() for tensor in state_dict.values() if tensor.is_floating_point())
+print(time.perf_counter() - start_time, checksum)
+"""
+
+ARTIFACT_LOAD_CHILD_CODE = """
+import sys, time, json, struct, torch, numpy as np
+start_time = time.perf_counter()
+with open(sys.argv[1], 'rb') as artifact_file:
+    header_length, = struct.unpack('<Q', artifact_file.read(8))
+    header = json.loads(artifact_file.read(header_length))
+data = np.memmap(sys.argv[1], dtype=np.uint8, mode='c', offset=8 + header_length)
+state_dict = {}
+for name, tensor_header in header['tensors'].items():
+    dtype = np.dtype(tensor_header['dtype'])
+    num_of_bytes = dtype.itemsize * int(np.prod(tensor_header['shape']))
+    state_dict[name] = torch.from_numpy(data[tensor_header['offset']:tensor_header['offset'] + num_of_bytes].view(dtype).reshape(tensor_header['shape']))
+checksum = sum(tensor.double().sum().item() for tensor in state_dict.values() if tensor.is_floating_point())
+print(time.perf_counter() - start_time, checksum)
+"""
+
+def write_cold_copy(source_path, copy_path):
+    # Write a fresh copy of the file and evict its pages from the page cache, so the next read comes from the disk
+    shutil.copyfile(source_path, copy_path)
+    with open(copy_path, 'rb+') as copy_file:
+        os.fsync(copy_file.fileno())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(copy_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def benchmark_model_artifact_loading(model=None, num_of_repeats=10):
+    # Compare the cold start time to ready weights from a torch.save checkpoint and from a memory-mapped artifact.
+    # Each load runs in a fresh interpreter on a freshly written, uncached copy of the file
+    model = Encoder(D=ENCODER_DIM, device='cpu') if model is None else model.cpu()
+    checkpoint_path = os.path.join(MODEL_ARTIFACTS_DIR, 'benchmark_encoder.pt')
+    artifact_path = os.path.join(MODEL_ARTIFACTS_DIR, 'benchmark_encoder.bin')
+    os.makedirs(MODEL_ARTIFACTS_DIR, exist_ok=True)
+    torch.save(model.state_dict(), checkpoint_path)
+    save_model_artifact(model, artifact_path)
+    expected_checksum = sum(tensor.double().sum().item() for tensor in model.state_dict().values() if tensor.is_floating_point())
+
+    results = {}
+    for name, path, child_code in [('torch.load', checkpoint_path, TORCH_LOAD_CHILD_CODE), ('artifact', artifact_path, ARTIFACT_LOAD_CHILD_CODE)]:
+        cold_path = path + '.cold'
+        load_times, process_times = [], []
+        for _ in range(num_of_repeats):
+            write_cold_copy(path, cold_path)
+            start_time = perf_counter()
+            output = subprocess.run([sys.executable, '-c', child_code, cold_path], capture_output=True, text=True, check=True).stdout
+            process_times.append(perf_counter() - start_time)
+            load_time, checksum = map(float, output.split())
+            load_times.append(load_time)
+
+            # Check the loaded weights match the saved ones
+            assert(math.isclose(checksum, expected_checksum, rel_tol=1e-9, abs_tol=1e-6)), f"{name} loaded different weights"
+        os.remove(cold_path)
+
+        results[name] = (np.mean(load_times) * 1000, np.mean(process_times) * 1000)
+        print(f"{name}: {results[name][0]:.2f} ms to ready weights, {results[name][1]:.2f} ms per process")
+
+    return results
+
+
+def benchmark_representations_extraction(encoder=None, batch_sizes=[256, 1024]):
+    # Compare the throughput of the list based extraction with the inference mode, preallocated, prefetched extraction
+    encoder = Encoder(D=ENCODER_DIM, device=DEVICE).to(DEVICE) if encoder is None else encoder
+    store = get_image_store('cifar10', is_train=True)
+    print(f"\n{'Batch size':>10} {'Lists (img/sec)':>15} {'Engine (img/sec)':>16}")
+    results = []
+    for batch_size in batch_sizes:
+        dataloader = ImageStoreLoader(store, batch_size=batch_size, shuffle=False)
+
+        # The previous extraction, with autograd graphs and a final concatenation
+        start_time = perf_counter()
+        data_img_encoders_lst = [encoder.eval()(images).detach() for images, _ in dataloader]
+        torch.cat(data_img_encoders_lst, dim=0)
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        lists_throughput = len(store) / (perf_counter() - start_time)
+
+        start_time = perf_counter()
+        compute_images_representations(dataloader, encoder, verbose=False)
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        engine_throughput = len(store) / (perf_counter() - start_time)
+
+        results.append((batch_size, lists_throughput, engine_throughput))
+        print(f"{batch_size:>10} {lists_throughput:>15.1f} {engine_throughput:>16.1f}")
+
+    return results
+
+
+def benchmark_multi_encoder_extraction(num_of_encoders_list=[1, 2, 4]):
+    # Compare extracting the representations of K encoders with K separate passes and with a single pass
+    store = get_image_store('cifar10', is_train=True)
+    dataloader = ImageStoreLoader(store, batch_size=BATCH_SIZE, shuffle=False)
+    print(f"\n{'Encoders':>8} {'Separate (sec)':>14} {'Single pass (sec)':>17}")
+    results = []
+    for num_of_encoders in num_of_encoders_list:
+        encoders = [Encoder(D=ENCODER_DIM, device=DEVICE).to(DEVICE) for _ in range(num_of_encoders)]
+
+        start_time = perf_counter()
+        for encoder in encoders:
+            compute_images_representations(dataloader, encoder, verbose=False)
+        separate_time = perf_counter() - start_time
+
+        start_time = perf_counter()
+        compute_multi_encoder_representations(dataloader, encoders, verbose=False)
+        single_pass_time = perf_counter() - start_time
+
+        results.append((num_of_encoders, separate_time, single_pass_time))
+        print(f"{num_of_encoders:>8} {separate_time:>14.1f} {single_pass_time:>17.1f}")
+
+    return results
+
+
+def benchmark_faiss_indexes(samples_tensor=None, num_of_samples=200000, num_of_queries=10000, k=10,
+                            configs=[dict(index_type='flat'), dict(index_type='ivf_flat', nprobe=8), dict(index_type='ivf_flat', nprobe=32),
+                                     dict(index_type='ivf_pq', nprobe=16), dict(index_type='hnsw', ef_search=32), dict(index_type='hnsw', ef_search=128)]):
+    # Report the build time, recall@k against exact search and queries/sec of each index configuration
+    samples_tensor = torch.randn(num_of_samples, ENCODER_DIM) if samples_tensor is None else samples_tensor
+    query_vectors = samples_tensor[torch.randperm(samples_tensor.size(0))[:num_of_queries]] + 0.01 * torch.randn(num_of_queries, samples_tensor.size(1))
+    # The samples set is keyed by an explicit id, so each manager builds its index once and the timed searches reuse it
+    _, exact_indices = FaissIndexManager(index_type='flat').search(samples_tensor, query_vectors, k, index_id='benchmark_samples')
+
+    print(f"\n{'Index':>32} {'Build (sec)':>11} {'Recall@' + str(k):>10} {'Queries/sec':>12}")
+    results = []
+    for config in configs:
+        index_manager = FaissIndexManager(**config)
+        start_time = perf_counter()
+        index_manager.search(samples_tensor, query_vectors[:1], k, index_id='benchmark_samples')
+        build_time = perf_counter() - start_time
+
+        start_time = perf_counter()
+        _, indices = index_manager.search(samples_tensor, query_vectors, k, index_id='benchmark_samples')
+        queries_per_sec = num_of_queries / (perf_counter() - start_time)
+
+        recall = np.mean([len(np.intersect1d(found, exact)) / k for found, exact in zip(indices, exact_indices)])
+        name = index_manager.config_description() + (f"_nprobe{index_manager.nprobe}" if 'ivf' in index_manager.index_type else '') + \
+               (f"_efs{index_manager.ef_search}" if index_manager.index_type == 'hnsw' else '')
+        results.append((name, build_time, recall, queries_per_sec))
+        print(f"{name:>32} {build_time:>11.2f} {recall:>10.4f} {queries_per_sec:>12.1f}")
+
+    return results
+
+
+def benchmark_knn_self_join(sizes=[10000, 50000, 200000], k=3):
+    # Compare the time, peak memory and agreement of the tiled self-join with a single FAISS search of all the rows,
+    # and the time of the self-join restricted to a single torch thread
+    print(f"\n{'Rows':>8} {'FAISS (sec)':>11} {'FAISS (MB)':>10} {'Join (sec)':>10} {'Join (MB)':>9} {'1 thread (sec)':>14} {'Agreement':>9}")
+    results = []
+    for num_of_samples in sizes:
+        embeddings = torch.randn(num_of_samples, ENCODER_DIM, device=DEVICE)
+        outputs = {}
+
+        def run_faiss():
+            outputs['faiss'] = find_k_nearest_neighbors(embeddings, embeddings, k=k, query_vectors_in_samples=True, index_manager=FaissIndexManager('flat'),
+                                                        index_id='benchmark_embeddings')[1]
+
+        def run_join():
+            outputs['join'] = knn_self_join(embeddings, k=k)[1]
+
+        timings = []
+        for run in [run_faiss, run_join]:
+            start_time = perf_counter()
+            peak_memory = measure_peak_memory_mb(run)
+            timings.append((perf_counter() - start_time, peak_memory))
+
+        num_of_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            start_time = perf_counter()
+            run_join()
+            if DEVICE.type == 'cuda':
+                torch.cuda.synchronize()
+            single_thread_time = perf_counter() - start_time
+        finally:
+            torch.set_num_threads(num_of_threads)
+
+        agreement = torch.mean((torch.sort(outputs['faiss'], dim=1)[0] == torch.sort(outputs['join'], dim=1)[0]).all(dim=1).float()).item()
+        results.append((num_of_samples, *timings[0], *timings[1], single_thread_time, agreement))
+        print(f"{num_of_samples:>8} {timings[0][0]:>11.2f} {timings[0][1]:>10.1f} {timings[1][0]:>10.2f} {timings[1][1]:>9.1f} {single_thread_time:>14.2f} {agreement:>9.4f}")
+
+    return results
+
+
+def benchmark_farthest_neighbors(num_of_samples=50000, num_of_queries=1000, k=5, num_of_repeats=3):
+    # Compare the inner product FAISS search with the farthest neighbor index, and check they return the same neighbors
+    samples_tensor = torch.randn(num_of_samples, ENCODER_DIM, device=DEVICE)
+    query_vectors = torch.randn(num_of_queries, ENCODER_DIM, device=DEVICE)
+
+    start_time = perf_counter()
+    for _ in range(num_of_repeats):
+        faiss_distances, faiss_indices = find_k_distant_neighbors(samples_tensor, query_vectors, k)
+    faiss_time = (perf_counter() - start_time) / num_of_repeats
+
+    start_time = perf_counter()
+    farthest_neighbor_index = FarthestNeighborIndex(samples_tensor)
+    build_time = perf_counter() - start_time
+    start_time = perf_counter()
+    for _ in range(num_of_repeats):
+        index_distances, index_indices = farthest_neighbor_index.search(query_vectors, k)
+    search_time = (perf_counter() - start_time) / num_of_repeats
+
+    same_neighbors = torch.mean((torch.sort(faiss_indices, dim=1)[0] == torch.sort(index_indices, dim=1)[0]).all(dim=1).float()).item()
+    mean_candidates = farthest_neighbor_index.num_of_exact_distances / num_of_queries
+    print(f"FAISS inner product: {faiss_time:.3f} sec, farthest neighbor index: {search_time:.3f} sec (+ {build_time:.3f} sec build)")
+    print(f"Mean exact distances per query: {mean_candidates:.1f} of {num_of_samples}, same neighbors: {same_neighbors:.4f}, "
+          f"max distance difference: {torch.max(torch.abs(faiss_distances - index_distances)).item():.2e}")
+
+    return faiss_time, build_time, search_time, mean_candidates, same_neighbors
+
+
+if RUN_BENCHMARKS:
+    benchmark_augmented_dataloaders()
+    benchmark_VICReg_loss()
+    benchmark_fast_training_modes()
+    benchmark_checkpointed_VICReg()
+    benchmark_split_batchnorm()
+    benchmark_model_artifact_loading()
+    benchmark_representations_extraction()
+    benchmark_multi_encoder_extraction()
+    benchmark_faiss_indexes()
+    benchmark_knn_self_join()
+    benchmark_farthest_neighbors()